@@ -0,0 +1,84 @@
+"""
+Benchmark of the HTML to markdown conversion (`content_extraction.py`) against the plain `markdownify` conversion of
+the whole page (which is what the app used to do).
+
+For every saved HTML page in the fixtures directory it reports the conversion time and the number of tokens in the
+resulting markdown (exact if `tiktoken` is installed, estimated otherwise).
+
+Usage (from the root of the repository):
+
+    python benchmarks/bench_content_extraction.py [FIXTURES_DIR] [--repeat N] [--max-chars N]
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from markdownify import markdownify
+
+from content_extraction import html_to_markdown
+
+DEFAULT_FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "html"
+
+
+def _token_counter() -> Callable[[str], int]:
+    try:
+        import tiktoken  # pylint: disable=import-outside-toplevel
+
+        encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except ImportError:
+        # A rough, but commonly used estimate for English text
+        return lambda text: len(text) // 4
+
+
+def _measure(convert: Callable[[str], str], html: str, repeat: int) -> tuple[float, str]:
+    best_sec = float("inf")
+    markdown = ""
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        markdown = convert(html)
+        best_sec = min(best_sec, time.perf_counter() - started_at)
+    return best_sec, markdown
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures_dir", nargs="?", default=str(DEFAULT_FIXTURES_DIR))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-chars", type=int, default=60_000)
+    args = parser.parse_args()
+
+    count_tokens = _token_counter()
+    fixture_paths = sorted(Path(args.fixtures_dir).glob("*.htm*"))
+    if not fixture_paths:
+        sys.exit(f"No *.html fixtures found in {args.fixtures_dir}")
+
+    print(f"{'fixture':<30} {'html KB':>8} {'md ms':>8} {'md tokens':>10} {'new ms':>8} {'new tokens':>10}")
+    totals = [0.0, 0, 0.0, 0]
+    for path in fixture_paths:
+        html = path.read_text(encoding="utf-8", errors="replace")
+        baseline_sec, baseline_md = _measure(markdownify, html, args.repeat)
+        new_sec, new_md = _measure(lambda html: html_to_markdown(html, args.max_chars), html, args.repeat)
+        baseline_tokens, new_tokens = count_tokens(baseline_md), count_tokens(new_md)
+
+        totals[0] += baseline_sec
+        totals[1] += baseline_tokens
+        totals[2] += new_sec
+        totals[3] += new_tokens
+        print(
+            f"{path.name:<30} {os.path.getsize(path) / 1024:>8.1f} {baseline_sec * 1000:>8.1f} {baseline_tokens:>10} "
+            f"{new_sec * 1000:>8.1f} {new_tokens:>10}"
+        )
+
+    print(f"{'TOTAL':<30} {'':>8} {totals[0] * 1000:>8.1f} {totals[1]:>10} {totals[2] * 1000:>8.1f} {totals[3]:>10}")
+
+
+if __name__ == "__main__":
+    main()
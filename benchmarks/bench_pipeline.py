@@ -0,0 +1,223 @@
+"""
+End-to-end benchmark of the research pipeline (`web_research.py`) that runs completely offline: the web searches, the
+scraped pages and the LLM calls are replayed from recorded fixtures (see `replay.py`) after synthetic delays drawn from
+configurable latency distributions.
+
+For every question of the suite (`questions.txt` in the fixtures directory) it reports the end-to-end time, the time to
+the first token of the final answer and the peak memory allocated by Python (in the main process - the HTML conversion
+runs in separate processes). The throughput of every stage of the pipeline is reported based on the traces of the runs
+(see `tracing.py`).
+
+Usage (from the root of the repository):
+
+    python benchmarks/bench_pipeline.py [FIXTURES_DIR] [--repeat N] [--concurrency N] [--seed N]
+        [--latency KIND=MEDIAN[:P95] ...] [--json-output FILE] [--baseline FILE] [--max-regression FRACTION]
+
+KIND is "serp", "http_page" (a plain HTTP GET of a page), "page" (the scraping browser) or "llm", latencies are in
+seconds (e.g. --latency llm=1.5:4). With --baseline the script exits with a non-zero status if the end-to-end time or
+the time to the first answer token got worse than in the baseline (a file previously written with --json-output) by
+more than --max-regression.
+
+The fixtures in benchmarks/fixtures/pipeline are synthetic (see `generate_pipeline_fixtures.py`). To record real ones,
+run the app with WEB_RESEARCH_REPLAY=record and WEB_RESEARCH_FIXTURES_DIR=<new fixtures dir> and put the questions you
+asked into <new fixtures dir>/questions.txt.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+DEFAULT_FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "pipeline"
+DEFAULT_LATENCIES = {
+    "serp": "0.8:2",
+    "page": "2:6",
+    "http_page": "0.3:1",
+    "llm": "1:3",
+}
+ANSWER_HEADER = "==========\nANSWER:\n=========="
+
+
+def _parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures_dir", nargs="?", default=str(DEFAULT_FIXTURES_DIR))
+    parser.add_argument("--repeat", type=int, default=1, help="how many times to run every question")
+    parser.add_argument("--concurrency", type=int, default=1, help="how many questions to research at the same time")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic latencies")
+    parser.add_argument("--latency", action="append", default=[], metavar="KIND=MEDIAN[:P95]")
+    parser.add_argument("--stream-chunk-delay", type=float, default=0.01, help="delay between answer tokens (sec)")
+    parser.add_argument("--with-cache", action="store_true", help="don't disable the on-disk cache")
+    parser.add_argument("--no-memory", action="store_true", help="don't trace memory allocations (faster)")
+    parser.add_argument("--json-output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    return parser.parse_args()
+
+
+async def _aresearch(question: str) -> dict[str, Any]:
+    # pylint: disable=import-outside-toplevel
+    # `web_research` (`utils`, to be precise) checks the version of MiniAgents, so it goes first
+    from web_research import research_agent
+
+    from miniagents import ErrorMessage  # pylint: disable=wrong-import-order
+
+    started_at = time.perf_counter()
+    first_answer_token_sec = None
+    answer_started = False
+    errors = 0
+    async for message_promise in research_agent.trigger(question):
+        if message_promise.known_beforehand.get("not_for_user"):
+            continue
+        async for _ in message_promise:
+            if answer_started and first_answer_token_sec is None:
+                first_answer_token_sec = time.perf_counter() - started_at
+        message = await message_promise
+        answer_started = answer_started or str(message) == ANSWER_HEADER
+        # `errors_as_messages` is on, so the errors arrive as messages
+        errors += isinstance(message, ErrorMessage)
+
+    return {
+        "question": question,
+        "e2e_sec": time.perf_counter() - started_at,
+        "first_answer_token_sec": first_answer_token_sec,
+        "errors": errors,
+    }
+
+
+async def _abenchmark(questions: list[str], args: argparse.Namespace) -> list[dict[str, Any]]:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def _arun(question: str) -> dict[str, Any]:
+        async with semaphore:
+            if not args.no_memory and args.concurrency == 1:
+                tracemalloc.reset_peak()
+            run = await _aresearch(question)
+            if not args.no_memory:
+                run["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+            return run
+
+    return await asyncio.gather(*(_arun(question) for question in questions * args.repeat))
+
+
+def _stage_throughput(trace_file: str) -> dict[str, dict[str, float]]:
+    summaries = []
+    if os.path.exists(trace_file):
+        with open(trace_file, encoding="utf-8") as file:
+            summaries = [record for record in map(json.loads, file) if record.get("type") == "summary"]
+
+    total_wall_clock_sec = sum(summary["wall_clock_sec"] for summary in summaries) or 1.0
+    stages: dict[str, dict[str, float]] = {}
+    for summary in summaries:
+        for name, stage in summary["stages"].items():
+            totals = stages.setdefault(name, {"count": 0, "total_sec": 0.0, "queue_wait_sec": 0.0})
+            totals["count"] += stage["count"]
+            totals["total_sec"] += stage["total_sec"]
+            totals["queue_wait_sec"] += stage["queue_wait_sec"]
+    for totals in stages.values():
+        totals["per_sec"] = totals["count"] / total_wall_clock_sec
+        totals["avg_sec"] = totals["total_sec"] / max(totals["count"], 1)
+        totals["avg_queue_wait_sec"] = totals["queue_wait_sec"] / max(totals["count"], 1)
+    return stages
+
+
+def _summarize(runs: list[dict[str, Any]]) -> dict[str, float]:
+    e2e = [run["e2e_sec"] for run in runs]
+    ttft = [run["first_answer_token_sec"] for run in runs if run["first_answer_token_sec"] is not None]
+    summary = {
+        "e2e_mean_sec": statistics.mean(e2e),
+        "e2e_p50_sec": statistics.median(e2e),
+        "e2e_max_sec": max(e2e),
+        "first_answer_token_mean_sec": statistics.mean(ttft) if ttft else float("nan"),
+        "errors": sum(run["errors"] for run in runs),
+    }
+    if "peak_memory_mb" in runs[0]:
+        summary["peak_memory_mb"] = max(run["peak_memory_mb"] for run in runs)
+    return summary
+
+
+def _check_regressions(summary: dict[str, float], baseline_file: str, max_regression: float) -> list[str]:
+    with open(baseline_file, encoding="utf-8") as file:
+        baseline = json.load(file)["summary"]
+    regressions = []
+    for metric in ("e2e_mean_sec", "first_answer_token_mean_sec"):
+        if baseline.get(metric) and summary[metric] > baseline[metric] * (1 + max_regression):
+            regressions.append(f"{metric}: {summary[metric]:.2f} (baseline {baseline[metric]:.2f})")
+    return regressions
+
+
+def main() -> None:
+    args = _parse_args()
+    questions_file = Path(args.fixtures_dir) / "questions.txt"
+    if not questions_file.exists():
+        sys.exit(f"{questions_file} not found")
+    questions = [line.strip() for line in questions_file.read_text(encoding="utf-8").splitlines() if line.strip()]
+
+    trace_file = os.path.join(tempfile.mkdtemp(prefix="bench_pipeline_"), "traces.jsonl")
+    # Everything is served from the fixtures, the credentials only need to be present
+    os.environ.setdefault("OPENAI_API_KEY", "replay")
+    os.environ.setdefault("BRIGHTDATA_SERP_API_CREDS", "replay:replay")
+    os.environ.setdefault("BRIGHTDATA_SCRAPING_BROWSER_CREDS", "replay:replay")
+    os.environ["WEB_RESEARCH_REPLAY"] = "replay"
+    os.environ["WEB_RESEARCH_FIXTURES_DIR"] = args.fixtures_dir
+    os.environ["WEB_RESEARCH_TRACE_FILE"] = trace_file
+    os.environ["WEB_RESEARCH_TRACING"] = "true"
+    if not args.with_cache:
+        os.environ["WEB_RESEARCH_CACHE"] = "false"
+
+    # pylint: disable=import-outside-toplevel
+    from replay import LatencyDistribution
+    from utils import WebResearchMiniAgents, replay_session
+
+    latencies = dict(DEFAULT_LATENCIES)
+    latencies.update(latency.split("=", 1) for latency in args.latency)
+    replay_session.configure(
+        latencies={kind: LatencyDistribution.parse(latency) for kind, latency in latencies.items()},
+        stream_chunk_delay_sec=args.stream_chunk_delay,
+        seed=args.seed,
+    )
+
+    if not args.no_memory:
+        tracemalloc.start()
+    runs = WebResearchMiniAgents().run(_abenchmark(questions, args))
+    stages = _stage_throughput(trace_file)
+    summary = _summarize(runs)
+
+    print(f"{'question':<50} {'e2e s':>8} {'ttft s':>8} {'peak MB':>8} {'errors':>6}")
+    for run in runs:
+        ttft = run["first_answer_token_sec"]
+        print(
+            f"{run['question'][:50]:<50} {run['e2e_sec']:>8.2f} {ttft if ttft is not None else float('nan'):>8.2f} "
+            f"{run.get('peak_memory_mb', float('nan')):>8.1f} {run['errors']:>6}"
+        )
+    print()
+    print(f"{'stage':<20} {'count':>6} {'per sec':>8} {'avg s':>8} {'avg wait s':>10}")
+    for name, stage in stages.items():
+        print(
+            f"{name:<20} {stage['count']:>6} {stage['per_sec']:>8.2f} {stage['avg_sec']:>8.2f} "
+            f"{stage['avg_queue_wait_sec']:>10.2f}"
+        )
+    print()
+    for metric, value in summary.items():
+        print(f"{metric:<30} {value:>10.2f}")
+
+    if args.json_output:
+        with open(args.json_output, "w", encoding="utf-8") as file:
+            json.dump({"summary": summary, "stages": stages, "runs": runs}, file, indent=2)
+
+    if args.baseline:
+        regressions = _check_regressions(summary, args.baseline, args.max_regression)
+        if regressions:
+            sys.exit("REGRESSIONS:\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
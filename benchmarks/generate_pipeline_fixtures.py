@@ -0,0 +1,289 @@
+"""
+Generate the synthetic fixtures in benchmarks/fixtures/pipeline (used by `bench_pipeline.py`).
+
+Real fixtures are recorded by running the app with WEB_RESEARCH_REPLAY=record (see `replay.py`). These synthetic ones
+exist so that the benchmark can run anywhere without credentials: they are shaped like the real responses of the SERP
+API, OpenAI, the web servers of the pages and the scraping browser.
+
+Usage (from the root of the repository):
+
+    python benchmarks/generate_pipeline_fixtures.py [FIXTURES_DIR]
+"""
+
+import argparse
+import json
+import shutil
+import sys
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from cache import normalize_query, normalize_url
+from replay import FixtureStore
+
+DEFAULT_FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures" / "pipeline"
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+PLANNING_MODEL = "o4-mini"
+EXTRACTION_MODEL = "gpt-4o-mini"
+# Facts are extracted with this model when the budget of a run is running low (see `budget.py`)
+CHEAPER_EXTRACTION_MODEL = "gpt-4.1-nano"
+# This page is long enough to be processed in chunks
+LONG_PAGE_URL = "https://developer.example.org/docs/http/status"
+# This page is rendered with JavaScript (a plain HTTP GET returns an empty shell, so it is escalated to the browser -
+# see `fetch_tiers.py`)
+JS_ONLY_PAGE_URL = "https://architecture.example.net/backoff-and-jitter"
+
+# question -> web searches -> web pages
+SUITE = {
+    "Which HTTP status codes should a client retry and how long should it wait between retries?": {
+        "retryable http status codes": [
+            ("https://developer.example.org/docs/http/status", "HTTP status codes reference"),
+            ("https://blog.example.com/retries-explained", "When to retry HTTP requests"),
+        ],
+        "exponential backoff with jitter": [
+            ("https://architecture.example.net/backoff-and-jitter", "Exponential backoff and jitter"),
+            # The same page as in the previous search (see `dedup.py`)
+            ("http://www.blog.example.com/retries-explained/?utm_source=newsletter", "When to retry HTTP requests"),
+        ],
+    },
+    "How do connection pooling and HTTP keep-alive reduce request latency?": {
+        "http keep-alive connection reuse latency": [
+            ("https://developer.example.org/docs/http/keep-alive", "Keep-Alive header"),
+            ("https://perf.example.io/handshakes", "The cost of TCP and TLS handshakes"),
+        ],
+        "connection pool size tuning": [
+            ("https://perf.example.io/connection-pools", "Sizing connection pools"),
+            # A syndicated copy of the previous page
+            ("https://news.example.net/2024/05/sizing-connection-pools", "Sizing connection pools"),
+        ],
+    },
+}
+# What real SERPs contain besides the organic results
+SERP_NOISE = {
+    "top_ads": [
+        {
+            "link": "https://ads.example.com/click?campaign=123&utm_source=google",
+            "title": "Best API Gateway - Try It Free",
+            "description": "Retries, rate limiting and more. Sign up today!",
+        }
+    ],
+    "knowledge": {"name": "HTTP", "description": "The Hypertext Transfer Protocol is an application layer protocol."},
+    "people_also_ask": [
+        {"question": "What does HTTP 503 mean?", "answer_source": "https://developer.example.org/docs/http/503"}
+    ],
+    "related": [{"text": "http retry best practices", "link": "https://www.google.com/search?q=http+retry"}],
+}
+
+
+def _chat_completion(model: str, content: str) -> dict[str, Any]:
+    return {
+        "id": "chatcmpl-replay",
+        "object": "chat.completion",
+        "created": 1_700_000_000,
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 2_000,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": 2_000 + len(content) // 4,
+        },
+    }
+
+
+def _streamed_chat_completion(model: str, content: str) -> str:
+    words = content.split(" ")
+    events = []
+    for word_idx, word in enumerate(words):
+        chunk = {
+            "id": "chatcmpl-replay",
+            "object": "chat.completion.chunk",
+            "created": 1_700_000_000,
+            "model": model,
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": word if word_idx == 0 else " " + word},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        events.append(f"data: {json.dumps(chunk)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events)
+
+
+def _put_llm(store: FixtureStore, route: list[Any], text: str, content: str) -> None:
+    # See `_fingerprint_request` in `replay.py`
+    _, model, _, stream = route
+    if stream:
+        response = {
+            "status_code": 200,
+            "headers": {"content-type": "text/event-stream; charset=utf-8"},
+            "body": _streamed_chat_completion(model, content),
+        }
+    else:
+        response = {
+            "status_code": 200,
+            "headers": {"content-type": "application/json"},
+            "body": json.dumps(_chat_completion(model, content)),
+        }
+    store.put(
+        "llm",
+        json.dumps([route, text]),
+        {
+            "request": {
+                "method": "POST",
+                "url": f"https://api.openai.com{CHAT_COMPLETIONS_PATH}",
+                "route": route,
+                "text": text,
+            },
+            "response": response,
+        },
+    )
+
+
+def _page_html(title: str, paragraphs: int) -> str:
+    body = "\n".join(
+        f"<p>{title}, paragraph {paragraph_idx + 1}. Clients should retry idempotent requests that failed with 408, "
+        f"429, 500, 502, 503 or 504 after an exponentially growing, randomized delay, and reuse kept-alive "
+        f"connections to avoid paying for new TCP and TLS handshakes.</p>"
+        for paragraph_idx in range(paragraphs)
+    )
+    return (
+        f"<html><head><title>{title}</title></head><body>"
+        f"<nav><a href='/'>Home</a> <a href='/docs'>Docs</a></nav>"
+        f"<main><article><h1>{title}</h1>\n{body}</article></main>"
+        f"<footer>Copyright Example Inc.</footer></body></html>"
+    )
+
+
+def _js_only_page_html() -> str:
+    return (
+        f"<html><head><title>Loading...</title><script src='/static/js/vendor.3f9a1c.js'></script>"
+        f"<script src='/static/js/app.8be2d0.js'></script><style>{'#root{min-height:100vh}' * 50}</style></head>"
+        f"<body><div id='root'></div><noscript>You need to enable JavaScript to run this app.</noscript></body></html>"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("fixtures_dir", nargs="?", default=str(DEFAULT_FIXTURES_DIR))
+    args = parser.parse_args()
+
+    fixtures_dir = Path(args.fixtures_dir)
+    for kind in ("llm", "page", "http_page", "serp"):
+        shutil.rmtree(fixtures_dir / kind, ignore_errors=True)
+    store = FixtureStore(str(fixtures_dir))
+
+    pages: dict[str, str] = {}
+    for question, web_searches in SUITE.items():
+        _put_llm(
+            store,
+            [CHAT_COMPLETIONS_PATH, PLANNING_MODEL, "WebSearchesToBeDone", False],
+            question,
+            json.dumps(
+                {
+                    "web_searches": [
+                        {"rationale": f"Find out about {query}", "web_search_query": query} for query in web_searches
+                    ]
+                }
+            ),
+        )
+        for query, web_pages in web_searches.items():
+            organic = [
+                {"link": url, "title": title, "description": f"{title} - everything about {query}.", "rank": rank}
+                for rank, (url, title) in enumerate(web_pages, start=1)
+            ]
+            organic += [
+                {
+                    "link": f"https://forum.example.com/t/{rank}",
+                    "title": f"Forum thread #{rank}",
+                    "description": "Anyone knows? Asking for a friend.",
+                    "rank": rank,
+                    "extensions": [{"type": "text", "text": f"{rank} answers"}],
+                }
+                for rank in range(len(organic) + 1, 11)
+            ]
+            store.put(
+                "serp",
+                normalize_query(query),
+                {
+                    "request": {
+                        "method": "GET",
+                        "url": "https://www.google.com/search",
+                        "route": ["serp"],
+                        "text": query,
+                    },
+                    "response": {
+                        "status_code": 200,
+                        "headers": {"content-type": "application/json"},
+                        "body": json.dumps({"general": {"query": query}, "organic": organic, **SERP_NOISE}),
+                    },
+                },
+            )
+            _put_llm(
+                store,
+                [CHAT_COMPLETIONS_PATH, PLANNING_MODEL, "WebPagesToBeRead", False],
+                f"{question}\n\nSEARCH QUERY: {query}",
+                json.dumps({"web_pages": [{"rationale": f"Covers {query}", "url": url} for url, _ in web_pages]}),
+            )
+            for url, title in web_pages:
+                pages[url] = _page_html(title, 200 if url == LONG_PAGE_URL else 20)
+
+        _put_llm(
+            store,
+            [CHAT_COMPLETIONS_PATH, EXTRACTION_MODEL, None, True],
+            f"USER QUESTION:\n\n{question}\n\nINFORMATION FOUND ON THE INTERNET:",
+            f"Based on the information found on the internet, here is the answer to the question: {question} "
+            + "Retry 408, 429 and 5xx responses with exponential backoff and full jitter, and keep connections "
+            "alive so that retries and follow-up requests don't pay for new handshakes. " * 10,
+        )
+
+        # The summaries of the pages that were read after the final answer had started (see `synthesis.py`)
+        _put_llm(
+            store,
+            [CHAT_COMPLETIONS_PATH, EXTRACTION_MODEL, None, False],
+            f"The USER QUESTION was already answered based on part of the information found on the internet (see "
+            f"ANSWER GIVEN SO FAR).\n\nUSER QUESTION:\n\n{question}\n\nANSWER GIVEN SO FAR:",
+            "The pages that were read later confirm the answer above and add that a Retry-After header, when present, "
+            "takes precedence over the computed backoff delay.",
+        )
+
+    (fixtures_dir / "questions.txt").write_text("".join(f"{question}\n" for question in SUITE), encoding="utf-8")
+
+    for url, html in pages.items():
+        store.put("page", normalize_url(url), {"url": url, "html": html})
+        store.put(
+            "http_page",
+            normalize_url(url),
+            {
+                "request": {"method": "GET", "url": url, "route": ["http_page"], "text": normalize_url(url)},
+                "response": {
+                    "status_code": 200,
+                    "headers": {"content-type": "text/html; charset=utf-8"},
+                    "body": _js_only_page_html() if url == JS_ONLY_PAGE_URL else html,
+                },
+            },
+        )
+        for model in (EXTRACTION_MODEL, CHEAPER_EXTRACTION_MODEL):
+            _put_llm(
+                store,
+                [CHAT_COMPLETIONS_PATH, model, None, False],
+                f"URL: {url}\nWEB PAGE CONTENT",
+                f"- {url} recommends retrying 408, 429, 500, 502, 503 and 504 responses.\n"
+                "- The delay between retries should grow exponentially and be randomized (jitter).\n"
+                "- Kept-alive connections avoid the cost of new TCP and TLS handshakes.",
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+A local web server with test pages for the tiered fetching of web pages (see `fetch_tiers.py`): static pages that a
+plain HTTP GET can read, and pages that need a browser (rendered with JavaScript, behind a bot wall etc.).
+
+With --check the server is started in the background, every page is fetched with a plain HTTP GET the same way the
+pipeline does it, and the script prints which tier every page ends up with (and why) and exits with a non-zero status
+if any of them ends up with a tier other than expected.
+
+Usage (from the root of the repository):
+
+    python benchmarks/serve_test_pages.py [--host HOST] [--port PORT] [--check]
+"""
+
+import argparse
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from content_extraction import html_to_markdown
+from fetch_tiers import reason_to_escalate_content, reason_to_escalate_response
+
+ARTICLE_PARAGRAPH = (
+    "Clients should retry idempotent requests that failed with 408, 429, 500, 502, 503 or 504 after an exponentially "
+    "growing, randomized delay, and reuse kept-alive connections to avoid paying for new TCP and TLS handshakes."
+)
+STATIC_ARTICLE = (
+    "<html><head><title>Retrying HTTP requests</title></head><body>"
+    "<nav><a href='/'>Home</a> <a href='/docs'>Docs</a></nav>"
+    "<main><article><h1>Retrying HTTP requests</h1>"
+    + "".join(f"<p>{ARTICLE_PARAGRAPH}</p>" for _ in range(10))
+    + "</article></main><footer>Copyright Example Inc.</footer></body></html>"
+)
+# Layout wrappers whose classes merely mention boilerplate words must not be stripped together with the article
+SIDEBAR_LAYOUT_ARTICLE = (
+    "<html><head><title>Retrying HTTP requests</title></head><body>"
+    "<div class='site-content has-sidebar'><div class='layout--with-sidebar social-embed-ready'>"
+    "<article class='post sponsored-post'><h1>Retrying HTTP requests</h1>"
+    + "".join(f"<p>{ARTICLE_PARAGRAPH}</p>" for _ in range(10))
+    + "</article><div class='sidebar'><a href='/'>Popular posts</a></div></div></div></body></html>"
+)
+# ASP.NET WebForms pages have the whole body inside a form - it must not be stripped like a search or a login form
+WEB_FORMS_ARTICLE = (
+    "<html><head><title>Retrying HTTP requests</title></head><body>"
+    "<form method='post' action='./article.aspx' id='aspnetForm'><div class='page'><h1>Retrying HTTP requests</h1>"
+    + "".join(f"<p>{ARTICLE_PARAGRAPH}</p>" for _ in range(10))
+    + "<form class='search'><input name='q'></form></div></form></body></html>"
+)
+JS_ONLY_APP = (
+    "<html><head><title>Loading...</title><script src='/static/js/app.js'></script>"
+    f"<style>{'#root{min-height:100vh}' * 50}</style></head>"
+    "<body><div id='root'></div><noscript>You need to enable JavaScript to run this app.</noscript></body></html>"
+)
+BOT_WALL = (
+    "<html><head><title>Just a moment...</title></head><body>"
+    "<div id='challenge-platform'>Checking if the site connection is secure</div></body></html>"
+)
+APP_SCRIPT = (
+    "document.addEventListener('DOMContentLoaded', () => {"
+    f"document.getElementById('root').innerHTML = '<h1>Retrying HTTP requests</h1><p>{ARTICLE_PARAGRAPH}</p>'"
+    ".repeat(10);});"
+)
+
+# path -> (status code, content type, body, the tier the page is expected to end up with)
+PAGES = {
+    "/static/article": (200, "text/html; charset=utf-8", STATIC_ARTICLE, "http"),
+    "/static/sidebar-layout": (200, "text/html; charset=utf-8", SIDEBAR_LAYOUT_ARTICLE, "http"),
+    "/static/web-forms": (200, "text/html; charset=utf-8", WEB_FORMS_ARTICLE, "http"),
+    "/static/notes.txt": (200, "text/plain; charset=utf-8", "\n\n".join([ARTICLE_PARAGRAPH] * 5), "http"),
+    "/js-only/app": (200, "text/html; charset=utf-8", JS_ONLY_APP, "browser"),
+    "/static/js/app.js": (200, "application/javascript", APP_SCRIPT, "browser"),
+    "/bot-wall": (403, "text/html; charset=utf-8", BOT_WALL, "browser"),
+    "/bot-wall/ok-status": (200, "text/html; charset=utf-8", BOT_WALL, "browser"),
+    "/empty": (200, "text/html; charset=utf-8", "", "browser"),
+    "/image.png": (200, "image/png", "\x89PNG", "browser"),
+}
+
+
+class TestPageHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        status_code, content_type, body, _ = PAGES.get(
+            self.path, (404, "text/html; charset=utf-8", "<html><body>Not found</body></html>", None)
+        )
+        data = body.encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:  # pylint: disable=redefined-builtin
+        # Only the --check report is printed
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def check_pages(base_url: str) -> bool:
+    """
+    Fetch every test page with a plain HTTP GET and print which tier it ends up with (True if all of them end up with
+    the expected tiers).
+    """
+    all_as_expected = True
+    print(f"{'page':<24} {'expected':<8} {'tier':<8} {'ms':>6}  reason")
+    with httpx.Client(follow_redirects=True, timeout=10) as client:
+        for path, (_, _, _, expected_tier) in PAGES.items():
+            started_at = time.perf_counter()
+            response = client.get(f"{base_url}{path}")
+            content_type = response.headers.get("content-type", "")
+            reason = reason_to_escalate_response(response.status_code, content_type, len(response.content))
+            if reason is None and content_type.startswith("text/html"):
+                reason = reason_to_escalate_content(response.text, html_to_markdown(response.text))
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+
+            tier = "browser" if reason else "http"
+            all_as_expected = all_as_expected and tier == expected_tier
+            mark = "" if tier == expected_tier else "  <-- UNEXPECTED"
+            print(f"{path:<24} {expected_tier:<8} {tier:<8} {elapsed_ms:>6.1f}  {reason or ''}{mark}")
+    return all_as_expected
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="0 - any free port")
+    parser.add_argument("--check", action="store_true", help="check the tiers of the pages and exit")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, 0 if args.check else args.port), TestPageHandler)
+    server.quiet = args.check
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    if not args.check:
+        print(f"Serving the test pages at {base_url}:")
+        for path in PAGES:
+            print(f"  {base_url}{path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        all_as_expected = check_pages(base_url)
+    finally:
+        server.shutdown()
+        server.server_close()
+    sys.exit(0 if all_as_expected else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Deadline- and budget-aware execution of research runs.
+
+A run can be limited in time ("answer within 30 seconds"), in LLM tokens and in paid requests (web searches and
+remote browser scrapings - plain HTTP fetches of pages and cache hits are free). `RunBudget` is created by the
+`research_agent` for every run and passed to the other agents, which report what they spend. As the budget runs down,
+the pipeline degrades gracefully instead of running every branch to completion:
+
+- while enough of the budget is left (`BudgetLimits.degrade_below`) everything runs as usual;
+- below that, fewer pages are read per web search and the facts are extracted with a cheaper model;
+- once the budget is exhausted, no new web searches or scrapings are started, the scrapings in flight are cancelled
+  and the final answer is given based on whatever was read by then.
+
+The last part of the time budget (`BudgetLimits.answer_reserve_fraction`) is reserved for the final answer, so "the
+budget is exhausted" happens a bit before the deadline. The sources that were skipped because of the budget are
+listed after the final answer.
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Optional, TypeVar
+
+from pydantic import BaseModel, Field
+
+T = TypeVar("T")
+
+
+class BudgetLimits(BaseModel):
+    # None - no limit
+    deadline_sec: Optional[float] = Field(default=None, gt=0)
+    max_tokens: Optional[int] = Field(default=None, gt=0)
+    max_paid_requests: Optional[int] = Field(default=None, gt=0)
+    # This fraction of the time budget is left for the final answer (no new pages are read by then)
+    answer_reserve_fraction: float = 0.25
+    # The pipeline starts saving once less than this fraction of the budget (of any kind) is left
+    degrade_below: float = 0.5
+
+
+class BudgetExhaustedError(Exception):
+    pass
+
+
+class RunBudget:
+    """
+    The budget of a single research run. Not thread-safe (it is meant to be used from the event loop, where it has
+    to be created).
+    """
+
+    def __init__(self, limits: BudgetLimits) -> None:
+        self.limits = limits
+        self.tokens = 0
+        self.paid_requests = 0
+        # source (a url or a web search) -> why it was skipped
+        self.skipped_sources: dict[str, str] = {}
+
+        self._started_at = time.monotonic()
+        self._exhausted = asyncio.Event()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        if limits.deadline_sec is not None:
+            self._timer = asyncio.get_running_loop().call_later(self._work_time_sec(), self._exhausted.set)
+
+    @property
+    def exhausted(self) -> bool:
+        return self._exhausted.is_set()
+
+    @property
+    def degraded(self) -> bool:
+        return self.remaining_fraction() < self.limits.degrade_below
+
+    def remaining_fraction(self) -> float:
+        """
+        The fraction of the budget that is left (of the kind of budget that is the closest to running out, 1.0 if the
+        run is not limited at all).
+        """
+        fractions = [1.0]
+        if self.limits.deadline_sec is not None:
+            fractions.append(1 - (time.monotonic() - self._started_at) / self._work_time_sec())
+        if self.limits.max_tokens is not None:
+            fractions.append(1 - self.tokens / self.limits.max_tokens)
+        if self.limits.max_paid_requests is not None:
+            fractions.append(1 - self.paid_requests / self.limits.max_paid_requests)
+        return max(0.0, min(fractions))
+
+    def record_tokens(self, tokens: int) -> None:
+        self.tokens += tokens
+        self._check()
+
+    def record_paid_request(self) -> None:
+        self.paid_requests += 1
+        self._check()
+
+    def skip(self, source: str, reason: str) -> None:
+        self.skipped_sources.setdefault(source, reason)
+
+    def pages_per_search(self, max_pages: int) -> int:
+        """
+        How many pages to read per web search (fewer as the budget runs down, at least one).
+        """
+        return max(1, max_pages // 2) if self.degraded else max_pages
+
+    def model_for_extraction(self, model: str, cheaper_model: str) -> str:
+        return cheaper_model if self.degraded else model
+
+    async def arun(self, awaitable: Awaitable[T]) -> T:
+        """
+        Await `awaitable` unless the budget runs out first - then it is cancelled and `BudgetExhaustedError` is raised
+        (right away if the budget is already exhausted).
+        """
+        if self.exhausted:
+            if asyncio.iscoroutine(awaitable):
+                # Not to leave a coroutine that was never awaited behind
+                awaitable.close()
+            raise BudgetExhaustedError("The budget of the run is exhausted")
+
+        task = asyncio.ensure_future(awaitable)
+        exhausted_waiter = asyncio.ensure_future(self._exhausted.wait())
+        try:
+            await asyncio.wait((task, exhausted_waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            exhausted_waiter.cancel()
+            if not task.done():
+                task.cancel()
+        if not task.done():
+            raise BudgetExhaustedError("The budget of the run ran out")
+        return task.result()
+
+    def format_skipped_sources(self) -> str:
+        return "\n".join(f"- {source} ({reason})" for source, reason in self.skipped_sources.items())
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limits": self.limits.model_dump(exclude_none=True),
+            "elapsed_sec": time.monotonic() - self._started_at,
+            "tokens": self.tokens,
+            "paid_requests": self.paid_requests,
+            "exhausted": self.exhausted,
+            "skipped_sources": len(self.skipped_sources),
+        }
+
+    def _work_time_sec(self) -> float:
+        return self.limits.deadline_sec * (1 - self.limits.answer_reserve_fraction)
+
+    def _check(self) -> None:
+        if self.remaining_fraction() <= 0:
+            self._exhausted.set()
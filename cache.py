@@ -0,0 +1,216 @@
+"""
+A persistent, content-addressed cache for search results and scraped pages.
+
+Entries are stored zlib-compressed in a single SQLite database and are addressed by a hash of the cache "source" (what
+kind of thing is cached, e.g. "serp" or "page") and the normalized key (a search query or a url). Every source has its
+own time-to-live, and the least recently used entries are evicted once the database grows beyond the configured size.
+
+A single connection guarded by a lock is shared by the event loop (via the `a`-prefixed methods, which do the actual
+work in a worker thread) and the scraping threads (via the regular methods).
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Callable, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+
+def connect_to_sqlite(path: str) -> sqlite3.Connection:
+    """
+    A connection to the SQLite database at `path` (created if needed) that can be shared by threads (under a lock) and
+    by several processes.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # `isolation_level=None` means autocommit - every statement is a transaction of its own
+    connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    # WAL lets several processes (e.g. several instances of the app) use the same database file safely
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if (parts.scheme == "http" and netloc.endswith(":80")) or (parts.scheme == "https" and netloc.endswith(":443")):
+        netloc = netloc.rsplit(":", 1)[0]
+    # The fragment is never sent to the server, so it doesn't affect the content of the page
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path or "/", parts.query, ""))
+
+
+class ContentCache:
+    """
+    `ttls` maps cache sources to their time-to-live in seconds (sources that are not mentioned there are cached with
+    `default_ttl`). `max_bytes` is the maximum total size of the compressed values.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttls: Optional[dict[str, float]] = None,
+        default_ttl: float = 24 * 60 * 60,
+        max_bytes: int = 512 * 1024 * 1024,
+        enabled: bool = True,
+    ) -> None:
+        self.path = path
+        self.ttls = dict(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._total_bytes: Optional[int] = None
+        self._hits: dict[str, int] = {}
+        self._misses: dict[str, int] = {}
+
+    def get(self, source: str, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+
+        cache_key = self._cache_key(source, key)
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute(
+                "SELECT value, size, created_at FROM entries WHERE key = ?",
+                (cache_key,),
+            ).fetchone()
+            if row and now - row[2] > self.ttls.get(source, self.default_ttl):
+                connection.execute("DELETE FROM entries WHERE key = ?", (cache_key,))
+                self._total_bytes -= row[1]
+                row = None
+            if row is None:
+                self._misses[source] = self._misses.get(source, 0) + 1
+                return None
+
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, cache_key))
+            self._hits[source] = self._hits.get(source, 0) + 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def set(self, source: str, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+
+        cache_key = self._cache_key(source, key)
+        compressed = zlib.compress(value.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute("SELECT size FROM entries WHERE key = ?", (cache_key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, source, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (cache_key, source, compressed, len(compressed), now, now),
+            )
+            self._total_bytes += len(compressed) - (row[0] if row else 0)
+            self._evict_if_needed(connection)
+
+    def update(self, source: str, key: str, update: Callable[[Optional[str]], str]) -> None:
+        """
+        Replace the value with `update(current_value)` (`current_value` is None if there is no fresh one) in a single
+        transaction, so concurrent updates of the same entry (by other threads or processes) don't overwrite each
+        other.
+        """
+        if not self.enabled:
+            return
+
+        cache_key = self._cache_key(source, key)
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            # IMMEDIATE - take the write lock of the database right away, before the current value is read
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = connection.execute(
+                    "SELECT value, size, created_at FROM entries WHERE key = ?",
+                    (cache_key,),
+                ).fetchone()
+                current_value = None
+                if row and now - row[2] <= self.ttls.get(source, self.default_ttl):
+                    current_value = zlib.decompress(row[0]).decode("utf-8")
+                compressed = zlib.compress(update(current_value).encode("utf-8"))
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries (key, source, value, size, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, source, compressed, len(compressed), now, now),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            self._total_bytes += len(compressed) - (row[1] if row else 0)
+            self._evict_if_needed(connection)
+
+    async def aget(self, source: str, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.get, source, key)
+
+    async def aset(self, source: str, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        await asyncio.to_thread(self.set, source, key, value)
+
+    async def aupdate(self, source: str, key: str, update: Callable[[Optional[str]], str]) -> None:
+        if not self.enabled:
+            return
+        await asyncio.to_thread(self.update, source, key, update)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "hits": dict(self._hits),
+                "misses": dict(self._misses),
+                "total_bytes": self._total_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+                self._total_bytes = None
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # NOTE: Should only be called while holding `self._lock`
+        if self._connection is None:
+            connection = connect_to_sqlite(self.path)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, source TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            self._total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            self._connection = connection
+        return self._connection
+
+    def _evict_if_needed(self, connection: sqlite3.Connection) -> None:
+        # NOTE: Should only be called while holding `self._lock`
+        while self._total_bytes > self.max_bytes:
+            rows = connection.execute(
+                "SELECT key, size FROM entries ORDER BY accessed_at LIMIT 100",
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                return
+            for key, size in rows:
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    return
+
+    @staticmethod
+    def _cache_key(source: str, key: str) -> str:
+        return hashlib.sha256(f"{source}\0{key}".encode("utf-8")).hexdigest()
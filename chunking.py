@@ -0,0 +1,72 @@
+"""
+Splitting of page markdown into chunks that fit a token budget.
+
+Tokens are counted with `tiktoken` when it is installed (`pip install tiktoken`) and estimated from the number of
+characters otherwise.
+"""
+
+import re
+from functools import cache
+from typing import Callable
+
+from content_extraction import split_markdown
+
+# A rough, but commonly used estimate for English text (used when `tiktoken` is not installed)
+CHARS_PER_TOKEN = 4
+
+_HEADING_RE = re.compile(r"^(?=#{1,6} )", re.MULTILINE)
+
+
+@cache
+def _get_token_counter(model: str) -> Callable[[str], int]:
+    try:
+        import tiktoken  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return lambda text: (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        # The model is too new for the installed version of `tiktoken`
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, model: str) -> int:
+    return _get_token_counter(model)(text)
+
+
+def split_into_token_chunks(markdown: str, max_tokens: int, model: str) -> list[str]:
+    """
+    Split markdown into chunks of at most (approximately, when `tiktoken` is not installed) `max_tokens` tokens each.
+    The text is split at headings first, then at paragraphs and lines, and the resulting pieces are merged back
+    together as long as they fit the budget (so that related content stays in the same chunk).
+    """
+    if count_tokens(markdown, model) <= max_tokens:
+        return [markdown]
+
+    pieces: list[tuple[str, int]] = []
+    for section in _HEADING_RE.split(markdown):
+        section = section.strip()
+        if not section:
+            continue
+        section_tokens = count_tokens(section, model)
+        if section_tokens <= max_tokens:
+            pieces.append((section, section_tokens))
+            continue
+        # Translate the token budget into a character budget using the density of this particular section (with a
+        # safety margin)
+        max_chars = max(1, int(len(section) * max_tokens / section_tokens * 0.9))
+        pieces.extend((piece, count_tokens(piece, model)) for piece in split_markdown(section, max_chars))
+
+    chunks: list[str] = []
+    current, current_tokens = "", 0
+    for piece, piece_tokens in pieces:
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current = f"{current}\n\n{piece}" if current else piece
+        current_tokens += piece_tokens
+    if current:
+        chunks.append(current)
+    return chunks
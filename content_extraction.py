@@ -0,0 +1,162 @@
+"""
+Conversion of scraped HTML into compact markdown that is suitable for LLM prompts.
+
+Besides the conversion itself, this module strips the parts of the page that never contain anything useful for the
+LLM (scripts, styles, navigation, cookie banners etc.), collapses the whitespace and caps the size of the output.
+
+The functions of this module are CPU-bound and only depend on the arguments that are passed to them, so they are meant
+to be run in a `ProcessPoolExecutor` (see `scrape_web_page` in `utils.py`) to keep the event loop responsive.
+"""
+
+import io
+import re
+
+from bs4 import BeautifulSoup, Comment, Tag
+from markdownify import MarkdownConverter
+
+# Tags that never contain the main content of a page
+BOILERPLATE_TAGS = (
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "svg",
+    "canvas",
+    "iframe",
+    "object",
+    "embed",
+    "nav",
+    "aside",
+    "button",
+    "select",
+    "dialog",
+)
+# Tags that are boilerplate unless they are part of the main content (e.g. the header of an article)
+PAGE_LEVEL_BOILERPLATE_TAGS = ("header", "footer")
+# Tags that are usually boilerplate (search boxes, login and subscription forms), but sometimes wrap the whole page
+# (e.g. `<form id="aspnetForm">` of ASP.NET WebForms) - they are treated like the elements that look like boilerplate
+# by their class or id (see below)
+LIKELY_BOILERPLATE_TAGS = ("form",)
+BOILERPLATE_ROLES = ("navigation", "banner", "contentinfo", "complementary", "search", "dialog", "alert")
+# Matched against every class and the id of an element as a whole (e.g. "cookie-banner" or "share-buttons", but not
+# "has-sidebar" or "sponsored-post", which are often the wrappers of the content itself)
+BOILERPLATE_CLASS_OR_ID_RE = re.compile(
+    r"(?:cookies?|consent|gdpr|ads?|advert\w*|sponsors?|newsletter|subscribe|sidebar|breadcrumbs?|share|sharing|social"
+    r"|popup|modal)(?:[-_](?:banner|bar|box|notice|container|wrapper|widget|links?|buttons?|icons?|signup|form|overlay"
+    r"|dialog|popup|slot|unit))*",
+    re.IGNORECASE,
+)
+# An element that looks like boilerplate by its class, id or role is kept anyway if it holds more than this fraction
+# of the text of the page (it is the content after all)
+MAX_BOILERPLATE_TEXT_FRACTION = 0.5
+# <main> or <article> is only trusted to be THE content if it holds at least this fraction of the text of the page
+MIN_MAIN_CONTENT_TEXT_FRACTION = 0.3
+
+
+def strip_boilerplate(soup: BeautifulSoup) -> None:
+    for comment in soup.find_all(string=lambda text: isinstance(text, Comment)):
+        comment.extract()
+    for tag in soup.find_all(BOILERPLATE_TAGS):
+        tag.decompose()
+    for tag in soup.find_all(PAGE_LEVEL_BOILERPLATE_TAGS):
+        if not tag.decomposed and not tag.find_parent(("main", "article")):
+            tag.decompose()
+
+    # The rest is guesswork based on the names and the attributes of the elements, so the main content and the elements
+    # that contain it are never removed, whatever they are called
+    protected_tags = {id(soup)}
+    for content_tag in [*soup.find_all(("main", "article")), *soup.find_all(attrs={"role": "main"})]:
+        protected_tags.add(id(content_tag))
+        protected_tags.update(id(parent) for parent in content_tag.parents)
+    page_text_length = len((soup.body or soup).get_text(strip=True))
+
+    def _looks_like_boilerplate(tag: Tag) -> bool:
+        if tag.name in LIKELY_BOILERPLATE_TAGS:
+            return True
+        if tag.attrs.get("role") in BOILERPLATE_ROLES or tag.attrs.get("aria-hidden") == "true":
+            return True
+        return any(
+            BOILERPLATE_CLASS_OR_ID_RE.fullmatch(name)
+            for name in [*tag.get("class", ()), *(tag.get("id") or "").split()]
+        )
+
+    for tag in soup.find_all(True):
+        if tag.decomposed or tag.attrs is None or tag.name in ("html", "body") or id(tag) in protected_tags:
+            continue
+        if not _looks_like_boilerplate(tag):
+            continue
+        if page_text_length and len(tag.get_text(strip=True)) > page_text_length * MAX_BOILERPLATE_TEXT_FRACTION:
+            continue
+        tag.decompose()
+
+
+def split_markdown(markdown: str, max_chunk_chars: int, separators: tuple[str, ...] = ("\n\n", "\n")) -> list[str]:
+    """
+    Split markdown into chunks of at most `max_chunk_chars` characters, preferably at paragraph boundaries (a single
+    paragraph that is longer than `max_chunk_chars` is split at line boundaries or, as a last resort, anywhere).
+    """
+    if len(markdown) <= max_chunk_chars:
+        return [markdown]
+    if not separators:
+        return [markdown[i : i + max_chunk_chars] for i in range(0, len(markdown), max_chunk_chars)]
+
+    separator = separators[0]
+    chunks: list[str] = []
+    current = ""
+    for part in markdown.split(separator):
+        for piece in split_markdown(part, max_chunk_chars, separators[1:]):
+            if current and len(current) + len(separator) + len(piece) > max_chunk_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}{separator}{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def html_to_markdown(html: str, max_chars: int = 100_000, max_html_chars: int = 5_000_000) -> str:
+    """
+    Convert an HTML page into markdown without the boilerplate. The result is truncated (at a paragraph boundary) to
+    `max_chars` characters. HTML that is larger than `max_html_chars` is truncated before it is even parsed.
+    """
+    soup = BeautifulSoup(html[:max_html_chars], "html.parser")
+    strip_boilerplate(soup)
+
+    root = soup.body or soup
+    root_text_length = len(root.get_text(strip=True))
+    for candidate in (soup.find("main"), soup.find("article")):
+        if candidate and len(candidate.get_text(strip=True)) >= root_text_length * MIN_MAIN_CONTENT_TEXT_FRACTION:
+            root = candidate
+            break
+
+    markdown = MarkdownConverter(heading_style="ATX", strip=["img"]).convert_soup(root)
+    # Collapse the whitespace that is left behind by the removed elements
+    markdown = re.sub(r"[ \t]+\n", "\n", markdown)
+    markdown = re.sub(r"\n{3,}", "\n\n", markdown).strip()
+
+    if len(markdown) > max_chars:
+        markdown = split_markdown(markdown, max_chars)[0]
+    return markdown
+
+
+def pdf_to_markdown(data: bytes, max_chars: int = 100_000) -> str:
+    """
+    Extract the text of a PDF document (requires the optional `pypdf` package). The result is truncated (at a
+    paragraph boundary) to `max_chars` characters.
+    """
+    # pylint: disable=import-outside-toplevel
+    from pypdf import PdfReader
+
+    pages = []
+    total_chars = 0
+    for page in PdfReader(io.BytesIO(data)).pages:
+        text = re.sub(r"\n{3,}", "\n\n", page.extract_text() or "").strip()
+        pages.append(text)
+        total_chars += len(text)
+        if total_chars > max_chars:
+            break
+
+    markdown = "\n\n".join(page for page in pages if page)
+    if len(markdown) > max_chars:
+        markdown = split_markdown(markdown, max_chars)[0]
+    return markdown
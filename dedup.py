@@ -0,0 +1,179 @@
+"""
+Deduplication of the web pages within a research run.
+
+- Before a page is scheduled for scraping, its url is canonicalized: the scheme (http vs https), "www.", mobile and AMP
+  variants, trailing slashes, tracking parameters (utm_* and the like), the order of the query parameters and the
+  fragment don't make two urls different pages.
+- After a page is scraped, its content is fingerprinted with SimHash. A page that is nearly identical to a page that
+  was already scraped in the same run (e.g. a syndicated copy of the same article) is not sent to the LLM for fact
+  extraction.
+
+`DedupRegistry` keeps the state of a single run and counts how many scrapings and LLM tokens were saved.
+"""
+
+import hashlib
+import re
+from typing import Any, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+TRACKING_PARAMS = frozenset(
+    ("gclid", "dclid", "fbclid", "msclkid", "yclid", "igshid", "mc_cid", "mc_eid", "_ga", "_gl")
+)
+TRACKING_PARAM_PREFIXES = ("utm_",)
+MOBILE_HOST_PREFIXES = ("www.", "m.", "mobile.", "amp.")
+AMP_CACHE_HOST_SUFFIX = ".cdn.ampproject.org"
+
+SIMHASH_BITS = 64
+SIMHASH_SHINGLE_WORDS = 3
+# Pages whose fingerprints differ in at most this many bits are considered near-duplicates
+NEAR_DUPLICATE_MAX_DISTANCE = 3
+# Fingerprints of shorter pages are not reliable enough (such pages are only deduplicated if they are identical)
+MIN_CHARS_FOR_NEAR_DUPLICATES = 1000
+
+
+def canonicalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").lower()
+    path = parts.path
+
+    if host.endswith(AMP_CACHE_HOST_SUFFIX):
+        # Google AMP cache: https://example-com.cdn.ampproject.org/c/s/example.com/article -> example.com/article
+        match = re.match(r"^/[a-z]/(?:s/)?([^/]+)(/.*)?$", path)
+        if match:
+            host, path = match.group(1).lower(), match.group(2) or ""
+
+    for prefix in MOBILE_HOST_PREFIXES:
+        if host.startswith(prefix) and "." in host[len(prefix) :]:
+            host = host[len(prefix) :]
+            break
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host if port in (None, 80, 443) else f"{host}:{port}"
+
+    path = _strip_amp_from_path(path).rstrip("/") or "/"
+    # ?amp=1 and the like only mark the AMP version of an article (on the home page they may well mean something else)
+    is_article = path != "/"
+    query = urlencode(
+        sorted(
+            (name, value)
+            for name, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not _is_noise_param(name.lower(), value.lower(), is_article)
+        )
+    )
+    # http and https versions of a page are the same page
+    return urlunsplit(("https", netloc, path, query, ""))
+
+
+def _strip_amp_from_path(path: str) -> str:
+    """
+    Turn the path of the AMP version of an article (/article/amp, /amp/article, /article.amp.html) into the path of
+    the article itself. "amp" that is the whole path (e.g. https://site.com/amp) is left alone - there is no article
+    for it to be the AMP version of.
+    """
+    for pattern, replacement in ((r"^(/.*[^/])/amp/?$", r"\1"), (r"^/amp(/.*[^/].*)$", r"\1")):
+        path, replaced = re.subn(pattern, replacement, path)
+        if replaced:
+            return path
+    return re.sub(r"([^/])\.amp\.html$", r"\1.html", path)
+
+
+def _is_noise_param(name: str, value: str, is_article: bool) -> bool:
+    if name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES):
+        return True
+    # ?amp, ?amp=1, ?outputType=amp
+    return is_article and (name == "amp" or (name == "outputtype" and value == "amp"))
+
+
+def _words(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def simhash(text: str) -> int:
+    """
+    SimHash of the word shingles of the text (similar texts get fingerprints that differ in few bits).
+    """
+    words = _words(text)
+    shingles = {
+        " ".join(words[word_idx : word_idx + SIMHASH_SHINGLE_WORDS])
+        for word_idx in range(max(len(words) - SIMHASH_SHINGLE_WORDS + 1, 1))
+    }
+    hashes = [
+        format(
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=SIMHASH_BITS // 8).digest(), "big"),
+            f"0{SIMHASH_BITS}b",
+        )
+        for shingle in shingles
+    ]
+    fingerprint = 0
+    # Every bit of the fingerprint is the majority vote of the same bit of the hashes of the shingles
+    for bits in zip(*hashes):
+        fingerprint = (fingerprint << 1) | (bits.count("1") * 2 > len(hashes))
+    return fingerprint
+
+
+def hamming_distance(fingerprint1: int, fingerprint2: int) -> int:
+    return bin(fingerprint1 ^ fingerprint2).count("1")
+
+
+class DedupRegistry:
+    """
+    The pages of a single research run. Not thread-safe (it is meant to be used from the event loop).
+    """
+
+    def __init__(self) -> None:
+        self._canonical_urls: set[str] = set()
+        # (url, fingerprint, length of the content)
+        self._fingerprints: list[tuple[str, int, int]] = []
+
+        self._duplicate_urls = 0
+        self._near_duplicate_pages = 0
+        self._saved_tokens = 0
+
+    def claim_url(self, url: str) -> bool:
+        """
+        Whether the page should be scraped (False if the same page was already claimed under any of its urls).
+        """
+        canonical_url = canonicalize_url(url)
+        if canonical_url in self._canonical_urls:
+            self._duplicate_urls += 1
+            return False
+        self._canonical_urls.add(canonical_url)
+        return True
+
+    def is_claimed(self, url: str) -> bool:
+        """
+        Whether the page was already claimed under any of its urls (without claiming it).
+        """
+        return canonicalize_url(url) in self._canonical_urls
+
+    def find_near_duplicate(self, url: str, page_content: str, fingerprint: int) -> Optional[str]:
+        """
+        The url of an earlier page of the run that has (nearly) the same content as this one, None if there is no such
+        page (in which case this page is remembered for the subsequent checks).
+        """
+        for other_url, other_fingerprint, other_length in self._fingerprints:
+            max_distance = (
+                NEAR_DUPLICATE_MAX_DISTANCE
+                if min(len(page_content), other_length) >= MIN_CHARS_FOR_NEAR_DUPLICATES
+                else 0
+            )
+            if hamming_distance(fingerprint, other_fingerprint) <= max_distance:
+                self._near_duplicate_pages += 1
+                return other_url
+        self._fingerprints.append((url, fingerprint, len(page_content)))
+        return None
+
+    def record_saved_tokens(self, tokens: int) -> None:
+        self._saved_tokens += tokens
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "pages": len(self._fingerprints),
+            # Every duplicate url is a scraping that didn't happen
+            "saved_scrapes": self._duplicate_urls,
+            # Every near-duplicate page is an LLM extraction that didn't happen
+            "saved_extractions": self._near_duplicate_pages,
+            "saved_tokens": self._saved_tokens,
+        }
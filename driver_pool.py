@@ -0,0 +1,222 @@
+"""
+A pool of warm, reusable remote browser sessions.
+
+Opening a new `selenium.webdriver.Remote` session means a full WebDriver handshake with the remote browser, which can
+easily take longer than loading the page itself. `BrowserSessionPool` keeps up to N such sessions alive and leases them
+out to the threads that do the scraping. Sessions are recycled after a configurable number of pages or right after
+they fail, and idle sessions are health-checked before they are handed out again.
+
+Selenium is not asyncio-friendly, so everything in this module is synchronous and thread-safe - the leasing is meant to
+happen inside the threads of a `ThreadPoolExecutor` (see `scrape_web_page` in `utils.py`).
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional
+
+from selenium.webdriver.remote.webdriver import WebDriver
+
+
+class _PooledSession:
+    def __init__(self, driver: WebDriver) -> None:
+        self.driver = driver
+        self.pages_served = 0
+        self.last_used_at = time.monotonic()
+
+
+class BrowserSessionPool:
+    """
+    A thread-safe pool of remote browser sessions.
+
+    `driver_factory` is any callable that returns a ready-to-use `WebDriver` - in production it connects to the
+    Bright Data Scraping Browser, in tests it may connect to a local Selenium server (or return a fake driver
+    altogether).
+    """
+
+    def __init__(
+        self,
+        driver_factory: Callable[[], WebDriver],
+        size: int = 4,
+        max_pages_per_session: int = 20,
+        lease_timeout: Optional[float] = None,
+        health_check_after_idle_sec: float = 30,
+    ) -> None:
+        if size < 1:
+            raise ValueError("The size of a BrowserSessionPool must be at least 1")
+
+        self.driver_factory = driver_factory
+        self.size = size
+        self.max_pages_per_session = max_pages_per_session
+        self.lease_timeout = lease_timeout
+        self.health_check_after_idle_sec = health_check_after_idle_sec
+
+        self._condition = threading.Condition()
+        self._idle: list[_PooledSession] = []
+        # The number of sessions that currently exist (idle, leased or being created)
+        self._total = 0
+        self._closed = False
+
+        self._leases = 0
+        self._reused_leases = 0
+        self._sessions_created = 0
+        self._sessions_recycled = 0
+        self._failed_health_checks = 0
+        self._total_lease_wait_sec = 0.0
+        self._max_lease_wait_sec = 0.0
+
+    @contextmanager
+    def lease(self) -> Iterator[WebDriver]:
+        """
+        Lease a session for the duration of the `with` block. If the block raises, the session is considered broken
+        and is recycled (a fresh one will be created on demand).
+        """
+        session = self._acquire()
+        try:
+            yield session.driver
+        except BaseException:
+            self._release(session, broken=True)
+            raise
+        self._release(session, broken=False)
+
+    def warm_up(self, num_sessions: Optional[int] = None) -> None:
+        """
+        Make sure that (up to) `num_sessions` sessions exist in the pool, so the first scrapes don't pay for the
+        WebDriver handshake. Failures are ignored - the sessions will be created on demand later.
+        """
+        num_sessions = self.size if num_sessions is None else min(num_sessions, self.size)
+        while True:
+            with self._condition:
+                if self._closed or self._total >= num_sessions:
+                    return
+                self._total += 1
+            try:
+                session = self._create_session()
+            except Exception:  # pylint: disable=broad-exception-caught
+                with self._condition:
+                    self._total -= 1
+                    self._condition.notify()
+                return
+            with self._condition:
+                self._idle.append(session)
+                self._condition.notify()
+
+    def close(self) -> None:
+        """
+        Quit all the idle sessions and refuse any further leases. Sessions that are leased at the moment of closing
+        are quit as soon as they are returned to the pool.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._total -= len(idle)
+            self._condition.notify_all()
+        for session in idle:
+            self._quit(session)
+
+    def stats(self) -> dict[str, Any]:
+        with self._condition:
+            return {
+                "size": self.size,
+                "sessions_alive": self._total,
+                "sessions_idle": len(self._idle),
+                "sessions_created": self._sessions_created,
+                "sessions_recycled": self._sessions_recycled,
+                "failed_health_checks": self._failed_health_checks,
+                "leases": self._leases,
+                "reused_leases": self._reused_leases,
+                "avg_lease_wait_sec": self._total_lease_wait_sec / self._leases if self._leases else 0.0,
+                "max_lease_wait_sec": self._max_lease_wait_sec,
+            }
+
+    def _acquire(self) -> _PooledSession:
+        started_at = time.monotonic()
+        deadline = None if self.lease_timeout is None else started_at + self.lease_timeout
+
+        while True:
+            session = None
+            with self._condition:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("BrowserSessionPool is closed")
+                    if self._idle:
+                        session = self._idle.pop()
+                        break
+                    if self._total < self.size:
+                        # There is room for one more session - we will create it outside the lock
+                        self._total += 1
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"Could not lease a browser session within {self.lease_timeout} seconds")
+                    self._condition.wait(remaining)
+
+            if session is None:
+                try:
+                    session = self._create_session()
+                except BaseException:
+                    with self._condition:
+                        self._total -= 1
+                        self._condition.notify()
+                    raise
+            elif not self._is_healthy(session):
+                self._discard(session)
+                continue
+
+            self._record_lease(session, time.monotonic() - started_at)
+            return session
+
+    def _release(self, session: _PooledSession, broken: bool) -> None:
+        session.last_used_at = time.monotonic()
+        if not broken:
+            session.pages_served += 1
+
+        with self._condition:
+            retire = broken or self._closed or session.pages_served >= self.max_pages_per_session
+            if not retire:
+                self._idle.append(session)
+                self._condition.notify()
+                return
+
+        self._discard(session)
+
+    def _discard(self, session: _PooledSession) -> None:
+        with self._condition:
+            self._total -= 1
+            self._sessions_recycled += 1
+            self._condition.notify()
+        self._quit(session)
+
+    def _is_healthy(self, session: _PooledSession) -> bool:
+        if time.monotonic() - session.last_used_at < self.health_check_after_idle_sec:
+            # The session was in use very recently, no need to ping it
+            return True
+        try:
+            session.driver.execute_script("return 1")
+            return True
+        except Exception:  # pylint: disable=broad-exception-caught
+            with self._condition:
+                self._failed_health_checks += 1
+            return False
+
+    def _create_session(self) -> _PooledSession:
+        session = _PooledSession(self.driver_factory())
+        with self._condition:
+            self._sessions_created += 1
+        return session
+
+    def _record_lease(self, session: _PooledSession, wait_sec: float) -> None:
+        with self._condition:
+            self._leases += 1
+            if session.pages_served:
+                self._reused_leases += 1
+            self._total_lease_wait_sec += wait_sec
+            self._max_lease_wait_sec = max(self._max_lease_wait_sec, wait_sec)
+
+    @staticmethod
+    def _quit(session: _PooledSession) -> None:
+        try:
+            session.driver.quit()
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The session is probably dead already - nothing else to do about it
+            pass
@@ -0,0 +1,102 @@
+"""
+Memoization of the facts that were extracted from web pages by the LLM.
+
+Extracting facts from a whole web page is the most expensive LLM call of the app, and the same page often comes up
+again - for the same or for a related question. `ExtractionCache` remembers the extractions (on top of `ContentCache`)
+keyed by the hash of the page content, the url of the page and the model, and serves them back according to one of
+the reuse policies:
+
+- "exact" - reuse an extraction only if it was made for exactly the same rationale;
+- "same_page" - if there is no exact match, reuse an extraction of the same page that was made for a similar enough
+  user question (regardless of the rationale).
+"""
+
+import hashlib
+import json
+import re
+from typing import Optional
+
+from cache import ContentCache, normalize_query, normalize_url
+
+REUSE_POLICIES = ("exact", "same_page")
+
+
+def _words(text: str) -> set[str]:
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def question_similarity(question1: str, question2: str) -> float:
+    """
+    Jaccard similarity of the sets of words of the two questions (a number between 0 and 1).
+    """
+    words1, words2 = _words(question1), _words(question2)
+    if not words1 or not words2:
+        return 0.0
+    return len(words1 & words2) / len(words1 | words2)
+
+
+class ExtractionCache:
+    def __init__(
+        self,
+        content_cache: ContentCache,
+        reuse_policy: str = "exact",
+        min_question_similarity: float = 0.6,
+        max_extractions_per_page: int = 10,
+    ) -> None:
+        if reuse_policy not in REUSE_POLICIES:
+            raise ValueError(f"Unknown reuse policy {reuse_policy!r}, expected one of {REUSE_POLICIES}")
+
+        self.content_cache = content_cache
+        self.reuse_policy = reuse_policy
+        self.min_question_similarity = min_question_similarity
+        self.max_extractions_per_page = max_extractions_per_page
+
+    async def aget(self, *, page_content: str, url: str, rationale: str, question: str, model: str) -> Optional[str]:
+        """
+        Return a previously extracted summary of the page or None if there is no suitable one.
+        """
+        extractions = await self._aload(page_content, url, model)
+
+        normalized_rationale = normalize_query(rationale)
+        for extraction in extractions:
+            if extraction["rationale"] == normalized_rationale:
+                return extraction["summary"]
+
+        if self.reuse_policy == "same_page":
+            best_similarity, best_summary = 0.0, None
+            for extraction in extractions:
+                similarity = question_similarity(question, extraction["question"])
+                if similarity > best_similarity:
+                    best_similarity, best_summary = similarity, extraction["summary"]
+            if best_similarity >= self.min_question_similarity:
+                return best_summary
+
+        return None
+
+    async def aset(
+        self, *, page_content: str, url: str, rationale: str, question: str, model: str, summary: str
+    ) -> None:
+        normalized_rationale = normalize_query(rationale)
+
+        def _add_extraction(cached: Optional[str]) -> str:
+            extractions = [
+                extraction
+                for extraction in (json.loads(cached) if cached else [])
+                if extraction["rationale"] != normalized_rationale
+            ]
+            extractions.append({"rationale": normalized_rationale, "question": question, "summary": summary})
+            # The most recent extractions are at the end of the list
+            return json.dumps(extractions[-self.max_extractions_per_page :])
+
+        # Other page scrapers might be adding their extractions of the same page at the same time - read, merge and
+        # write in a single transaction, so none of them is lost
+        await self.content_cache.aupdate("extraction", self._cache_key(page_content, url, model), _add_extraction)
+
+    async def _aload(self, page_content: str, url: str, model: str) -> list[dict[str, str]]:
+        cached = await self.content_cache.aget("extraction", self._cache_key(page_content, url, model))
+        return json.loads(cached) if cached else []
+
+    @staticmethod
+    def _cache_key(page_content: str, url: str, model: str) -> str:
+        content_hash = hashlib.sha256(page_content.encode("utf-8")).hexdigest()
+        return f"{content_hash}\0{normalize_url(url)}\0{model}"
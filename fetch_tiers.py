@@ -0,0 +1,140 @@
+"""
+Tiered fetching of web pages: a plain HTTP GET first, the remote browser (Bright Data Scraping Browser) only when it is
+needed.
+
+Most articles, docs and PDFs don't need a browser at all - a plain GET returns them in a fraction of the time and
+cost. A page is escalated to the browser if the plain GET doesn't look like the real page:
+
+- the response is an error (bot protection often responds with 403, 429 or 503), or it is empty;
+- the content type is not something we can read without a browser;
+- the page is a bot wall (a captcha, a "checking your browser" interstitial etc.);
+- there is too little text compared to the markup (an empty shell of an app that renders the content with
+  JavaScript).
+
+`PageTierMemory` remembers per domain how the plain GETs went, so the domains that keep failing them go straight to
+the browser (for a while).
+"""
+
+import time
+from typing import Any, Optional
+from urllib.parse import urlsplit
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+TEXT_CONTENT_TYPES = ("text/plain", "text/markdown")
+PDF_CONTENT_TYPE = "application/pdf"
+
+BOT_WALL_MARKERS = (
+    "cf-browser-verification",
+    "challenge-platform",
+    "/cdn-cgi/challenge",
+    "just a moment...",
+    "attention required! | cloudflare",
+    "px-captcha",
+    "captcha-delivery.com",
+    "g-recaptcha",
+    "h-captcha",
+    "are you a robot",
+    "are you human",
+    "unusual traffic from your computer",
+    "please enable cookies",
+    "access denied",
+)
+# A page with less text than this is not the real page (or not a page worth reading)
+MIN_PAGE_TEXT_CHARS = 300
+# A page with less text than this (but more than `MIN_PAGE_TEXT_CHARS`) is suspicious if the text is a tiny fraction
+# of the markup (the content is most likely rendered with JavaScript)
+ENOUGH_PAGE_TEXT_CHARS = 5_000
+MIN_TEXT_TO_MARKUP_RATIO = 0.02
+
+# A domain goes straight to the browser after this many plain GETs in a row failed...
+HTTP_FAILURES_BEFORE_BROWSER_ONLY = 2
+# ...until this much time passes since the last failure (the site might have changed)
+BROWSER_ONLY_TTL_SEC = 6 * 60 * 60
+MAX_REMEMBERED_DOMAINS = 10_000
+
+
+def reason_to_escalate_response(status_code: int, content_type: str, body_size: int) -> Optional[str]:
+    """
+    Why the response of a plain GET is not good enough (None if it is - so far, see `reason_to_escalate_content`).
+    """
+    if not 200 <= status_code < 300:
+        return f"status {status_code}"
+    if not body_size:
+        return "empty body"
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    if media_type and media_type not in (*HTML_CONTENT_TYPES, *TEXT_CONTENT_TYPES, PDF_CONTENT_TYPE):
+        return f"content type {media_type}"
+    return None
+
+
+def reason_to_escalate_content(markup: str, text: str) -> Optional[str]:
+    """
+    Why the page (its raw `markup` and the `text` extracted from it) doesn't look like the real page (None if it does).
+    """
+    if len(text) >= ENOUGH_PAGE_TEXT_CHARS:
+        return None
+    lowercase_markup = markup.lower()
+    for marker in BOT_WALL_MARKERS:
+        if marker in lowercase_markup:
+            return f"bot wall ({marker})"
+    if len(text) < MIN_PAGE_TEXT_CHARS:
+        return "too little text"
+    if len(text) / max(len(markup), 1) < MIN_TEXT_TO_MARKUP_RATIO:
+        return "too little text for the markup"
+    return None
+
+
+def domain_of(url: str) -> str:
+    host = (urlsplit(url).hostname or "").lower()
+    return host[len("www.") :] if host.startswith("www.") else host
+
+
+class PageTierMemory:
+    """
+    Which tier worked for which domain: "http" (a plain GET) or "browser". Not thread-safe (it is meant to be used
+    from the event loop).
+    """
+
+    def __init__(self) -> None:
+        # domain -> [plain GETs that failed in a row, time of the last failure]
+        self._http_failures: dict[str, list[Any]] = {}
+
+        self._fetched_over_http = 0
+        self._escalated = 0
+        self._browser_only = 0
+
+    def should_try_http(self, url: str) -> bool:
+        failures = self._http_failures.get(domain_of(url))
+        if (
+            failures is not None
+            and failures[0] >= HTTP_FAILURES_BEFORE_BROWSER_ONLY
+            and time.monotonic() - failures[1] < BROWSER_ONLY_TTL_SEC
+        ):
+            self._browser_only += 1
+            return False
+        return True
+
+    def record_http_success(self, url: str) -> None:
+        self._fetched_over_http += 1
+        self._http_failures.pop(domain_of(url), None)
+
+    def record_http_failure(self, url: str) -> None:
+        self._escalated += 1
+        domain = domain_of(url)
+        failures = self._http_failures.pop(domain, None) or [0, 0.0]
+        failures[0] += 1
+        failures[1] = time.monotonic()
+        # Re-inserted, so the domains are kept in the order of their last failure (the oldest ones are forgotten first)
+        self._http_failures[domain] = failures
+        if len(self._http_failures) > MAX_REMEMBERED_DOMAINS:
+            del self._http_failures[next(iter(self._http_failures))]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "fetched_over_http": self._fetched_over_http,
+            "escalated_to_browser": self._escalated,
+            "browser_only": self._browser_only,
+            "browser_only_domains": sum(
+                failures[0] >= HTTP_FAILURES_BEFORE_BROWSER_ONLY for failures in self._http_failures.values()
+            ),
+        }
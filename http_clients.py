@@ -0,0 +1,89 @@
+"""
+Long-lived `httpx.AsyncClient` instances shared by the whole application.
+
+Creating a new `httpx.AsyncClient` for every request means a new TCP connection and a new TLS handshake (to the proxy
+as well as to the target host) every time. `HttpClientManager` keeps one client per proxy/verification setting alive
+for the whole run, so the connections are kept alive and reused between requests, and it limits the number of
+concurrent requests per target host to the number of connections it keeps alive.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from importlib.util import find_spec
+from typing import AsyncIterator, Callable, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+class HttpClientManager:
+    """
+    Lazily creates (and caches) `httpx.AsyncClient` instances - one per unique combination of `proxy` and `verify` -
+    and hands out per-host concurrency slots (see `ahost_slot`). Call `aclose` at shutdown.
+
+    HTTP/2 is only enabled if it was requested and the optional `h2` package is installed. `transport_wrapper`, if
+    given, wraps the transports of the clients (e.g. to record or replay the traffic, see `replay.py`).
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60,
+        max_concurrency_per_host: Optional[int] = None,
+        http2: bool = False,
+        timeout: float = 20,
+        transport_wrapper: Optional[Callable[[httpx.AsyncBaseTransport], httpx.AsyncBaseTransport]] = None,
+    ) -> None:
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        # By default, don't let more requests to the same host run concurrently than there are connections that we
+        # keep alive (otherwise the "excess" requests would be paying for new handshakes anyway)
+        self.max_concurrency_per_host = max_concurrency_per_host or max_keepalive_connections
+        self.http2 = http2 and find_spec("h2") is not None
+        self.timeout = timeout
+        self.transport_wrapper = transport_wrapper
+
+        self._clients: dict[tuple[Optional[str], bool], httpx.AsyncClient] = {}
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def get_client(self, proxy: Optional[str] = None, verify: bool = True) -> httpx.AsyncClient:
+        key = (proxy, verify)
+        client = self._clients.get(key)
+        if client is None or client.is_closed:
+            if self.transport_wrapper is None:
+                client = httpx.AsyncClient(
+                    proxy=proxy,
+                    verify=verify,
+                    timeout=self.timeout,
+                    limits=self.limits,
+                    http2=self.http2,
+                )
+            else:
+                transport = httpx.AsyncHTTPTransport(proxy=proxy, verify=verify, limits=self.limits, http2=self.http2)
+                client = httpx.AsyncClient(transport=self.transport_wrapper(transport), timeout=self.timeout)
+            self._clients[key] = client
+        return client
+
+    def host_semaphore(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc.lower()
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrency_per_host)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    @asynccontextmanager
+    async def ahost_slot(self, url: str) -> AsyncIterator[None]:
+        """
+        Limit the number of concurrent requests to the host of the given url.
+        """
+        async with self.host_semaphore(url):
+            yield
+
+    async def aclose(self) -> None:
+        clients, self._clients = self._clients, {}
+        await asyncio.gather(*(client.aclose() for client in clients.values()), return_exceptions=True)
@@ -0,0 +1,262 @@
+"""
+A semantic cache of research plans (the web searches that the LLM decided to do for a user question).
+
+Planning is a blocking call to the smarter model on the critical path of every research - no web search can start
+before it is done - and users often ask paraphrased versions of the same questions. `PlanCache` remembers the plans
+together with an embedding of their questions in a local SQLite database, and looks up the most similar past question
+(cosine similarity, brute force over the plans that are still fresh):
+
+- the same question (up to case, punctuation and whitespace) reuses the stored plan as is, without calling the LLM;
+- a similar question (similarity >= `seed_similarity`) seeds the planning - the stored plan is shown to the LLM as a
+  starting point, and its web searches can be started speculatively while the new plan is being generated (see
+  `research_agent` in `web_research.py`).
+
+Similarity alone is never enough to reuse a plan: "who founded X" and "when was X founded", or "side effects of Y" and
+"side effects of Y in children", are very similar questions that need different web searches.
+
+The embeddings are computed locally with the hashing trick (no external service and no model to download): the
+content words of the question (lowercased, crudely stemmed, without stop words) and their character n-grams are hashed
+into a sparse vector, so rephrasings that keep the key terms, reorder them or change their grammatical form still end
+up close to each other.
+"""
+
+import asyncio
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from pydantic import BaseModel
+
+from cache import connect_to_sqlite
+
+# Negations ("not", "no", "nor"), temporal words ("before", "after") and question words ("who", "when", "where", "why",
+# "how" etc.) are not stop words here - they change what the question is about
+STOP_WORDS = frozenset(
+    "a an the and or but if of to in on at by for with from about into over between than as is are was were be been "
+    "being do does did done have has had can could should would will shall may might must i you he she it we they me "
+    "him her us them my your his its our their this that these those what which there here some any all each every "
+    "more most much many very so such only also just then too please tell explain know want need way ways".split()
+)
+STEM_SUFFIXES = ("ations", "ation", "ments", "ment", "ings", "ing", "ies", "ied", "ers", "er", "es", "ed", "ly", "s")
+MIN_STEM_CHARS = 3
+# Character n-grams make the embeddings tolerant to the words that the stemming doesn't bring to the same form
+CHAR_NGRAM_SIZE = 4
+CHAR_NGRAM_WEIGHT = 0.3
+EMBEDDING_DIMENSIONS = 1 << 20
+
+
+def _stem(word: str) -> str:
+    for suffix in STEM_SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= MIN_STEM_CHARS:
+            return word[: -len(suffix)]
+    return word
+
+
+def _feature_index(feature: str) -> int:
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % EMBEDDING_DIMENSIONS
+
+
+def normalize_question(question: str) -> str:
+    """
+    The question without the differences that don't change it: case, punctuation and whitespace.
+    """
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+def embed_question(question: str) -> dict[int, float]:
+    """
+    A sparse, L2-normalized embedding of the question (feature index -> weight).
+    """
+    vector: dict[int, float] = {}
+    for word in re.findall(r"\w+", question.lower()):
+        if word in STOP_WORDS:
+            continue
+        stem = _stem(word)
+        index = _feature_index(f"w:{stem}")
+        vector[index] = vector.get(index, 0.0) + 1.0
+        padded = f"<{stem}>"
+        for char_idx in range(max(len(padded) - CHAR_NGRAM_SIZE + 1, 1)):
+            index = _feature_index(f"c:{padded[char_idx : char_idx + CHAR_NGRAM_SIZE]}")
+            vector[index] = vector.get(index, 0.0) + CHAR_NGRAM_WEIGHT
+
+    norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+    return {index: weight / norm for index, weight in vector.items()} if norm else {}
+
+
+def cosine_similarity(vector1: dict[int, float], vector2: dict[int, float]) -> float:
+    # The embeddings are normalized, so the dot product is the cosine similarity
+    if len(vector1) > len(vector2):
+        vector1, vector2 = vector2, vector1
+    return sum(weight * vector2.get(index, 0.0) for index, weight in vector1.items())
+
+
+class PlanMatch(BaseModel):
+    question: str
+    # The plan as it was stored (e.g. the JSON of `WebSearchesToBeDone`)
+    plan: str
+    similarity: float
+    age_sec: float
+    # Whether the plan can be reused as is - it was made for the same question (otherwise it can only seed the planning)
+    reusable: bool
+
+
+class PlanCache:
+    """
+    `ttl` is the freshness window of the plans in seconds (older plans are neither reused nor shown to the LLM, since
+    the web searches they contain might be outdated). Only the `max_plans` most recent plans are kept.
+
+    Like `ContentCache`, a single connection guarded by a lock is shared by everyone, the `a`-prefixed methods do the
+    actual work in a worker thread. The embeddings are also kept in memory (new plans that other processes add to the
+    same database are picked up on the next lookup).
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 7 * 24 * 60 * 60,
+        seed_similarity: float = 0.5,
+        max_plans: int = 10_000,
+        enabled: bool = True,
+    ) -> None:
+        if not 0 < seed_similarity <= 1:
+            raise ValueError(f"Expected 0 < seed_similarity <= 1, got {seed_similarity}")
+
+        self.path = path
+        self.ttl = ttl
+        self.seed_similarity = seed_similarity
+        self.max_plans = max_plans
+        self.enabled = enabled
+
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        # rowid -> (model, question, normalized question, embedding, created_at)
+        self._index: dict[int, tuple[str, str, str, dict[int, float], float]] = {}
+        self._last_loaded_rowid = 0
+        self._lookups: dict[str, int] = {"reused": 0, "seeded": 0, "missed": 0}
+
+    def lookup(self, question: str, model: str) -> Optional[PlanMatch]:
+        """
+        The plan of the same fresh question (the most recent one) or, if there is none, of the most similar one that
+        was planned with the same model (None if none of them is similar enough to at least seed the planning).
+        """
+        if not self.enabled:
+            return None
+
+        normalized_question = normalize_question(question)
+        embedding = embed_question(question)
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            self._load_new_plans(connection)
+
+            best_similarity, best_rowid, reusable = 0.0, None, False
+            # From the newest plan to the oldest one, so the most recent plan of the same question wins
+            for rowid, (plan_model, _, plan_normalized_question, plan_embedding, created_at) in reversed(
+                self._index.items()
+            ):
+                if plan_model != model or now - created_at > self.ttl:
+                    continue
+                if plan_normalized_question == normalized_question:
+                    best_similarity, best_rowid, reusable = 1.0, rowid, True
+                    break
+                similarity = cosine_similarity(embedding, plan_embedding)
+                if similarity > best_similarity:
+                    best_similarity, best_rowid = similarity, rowid
+
+            if best_rowid is None or best_similarity < self.seed_similarity:
+                self._lookups["missed"] += 1
+                return None
+            row = connection.execute("SELECT plan FROM plans WHERE rowid = ?", (best_rowid,)).fetchone()
+            if row is None:
+                # Evicted by another process
+                self._lookups["missed"] += 1
+                return None
+
+            self._lookups["reused" if reusable else "seeded"] += 1
+            _, plan_question, _, _, created_at = self._index[best_rowid]
+            return PlanMatch(
+                question=plan_question,
+                plan=row[0],
+                similarity=best_similarity,
+                age_sec=now - created_at,
+                reusable=reusable,
+            )
+
+    def set(self, question: str, model: str, plan: str) -> None:
+        if not self.enabled:
+            return
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT INTO plans (model, question, embedding, plan, created_at) VALUES (?, ?, ?, ?, ?)",
+                (model, question, json.dumps(list(embed_question(question).items())), plan, time.time()),
+            )
+            # Evict the oldest and the stale plans
+            connection.execute(
+                "DELETE FROM plans WHERE created_at < ? OR rowid <= "
+                "(SELECT rowid FROM plans ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                (time.time() - self.ttl, self.max_plans),
+            )
+            self._load_new_plans(connection)
+
+    async def alookup(self, question: str, model: str) -> Optional[PlanMatch]:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.lookup, question, model)
+
+    async def aset(self, question: str, model: str, plan: str) -> None:
+        if not self.enabled:
+            return
+        await asyncio.to_thread(self.set, question, model, plan)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {**self._lookups, "plans": len(self._index)}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+                self._index = {}
+                self._last_loaded_rowid = 0
+
+    def _load_new_plans(self, connection: sqlite3.Connection) -> None:
+        # NOTE: Should only be called while holding `self._lock`
+        for rowid, model, question, embedding, created_at in connection.execute(
+            "SELECT rowid, model, question, embedding, created_at FROM plans WHERE rowid > ? ORDER BY rowid",
+            (self._last_loaded_rowid,),
+        ):
+            self._index[rowid] = (
+                model,
+                question,
+                normalize_question(question),
+                dict(json.loads(embedding)),
+                created_at,
+            )
+            self._last_loaded_rowid = rowid
+        # Forget the stale plans and the oldest ones (the index is ordered from the oldest plan to the newest one)
+        stale_before = time.time() - self.ttl
+        for rowid in [rowid for rowid, plan in self._index.items() if plan[4] < stale_before]:
+            del self._index[rowid]
+        while len(self._index) > self.max_plans:
+            del self._index[next(iter(self._index))]
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # NOTE: Should only be called while holding `self._lock`
+        if self._connection is None:
+            connection = connect_to_sqlite(self.path)
+            # AUTOINCREMENT, so the rowids of the evicted plans are never reused (the in-memory index relies on it)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS plans (rowid INTEGER PRIMARY KEY AUTOINCREMENT, model TEXT NOT NULL, "
+                "question TEXT NOT NULL, embedding TEXT NOT NULL, plan TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._connection = connection
+        return self._connection
@@ -0,0 +1,359 @@
+"""
+Record/replay of the external calls of the pipeline (web searches, scraped pages and LLM calls).
+
+In "record" mode the real responses of the SERP API, the OpenAI API, the plain HTTP fetches of web pages and the
+scraping browser are saved as JSON fixtures (one file per request). In "replay" mode the same calls are served from
+those fixtures without touching the network, after a synthetic delay drawn from a configurable latency distribution -
+which makes it possible to benchmark the whole pipeline offline and reproducibly (see `benchmarks/bench_pipeline.py`).
+
+Requests are matched to the fixtures exactly (after normalization) first. LLM prompts are rarely identical between
+runs though (the current date is part of them, and the order in which concurrent results arrive differs from run to
+run), so if there is no exact match, the most similar recorded request of the same kind is replayed. Web pages fetched
+over plain HTTP are the exception: a page without a fixture gets a 404 (and is escalated to the browser, see
+`fetch_tiers.py`).
+"""
+
+import asyncio
+import base64
+import hashlib
+import importlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from types import ModuleType
+from typing import Any, AsyncIterator, Callable, Optional
+
+import httpx
+
+from cache import normalize_query, normalize_url
+from extraction_cache import question_similarity
+
+REPLAY_MODES = ("record", "replay")
+# Fixtures of these kinds are only replayed for exactly the same request (a similar url is a different page)
+EXACT_MATCH_KINDS = ("http_page",)
+# Only this much of a request is kept for similarity matching (prompts can contain whole web pages)
+MAX_MATCHING_TEXT_CHARS = 20_000
+
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+# Headers that describe the encoding of the original response body, which is stored decoded
+_ENCODING_HEADERS = ("content-encoding", "content-length", "transfer-encoding")
+
+
+class FixtureNotFoundError(LookupError):
+    pass
+
+
+class LatencyDistribution:
+    """
+    Log-normal distribution of latencies defined by its median and 95th percentile (in seconds).
+    """
+
+    def __init__(self, median_sec: float, p95_sec: Optional[float] = None) -> None:
+        p95_sec = median_sec if p95_sec is None else p95_sec
+        if median_sec < 0 or p95_sec < median_sec:
+            raise ValueError(f"Invalid latency distribution: median {median_sec}, p95 {p95_sec}")
+        self.median_sec = median_sec
+        self.p95_sec = p95_sec
+
+    @classmethod
+    def parse(cls, value: str) -> "LatencyDistribution":
+        """
+        Parse "MEDIAN" or "MEDIAN:P95" (e.g. "1.5:4").
+        """
+        median, _, p95 = value.partition(":")
+        return cls(float(median), float(p95) if p95 else None)
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median_sec == 0:
+            return 0.0
+        # 1.645 is the z-score of the 95th percentile of the standard normal distribution
+        sigma = math.log(self.p95_sec / self.median_sec) / 1.645
+        return rng.lognormvariate(math.log(self.median_sec), sigma)
+
+
+class FixtureStore:
+    """
+    Fixtures of one kind ("serp", "llm", "http_page" or "page") live in a subdirectory of `directory` named after the
+    kind, one JSON file per recorded request.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._loaded: dict[str, dict[str, dict[str, Any]]] = {}
+
+    def get(self, kind: str, key: str) -> Optional[dict[str, Any]]:
+        return self._load_kind(kind).get(_fixture_id(key))
+
+    def find_similar(self, kind: str, route: list[Any], text: str) -> Optional[dict[str, Any]]:
+        """
+        The recorded request of the same kind and route (e.g. the same model and response format) whose text is the
+        most similar to `text`.
+        """
+        candidates = [fixture for fixture in self._load_kind(kind).values() if fixture["request"]["route"] == route]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda fixture: question_similarity(fixture["request"]["text"], text))
+
+    def put(self, kind: str, key: str, fixture: dict[str, Any]) -> None:
+        fixture_id = _fixture_id(key)
+        path = os.path.join(self.directory, kind, f"{fixture_id}.json")
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as file:
+                json.dump(fixture, file, ensure_ascii=False, indent=2)
+            self._loaded.setdefault(kind, {})[fixture_id] = fixture
+
+    def _load_kind(self, kind: str) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            fixtures = self._loaded.get(kind)
+            if fixtures is None:
+                fixtures = {}
+                kind_dir = os.path.join(self.directory, kind)
+                if os.path.isdir(kind_dir):
+                    for filename in sorted(os.listdir(kind_dir)):
+                        if filename.endswith(".json"):
+                            with open(os.path.join(kind_dir, filename), encoding="utf-8") as file:
+                                fixtures[filename[: -len(".json")]] = json.load(file)
+                self._loaded[kind] = fixtures
+            return fixtures
+
+
+class ReplaySession:
+    """
+    Creates the transports (for `httpx` clients) and the browser drivers that record or replay the external calls
+    according to `mode` ("record", "replay" or None - neither, everything goes to the network as usual).
+    """
+
+    def __init__(self, mode: Optional[str], fixtures_dir: str) -> None:
+        if mode is not None and mode not in REPLAY_MODES:
+            raise ValueError(f"Unknown replay mode: {mode!r} (expected one of {REPLAY_MODES})")
+        self.mode = mode
+        self.store = FixtureStore(fixtures_dir)
+        self.latencies: dict[str, LatencyDistribution] = {}
+        # Delay between the chunks of a replayed streamed response (e.g. the tokens of the final answer)
+        self.stream_chunk_delay_sec = 0.0
+        self.rng = random.Random()
+
+    def configure(
+        self,
+        latencies: Optional[dict[str, LatencyDistribution]] = None,
+        stream_chunk_delay_sec: Optional[float] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        if latencies is not None:
+            self.latencies = dict(latencies)
+        if stream_chunk_delay_sec is not None:
+            self.stream_chunk_delay_sec = stream_chunk_delay_sec
+        if seed is not None:
+            self.rng.seed(seed)
+
+    def sample_latency(self, kind: str) -> float:
+        latency = self.latencies.get(kind)
+        return latency.sample(self.rng) if latency else 0.0
+
+    def httpx_transport(self, kind: str, client_class: type = httpx.AsyncClient) -> Optional[Any]:
+        """
+        A transport for an HTTP client of the given class that connects directly to the target host (None if
+        recording/replaying is off, which makes the client use its default transport).
+        """
+        http_module = _http_module_of(client_class)
+        wrapper = self.transport_wrapper(kind, http_module)
+        return wrapper(http_module.AsyncHTTPTransport()) if wrapper else None
+
+    def transport_wrapper(self, kind: str, http_module: ModuleType = httpx) -> Optional[Callable[[Any], Any]]:
+        """
+        A function that wraps a real transport into a recording or replaying one (None if recording/replaying is off).
+        """
+        if self.mode == "record":
+            return lambda transport: _RecordingTransport(self, kind, http_module, transport)
+        if self.mode == "replay":
+            return lambda transport: _ReplayTransport(self, kind, http_module)
+        return None
+
+    def driver_factory(self, create_driver: Callable[[], Any]) -> Callable[[], Any]:
+        if self.mode == "record":
+            return lambda: _RecordingBrowserDriver(self, create_driver())
+        if self.mode == "replay":
+            return lambda: _ReplayBrowserDriver(self)
+        return create_driver
+
+
+class _Transport:
+    """
+    The interface of `httpx.AsyncBaseTransport`. The transports don't inherit from it, because they are also used
+    with `httpx2` (newer versions of `openai` are built on this fork of `httpx`), they build the responses with the
+    library of the client instead (`http_module`).
+    """
+
+    def __init__(self, session: ReplaySession, kind: str, http_module: ModuleType) -> None:
+        self._session = session
+        self._kind = kind
+        self._http = http_module
+
+    async def handle_async_request(self, request: Any) -> Any:
+        raise NotImplementedError
+
+    async def aclose(self) -> None:
+        pass
+
+    async def __aenter__(self) -> "_Transport":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+
+class _RecordingTransport(_Transport):
+    def __init__(self, session: ReplaySession, kind: str, http_module: ModuleType, transport: Any) -> None:
+        super().__init__(session, kind, http_module)
+        self._transport = transport
+
+    async def handle_async_request(self, request: Any) -> Any:
+        response = await self._transport.handle_async_request(request)
+        try:
+            # Streamed responses are recorded as a whole (they reach the client only after they are complete, which
+            # doesn't matter in this mode - recording is not meant for measuring anything)
+            body = await self._http.Response(
+                response.status_code, headers=response.headers, stream=response.stream
+            ).aread()
+        finally:
+            await response.aclose()
+
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in _ENCODING_HEADERS}
+        # Redirects are recorded too, so that they can be followed in the replay mode
+        if 200 <= response.status_code < 400:
+            await request.aread()
+            key, route, text = _fingerprint_request(self._kind, request)
+            fixture = {
+                "request": {"method": request.method, "url": str(request.url), "route": route, "text": text},
+                "response": {"status_code": response.status_code, "headers": headers, **_encode_body(body)},
+            }
+            await asyncio.to_thread(self._session.store.put, self._kind, key, fixture)
+        return self._http.Response(response.status_code, headers=headers, content=body)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class _ReplayTransport(_Transport):
+    async def handle_async_request(self, request: Any) -> Any:
+        await request.aread()
+        key, route, text = _fingerprint_request(self._kind, request)
+        fixture = self._session.store.get(self._kind, key)
+        if fixture is None and self._kind not in EXACT_MATCH_KINDS:
+            fixture = self._session.store.find_similar(self._kind, route, text)
+
+        await asyncio.sleep(self._session.sample_latency(self._kind))
+        if fixture is None:
+            # 404 is not retried (see `retrying.py`), so a missing fixture fails fast
+            return self._http.Response(
+                404, json={"error": {"message": f"No {self._kind} fixture was recorded for {request.url}"}}
+            )
+
+        response = fixture["response"]
+        body = _decode_body(response)
+        if "text/event-stream" in response["headers"].get("content-type", ""):
+            return self._http.Response(
+                response["status_code"], headers=response["headers"], content=self._aiter_events(body)
+            )
+        return self._http.Response(response["status_code"], headers=response["headers"], content=body)
+
+    async def _aiter_events(self, body: bytes) -> AsyncIterator[bytes]:
+        # Server-sent events are delivered one by one (e.g. the tokens of a streamed LLM response)
+        events = body.split(b"\n\n")
+        for event_idx, event in enumerate(events):
+            if event_idx:
+                await asyncio.sleep(self._session.stream_chunk_delay_sec)
+            if event_idx < len(events) - 1:
+                yield event + b"\n\n"
+            elif event:
+                yield event
+
+
+class _RecordingBrowserDriver:
+    def __init__(self, session: ReplaySession, driver: Any) -> None:
+        self._session = session
+        self._driver = driver
+
+    def get(self, url: str) -> None:
+        self._driver.get(url)
+        self._session.store.put("page", normalize_url(url), {"url": url, "html": self._driver.page_source})
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._driver, name)
+
+
+class _ReplayBrowserDriver:
+    def __init__(self, session: ReplaySession) -> None:
+        self._session = session
+        self.page_source = ""
+
+    def get(self, url: str) -> None:
+        # This runs in a scraping thread (see `scrape_web_page` in `utils.py`), hence the blocking sleep
+        time.sleep(self._session.sample_latency("page"))
+        fixture = self._session.store.get("page", normalize_url(url))
+        if fixture is None:
+            raise FixtureNotFoundError(f"No page fixture was recorded for {url}")
+        self.page_source = fixture["html"]
+
+    def execute_script(self, script: str, *args: Any) -> Any:  # pylint: disable=unused-argument
+        # Only used for health checks of pooled sessions (see `driver_pool.py`)
+        return 1
+
+    def quit(self) -> None:
+        pass
+
+
+def _fingerprint_request(kind: str, request: Any) -> tuple[str, list[Any], str]:
+    """
+    The key of the fixture of a request (for exact matching), its "route" (only the requests of the same route are
+    considered for similarity matching) and its text (for similarity matching).
+    """
+    if kind == "serp":
+        query = normalize_query(request.url.params.get("q", ""))
+        return query, [kind], query
+    if kind == "http_page":
+        url = normalize_url(str(request.url))
+        return url, [kind], url
+
+    body = json.loads(request.content or b"{}")
+    response_format = body.get("response_format") or {}
+    route = [
+        request.url.path,
+        body.get("model"),
+        (response_format.get("json_schema") or {}).get("name"),
+        bool(body.get("stream")),
+    ]
+    text = "\n\n".join(str(message.get("content")) for message in body.get("messages", ()))
+    text = _DATE_RE.sub("<DATE>", text)
+    return json.dumps([route, text]), route, text[:MAX_MATCHING_TEXT_CHARS]
+
+
+def _encode_body(body: bytes) -> dict[str, str]:
+    try:
+        return {"body": body.decode("utf-8")}
+    except UnicodeDecodeError:
+        # E.g. a PDF document
+        return {"body_base64": base64.b64encode(body).decode("ascii")}
+
+
+def _decode_body(response: dict[str, Any]) -> bytes:
+    if "body_base64" in response:
+        return base64.b64decode(response["body_base64"])
+    return response["body"].encode("utf-8")
+
+
+def _http_module_of(client_class: type) -> ModuleType:
+    for cls in client_class.__mro__:
+        if cls.__name__ == "AsyncClient":
+            return importlib.import_module(cls.__module__.partition(".")[0])
+    return httpx
+
+
+def _fixture_id(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:24]
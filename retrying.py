@@ -0,0 +1,163 @@
+"""
+Retries with exponential backoff and jitter, per-call deadlines and hedged requests.
+
+- Errors are classified into retryable (network problems, timeouts, rate limiting, server errors) and non-retryable
+  (e.g. bad requests or authentication problems - retrying them would only add latency).
+- The delay between attempts grows exponentially and is randomized ("full jitter"), so that concurrent callers that
+  failed at the same time don't retry in lockstep.
+- A "hedged" attempt starts a duplicate request if the first one takes longer than the 95th percentile of the latency
+  observed so far, and the request that finishes first wins (the other one is cancelled).
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import httpx
+import openai
+from pydantic import BaseModel
+from selenium.common.exceptions import InvalidArgumentException, WebDriverException
+
+T = TypeVar("T")
+
+RETRYABLE_HTTP_STATUS_CODES = (408, 425, 429, 500, 502, 503, 504)
+
+
+class RetryPolicy(BaseModel):
+    max_attempts: int = 3
+    base_delay_sec: float = 0.5
+    max_delay_sec: float = 8.0
+    # Time limit for a single attempt (None - no limit)
+    attempt_timeout_sec: Optional[float] = None
+    # Time limit for all the attempts together, including the delays between them (None - no limit)
+    deadline_sec: Optional[float] = None
+
+    def delay_before_attempt(self, attempt: int) -> float:
+        """
+        The delay before the given attempt (attempts are numbered from 1), exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.max_delay_sec, self.base_delay_sec * 2 ** (attempt - 2)))
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_HTTP_STATUS_CODES
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_HTTP_STATUS_CODES
+    if isinstance(error, openai.OpenAIError):
+        # E.g. the structured output could not be parsed because the response was cut off - it's not likely that a
+        # retry will help
+        return False
+    if isinstance(error, LookupError):
+        # E.g. nothing was recorded for this request in the replay mode (see `replay.py`)
+        return False
+    if isinstance(error, InvalidArgumentException):
+        # E.g. a malformed url
+        return False
+    if isinstance(error, WebDriverException):
+        return True
+    # We don't know what this is - let's give it another chance
+    return isinstance(error, Exception)
+
+
+class LatencyTracker:
+    """
+    Keeps the latencies of the last `window` successful calls to estimate latency percentiles.
+    """
+
+    def __init__(self, window: int = 200, min_samples: int = 10) -> None:
+        self.min_samples = min_samples
+        self._samples: deque[float] = deque(maxlen=window)
+
+    def record(self, latency_sec: float) -> None:
+        self._samples.append(latency_sec)
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """
+        Return the given percentile of the recorded latencies or None if there are not enough samples yet.
+        """
+        if len(self._samples) < self.min_samples:
+            return None
+        sorted_samples = sorted(self._samples)
+        return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percent / 100))]
+
+
+async def ahedged(func: Callable[[], Awaitable[T]], hedge_after_sec: float) -> T:
+    """
+    Call `func` and, if it doesn't finish within `hedge_after_sec` seconds, call it once more in parallel. The result
+    of whichever call succeeds first is returned and the other call is cancelled. If both calls fail, the error of the
+    first one is raised.
+    """
+    first = asyncio.ensure_future(func())
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after_sec)
+        if not done:
+            tasks.append(asyncio.ensure_future(func()))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+        # Either the first call finished (successfully or not) before the hedging delay or both calls failed
+        return first.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def aretry(
+    func: Callable[[], Awaitable[T]],
+    policy: RetryPolicy,
+    *,
+    on_retry: Optional[Callable[[int, BaseException], None]] = None,
+    latency_tracker: Optional[LatencyTracker] = None,
+    hedge: bool = False,
+) -> T:
+    """
+    Call `func` (a function that returns a new awaitable every time it is called) and retry it according to the
+    `policy` if it fails with a retryable error. `on_retry` is called with the number of the upcoming attempt and the
+    error of the previous attempt right before every retry. If `hedge` is True (requires a `latency_tracker`), every
+    attempt is hedged after the 95th percentile of the latency observed so far.
+    """
+    started_at = time.monotonic()
+    attempt = 1
+    while True:
+        timeout = policy.attempt_timeout_sec
+        if policy.deadline_sec is not None:
+            remaining = policy.deadline_sec - (time.monotonic() - started_at)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        hedge_after_sec = latency_tracker.percentile(95) if hedge and latency_tracker else None
+        attempt_started_at = time.monotonic()
+        try:
+            if hedge_after_sec is None:
+                result = await asyncio.wait_for(func(), timeout)
+            else:
+                result = await asyncio.wait_for(ahedged(func, hedge_after_sec), timeout)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            delay = policy.delay_before_attempt(attempt + 1)
+            deadline_exceeded = (
+                policy.deadline_sec is not None and time.monotonic() - started_at + delay >= policy.deadline_sec
+            )
+            if attempt >= policy.max_attempts or deadline_exceeded or not is_retryable(error):
+                raise
+            if on_retry:
+                on_retry(attempt + 1, error)
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+
+        if latency_tracker:
+            latency_tracker.record(time.monotonic() - attempt_started_at)
+        return result
@@ -0,0 +1,226 @@
+"""
+A central scheduler that limits the concurrency of the different stages of the pipeline (web searches, page scraping,
+LLM calls).
+
+Every stage gets its own concurrency budget which adapts to the observed behaviour of the stage AIMD-style (additive
+increase, multiplicative decrease - the same way TCP congestion control works): the budget grows slowly while the
+stage is healthy and shrinks quickly upon errors, rate limiting (HTTP 429, `retry-after` and `x-ratelimit-*` headers)
+and latencies that exceed the target latency of the stage. Work that waits for a slot is served in the order of its
+priority (and in FIFO order within the same priority).
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+import weakref
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Any, AsyncContextManager, AsyncIterator, Mapping, Optional
+
+from pydantic import BaseModel
+
+from tracing import record_queue_wait
+
+
+class Priority(IntEnum):
+    # The smaller the value, the sooner the work is served
+    CRITICAL = 0  # the final answer that the user is waiting for
+    HIGH = 1  # planning of the research (everything else depends on it)
+    NORMAL = 2
+    LOW = 3  # speculative work (e.g. scraping of pages that might turn out to be not needed)
+
+
+class StageBudget(BaseModel):
+    initial: int
+    min: int = 1
+    max: int
+    # The budget is decreased if a unit of work of the stage takes longer than this (None - don't look at latency)
+    target_latency_sec: Optional[float] = None
+    increase_step: float = 1.0
+    decrease_factor: float = 0.7
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter of a single stage. Use `aslot` to run a unit of work within the limit.
+    """
+
+    def __init__(self, name: str, budget: StageBudget) -> None:
+        self.name = name
+        self.budget = budget
+        self.limit = float(budget.initial)
+
+        self._in_flight = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._resume_handle: Optional[asyncio.TimerHandle] = None
+        # The rate limited responses that were already observed (they are seen again by `_on_failure` when the error
+        # that carries them is raised, and must not be counted twice)
+        self._observed_rate_limited_responses: weakref.WeakSet = weakref.WeakSet()
+
+        self._completed = 0
+        self._failed = 0
+        self._rate_limited = 0
+        self._max_queue_depth = 0
+        self._total_wait_sec = 0.0
+        self._total_exec_sec = 0.0
+
+    @asynccontextmanager
+    async def aslot(self, priority: Priority = Priority.NORMAL) -> AsyncIterator[float]:
+        """
+        Wait for a free slot and hold it for the duration of the `async with` block. The time spent waiting (in
+        seconds) is what the `async with` statement returns.
+        """
+        wait_sec = await self._aacquire(priority)
+        record_queue_wait(wait_sec)
+        started_at = time.monotonic()
+        try:
+            yield wait_sec
+        except asyncio.CancelledError:
+            raise
+        except BaseException as exc:
+            self._on_failure(exc)
+            raise
+        else:
+            self._on_success(time.monotonic() - started_at)
+        finally:
+            self._total_exec_sec += time.monotonic() - started_at
+            self._release()
+
+    def observe_rate_limit(self, status_code: int, headers: Mapping[str, str], response: Any = None) -> None:
+        """
+        Adapt the budget to the rate limiting information of an HTTP response (see `StageScheduler.observe_response`).
+        """
+        if status_code == 429:
+            if response is not None:
+                self._observed_rate_limited_responses.add(response)
+            retry_after = _parse_float(headers.get("retry-after"))
+            self._on_rate_limited(retry_after)
+            return
+
+        for kind in ("requests", "tokens"):
+            remaining = _parse_float(headers.get(f"x-ratelimit-remaining-{kind}"))
+            limit = _parse_float(headers.get(f"x-ratelimit-limit-{kind}"))
+            if remaining is not None and limit and remaining / limit < 0.05:
+                # We are about to hit the rate limit - let's slow down before we actually do
+                self._decrease()
+                return
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "in_flight": self._in_flight,
+            "queue_depth": len(self._waiters),
+            "max_queue_depth": self._max_queue_depth,
+            "completed": self._completed,
+            "failed": self._failed,
+            "rate_limited": self._rate_limited,
+            "avg_wait_sec": self._total_wait_sec / max(self._completed + self._failed, 1),
+            "avg_exec_sec": self._total_exec_sec / max(self._completed + self._failed, 1),
+        }
+
+    async def _aacquire(self, priority: Priority) -> float:
+        started_at = time.monotonic()
+        if not self._waiters and self._has_capacity():
+            self._in_flight += 1
+            return 0.0
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (int(priority), next(self._sequence), future))
+        self._max_queue_depth = max(self._max_queue_depth, len(self._waiters))
+        # Makes sure that the waiter is woken up when a rate limiting pause is over (even if nothing gets released)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted right before the cancellation - give it back
+                self._release()
+            raise
+
+        wait_sec = time.monotonic() - started_at
+        self._total_wait_sec += wait_sec
+        return wait_sec
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._waiters and self._has_capacity():
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self._in_flight += 1
+            future.set_result(None)
+
+        if self._waiters and self._paused_until > time.monotonic() and self._resume_handle is None:
+            self._resume_handle = asyncio.get_running_loop().call_later(
+                self._paused_until - time.monotonic(), self._resume
+            )
+
+    def _resume(self) -> None:
+        self._resume_handle = None
+        self._dispatch()
+
+    def _has_capacity(self) -> bool:
+        return self._paused_until <= time.monotonic() and self._in_flight < int(self.limit)
+
+    def _on_success(self, latency_sec: float) -> None:
+        self._completed += 1
+        if self.budget.target_latency_sec is not None and latency_sec > self.budget.target_latency_sec:
+            self._decrease()
+        else:
+            # Additive increase: roughly +`increase_step` per "window" of `limit` successful units of work
+            self.limit = min(float(self.budget.max), self.limit + self.budget.increase_step / max(self.limit, 1.0))
+            self._dispatch()
+
+    def _on_failure(self, exc: BaseException) -> None:
+        self._failed += 1
+        response = getattr(exc, "response", None)
+        if getattr(response, "status_code", None) == 429:
+            if response in self._observed_rate_limited_responses:
+                # Already taken into account when the response was observed
+                return
+            self._on_rate_limited(_parse_float(response.headers.get("retry-after")))
+        else:
+            self._decrease()
+
+    def _on_rate_limited(self, retry_after_sec: Optional[float]) -> None:
+        self._rate_limited += 1
+        self._decrease(factor=0.5)
+        if retry_after_sec:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after_sec)
+
+    def _decrease(self, factor: Optional[float] = None) -> None:
+        factor = self.budget.decrease_factor if factor is None else factor
+        self.limit = max(float(self.budget.min), self.limit * factor)
+
+
+class StageScheduler:
+    def __init__(self, budgets: Mapping[str, StageBudget]) -> None:
+        self.limiters = {name: AdaptiveLimiter(name, budget) for name, budget in budgets.items()}
+
+    def aslot(self, stage: str, priority: Priority = Priority.NORMAL) -> AsyncContextManager[float]:
+        return self.limiters[stage].aslot(priority)
+
+    def observe_response(self, stage: str, status_code: int, headers: Mapping[str, str], response: Any = None) -> None:
+        """
+        Pass the `response` object itself too if the error it may end up being raised with fails the slot of the stage
+        (e.g. a `RateLimitError` of OpenAI) - then the rate limiting is only taken into account once.
+        """
+        self.limiters[stage].observe_rate_limit(status_code, headers, response)
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {name: limiter.stats() for name, limiter in self.limiters.items()}
+
+
+def _parse_float(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
@@ -0,0 +1,113 @@
+"""
+Normalization of the search engine result pages (SERPs) returned by Bright Data SERP API (`brd_json=1`).
+
+The raw response is a big dict full of ads, knowledge panels, "people also ask" blocks, images and tracking data.
+Only the organic results are kept (title, url, snippet and the rank given by the search engine). They are re-ranked
+locally against the search query and its rationale with BM25 (a lexical relevance score), and only the top results
+are shown to the LLM that picks the pages to read - in a compact text format rather than as a Python repr of a dict.
+"""
+
+import math
+import re
+from collections import Counter
+from typing import Any
+
+from pydantic import BaseModel
+
+# BM25 parameters (the usual defaults)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# The smoothing constant of reciprocal rank fusion (the usual default)
+RRF_K = 60
+MAX_SNIPPET_CHARS = 300
+
+
+class SearchResult(BaseModel):
+    title: str
+    url: str
+    snippet: str
+    # The position in the results of the search engine (starting from 1)
+    rank: int
+
+
+def _terms(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def parse_organic_results(serp: dict[str, Any]) -> list[SearchResult]:
+    """
+    The organic results of a SERP in the order of their rank (results without a url are skipped, and so are
+    duplicate urls).
+    """
+    results = []
+    seen_urls = set()
+    for position, item in enumerate(serp.get("organic") or (), start=1):
+        url = (item.get("link") or item.get("url") or "").strip()
+        if not url or url in seen_urls:
+            continue
+        seen_urls.add(url)
+        snippet = " ".join(str(item.get("description") or item.get("snippet") or "").split())
+        results.append(
+            SearchResult(
+                title=" ".join(str(item.get("title") or "").split()),
+                url=url,
+                snippet=snippet[:MAX_SNIPPET_CHARS],
+                rank=int(item.get("rank") or position),
+            )
+        )
+    results.sort(key=lambda result: result.rank)
+    return results
+
+
+def bm25_scores(query: str, documents: list[str]) -> list[float]:
+    """
+    BM25 score of every document for the query (the statistics of the terms are taken from the documents themselves).
+    """
+    documents_terms = [_terms(document) for document in documents]
+    if not documents_terms:
+        return []
+    avg_length = sum(len(terms) for terms in documents_terms) / len(documents_terms) or 1.0
+    document_frequencies = Counter(term for terms in documents_terms for term in set(terms))
+
+    scores = []
+    for terms in documents_terms:
+        term_frequencies = Counter(terms)
+        score = 0.0
+        for term in set(_terms(query)):
+            frequency = term_frequencies.get(term)
+            if not frequency:
+                continue
+            idf = math.log(
+                1 + (len(documents_terms) - document_frequencies[term] + 0.5) / (document_frequencies[term] + 0.5)
+            )
+            score += (
+                idf
+                * frequency
+                * (BM25_K1 + 1)
+                / (frequency + BM25_K1 * (1 - BM25_B + BM25_B * len(terms) / avg_length))
+            )
+        scores.append(score)
+    return scores
+
+
+def rank_search_results(results: list[SearchResult], query: str, max_results: int) -> list[SearchResult]:
+    """
+    The `max_results` most relevant results. The BM25 ranking (title and snippet against the query) is fused with the
+    ranking of the search engine (reciprocal rank fusion), so neither of them alone decides what is dropped (the
+    results that have no terms in common with the query at all only get the score of their search engine rank). The
+    results that are kept are returned in the order of the search engine.
+    """
+    scores = bm25_scores(query, [f"{result.title} {result.snippet}" for result in results])
+    fused_scores = [1 / (RRF_K + result.rank) for result in results]
+    for bm25_rank, result_idx in enumerate(sorted(range(len(results)), key=lambda idx: -scores[idx]), start=1):
+        if scores[result_idx] > 0:
+            fused_scores[result_idx] += 1 / (RRF_K + bm25_rank)
+    fused = sorted(range(len(results)), key=lambda idx: -fused_scores[idx])
+    return sorted((results[idx] for idx in fused[:max_results]), key=lambda result: result.rank)
+
+
+def format_search_results(results: list[SearchResult]) -> str:
+    """
+    A compact text representation of the search results for an LLM prompt.
+    """
+    return "\n\n".join(f"{result.rank}. {result.title}\n{result.url}\n{result.snippet}" for result in results)
@@ -0,0 +1,368 @@
+"""
+A long-running HTTP server that researches many questions concurrently (an alternative to the one-question console UI
+of `web_research.py`).
+
+All the questions are researched within one `MiniAgents` context, so they share the connection pools, the remote
+browser sessions, the process pool, the caches and the concurrency budgets of the scheduler (see `utils.py`). Only the
+standard library is used (`asyncio` streams):
+
+    POST /research   The question is the request body (plain text or JSON: {"question": "..."}). The progress reports
+                     and the answer are streamed back as plain text as soon as they are available (the same text the
+                     console UI prints). GET /research?q=... works too. The budget of the research can be limited
+                     with the `deadline_sec`, `max_tokens` and `max_paid_requests` query parameters (or JSON fields,
+                     see `budget.py`).
+    GET  /stats      Questions per minute, admission control, scheduler, caches, fetching and browser sessions (JSON)
+    GET  /health     Liveness check
+
+Questions beyond `max_concurrent` wait in a queue of limited size (and for a limited time) - when the queue is full,
+or the wait is too long, the server responds with "503 Service Unavailable" right away instead of piling up work.
+
+Usage (from the root of the repository):
+
+    python server.py [--host HOST] [--port PORT] [--max-concurrent N] [--max-queued N] [--llm-logs]
+
+    curl -N localhost:8000/research -d "What is the tallest building in Europe?"
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager, suppress
+from typing import Any, AsyncIterator, Optional
+from urllib.parse import parse_qs
+
+from pydantic import ValidationError
+
+from budget import BudgetLimits
+from utils import (
+    WebResearchMiniAgents,
+    browser_session_pool,
+    content_cache,
+    page_tier_memory,
+    plan_cache,
+    scheduler,
+)
+from web_research import research_agent
+
+# Importing `utils` above has checked the version of MiniAgents
+# pylint: disable=wrong-import-position,wrong-import-order
+from miniagents import ErrorMessage
+
+MAX_CONCURRENT_QUESTIONS = int(os.environ.get("WEB_RESEARCH_MAX_CONCURRENT_QUESTIONS", "8"))
+MAX_QUEUED_QUESTIONS = int(os.environ.get("WEB_RESEARCH_MAX_QUEUED_QUESTIONS", "32"))
+# How long a question may wait in the queue before it is rejected
+QUEUE_TIMEOUT_SEC = 60
+# Questions per minute are measured over this period
+THROUGHPUT_WINDOW_SEC = 10 * 60
+MAX_REQUEST_BODY_BYTES = 64 * 1024
+# The limits of the budget of a research that can be given per question (see `BudgetLimits` in `budget.py`)
+BUDGET_PARAMS = ("deadline_sec", "max_tokens", "max_paid_requests")
+REQUEST_HEADERS_TIMEOUT_SEC = 30
+
+_STATUS_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
+
+
+class AdmissionRejectedError(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Lets at most `max_concurrent` questions be researched at the same time, with at most `max_queued` more questions
+    waiting (for at most `queue_timeout_sec` seconds) for their turn.
+    """
+
+    def __init__(self, max_concurrent: int, max_queued: int, queue_timeout_sec: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout_sec = queue_timeout_sec
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._in_flight = 0
+        self._queued = 0
+        self._admitted = 0
+        self._rejected = 0
+
+    @asynccontextmanager
+    async def aadmit(self) -> AsyncIterator[None]:
+        if self._semaphore.locked() and self._queued >= self.max_queued:
+            self._rejected += 1
+            raise AdmissionRejectedError("Too many questions are waiting to be researched")
+
+        self._queued += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout_sec)
+        except asyncio.TimeoutError as exc:
+            self._rejected += 1
+            raise AdmissionRejectedError("The question waited to be researched for too long") from exc
+        finally:
+            self._queued -= 1
+
+        self._admitted += 1
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "max_queued": self.max_queued,
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "admitted": self._admitted,
+            "rejected": self._rejected,
+        }
+
+
+class ThroughputMeter:
+    """
+    Sustained throughput (questions per minute) and latency of the questions completed within the last `window_sec`
+    seconds.
+    """
+
+    def __init__(self, window_sec: float) -> None:
+        self.window_sec = window_sec
+        self._started_at = time.monotonic()
+        self._completions: deque[tuple[float, float]] = deque()
+        self._completed = 0
+        self._with_errors = 0
+
+    def record(self, duration_sec: float, errors: int) -> None:
+        self._completed += 1
+        self._with_errors += bool(errors)
+        self._completions.append((time.monotonic(), duration_sec))
+
+    def stats(self) -> dict[str, Any]:
+        now = time.monotonic()
+        while self._completions and self._completions[0][0] < now - self.window_sec:
+            self._completions.popleft()
+        durations = sorted(duration_sec for _, duration_sec in self._completions)
+        measured_sec = min(self.window_sec, now - self._started_at)
+        return {
+            "completed": self._completed,
+            "completed_with_errors": self._with_errors,
+            "questions_per_minute": len(durations) * 60 / max(measured_sec, 1.0),
+            "window_sec": self.window_sec,
+            "p50_sec": statistics.median(durations) if durations else None,
+            "p95_sec": durations[int(len(durations) * 0.95)] if durations else None,
+        }
+
+
+class ResearchServer:
+    def __init__(self, admission: AdmissionController, throughput: ThroughputMeter) -> None:
+        self.admission = admission
+        self.throughput = throughput
+
+    async def aserve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self._ahandle_connection, host, port)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            with suppress(NotImplementedError):  # not supported on Windows
+                loop.add_signal_handler(signal_number, stop.set)
+
+        async with server:
+            await stop.wait()
+        # The questions that are still being researched are finished by `MiniAgents` (it waits for all the agents to
+        # finish before it shuts down the shared resources)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "questions": self.throughput.stats(),
+            "admission": self.admission.stats(),
+            "scheduler": scheduler.stats(),
+            "cache": content_cache.stats(),
+            "plan_cache": plan_cache.stats(),
+            "browser_sessions": browser_session_pool.stats(),
+            "fetch_tiers": page_tier_memory.stats(),
+        }
+
+    async def _ahandle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            try:
+                method, path, query, body = await asyncio.wait_for(_aread_request(reader), REQUEST_HEADERS_TIMEOUT_SEC)
+            except _BadRequestError as exc:
+                await _awrite_response(writer, exc.status, {"error": str(exc)})
+                return
+            except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                await _awrite_response(writer, 400, {"error": "Malformed request"})
+                return
+
+            if path == "/research" and method in ("GET", "POST"):
+                question = _parse_question(method, query, body)
+                try:
+                    budget = _parse_budget(query, body)
+                except ValueError as exc:
+                    await _awrite_response(writer, 400, {"error": f"Invalid budget: {exc}"})
+                    return
+                if question:
+                    await self._astream_research(writer, question, budget)
+                else:
+                    await _awrite_response(writer, 400, {"error": "No question was given"})
+            elif path == "/stats" and method == "GET":
+                await _awrite_response(writer, 200, self.stats())
+            elif path == "/health" and method == "GET":
+                await _awrite_response(writer, 200, {"status": "ok"})
+            else:
+                await _awrite_response(writer, 404, {"error": f"{method} {path} not found"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            with suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _astream_research(self, writer: asyncio.StreamWriter, question: str, budget: dict[str, Any]) -> None:
+        try:
+            async with self.admission.aadmit():
+                await _awrite_head(writer, 200, "text/plain; charset=utf-8")
+                started_at = time.monotonic()
+                client_connected = True
+                errors = 0
+                # The same as in `main` in `web_research.py`: everything the agents report is streamed to the client
+                # token by token, except for the messages that are not meant for the user
+                async for message_promise in research_agent.trigger(question, **budget):
+                    if message_promise.known_beforehand.get("not_for_user"):
+                        continue
+                    async for token in message_promise:
+                        client_connected = await _awrite_text(writer, str(token), client_connected)
+                    client_connected = await _awrite_text(writer, "\n\n", client_connected)
+                    errors += isinstance(await message_promise, ErrorMessage)
+                # NOTE: If the client disconnects, the research still runs to completion (and keeps its admission
+                # slot), because its agents keep working in the background anyway (and fill the caches for the next
+                # questions)
+                self.throughput.record(time.monotonic() - started_at, errors)
+        except AdmissionRejectedError as exc:
+            await _awrite_response(writer, 503, {"error": str(exc)}, extra_headers={"Retry-After": "30"})
+
+
+class _BadRequestError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+async def _aread_request(reader: asyncio.StreamReader) -> tuple[str, str, str, bytes]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, target, _ = request_line.split(" ", 2)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    content_length = int(headers.get("content-length") or 0)
+    if content_length > MAX_REQUEST_BODY_BYTES:
+        raise _BadRequestError(413, f"The request body must not exceed {MAX_REQUEST_BODY_BYTES} bytes")
+    body = await reader.readexactly(content_length) if content_length else b""
+
+    path, _, query = target.partition("?")
+    return method.upper(), path, query, body
+
+
+def _parse_question(method: str, query: str, body: bytes) -> Optional[str]:
+    if method == "GET":
+        return (parse_qs(query).get("q") or [""])[0].strip()
+
+    text = body.decode("utf-8", errors="replace").strip()
+    if text.startswith("{"):
+        try:
+            return str(json.loads(text).get("question") or "").strip()
+        except (ValueError, AttributeError):
+            return None
+    return text
+
+
+def _parse_budget(query: str, body: bytes) -> dict[str, Any]:
+    """
+    The limits of the budget of the research that were given in the query string or in the JSON body (the ones that
+    were not given are not included). Raises `ValueError` if any of them is invalid.
+    """
+    given = {name: values[0] for name, values in parse_qs(query).items() if name in BUDGET_PARAMS}
+    text = body.decode("utf-8", errors="replace").strip()
+    if text.startswith("{"):
+        with suppress(ValueError, AttributeError):
+            given.update({name: value for name, value in json.loads(text).items() if name in BUDGET_PARAMS})
+    try:
+        limits = BudgetLimits(**given)
+    except ValidationError as exc:
+        raise ValueError("; ".join(f"{error['loc'][0]}: {error['msg']}" for error in exc.errors())) from exc
+    return limits.model_dump(include=set(given))
+
+
+async def _awrite_head(
+    writer: asyncio.StreamWriter, status: int, content_type: str, extra_headers: Optional[dict[str, str]] = None
+) -> None:
+    # No Content-Length - the end of the (streamed) response body is marked by closing the connection
+    headers = {
+        "Content-Type": content_type,
+        "Cache-Control": "no-cache",
+        "Connection": "close",
+        **(extra_headers or {}),
+    }
+    head = f"HTTP/1.1 {status} {_STATUS_REASONS[status]}\r\n"
+    head += "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    writer.write(f"{head}\r\n".encode("latin-1"))
+    await writer.drain()
+
+
+async def _awrite_response(
+    writer: asyncio.StreamWriter, status: int, payload: dict[str, Any], extra_headers: Optional[dict[str, str]] = None
+) -> None:
+    await _awrite_head(writer, status, "application/json", extra_headers)
+    writer.write(json.dumps(payload, default=str).encode("utf-8"))
+    await writer.drain()
+
+
+async def _awrite_text(writer: asyncio.StreamWriter, text: str, client_connected: bool) -> bool:
+    """
+    Write text to the client, return whether the client is still connected.
+    """
+    if not client_connected:
+        return False
+    try:
+        writer.write(text.encode("utf-8"))
+        await writer.drain()
+        return True
+    except ConnectionError:
+        return False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-concurrent", type=int, default=MAX_CONCURRENT_QUESTIONS)
+    parser.add_argument("--max-queued", type=int, default=MAX_QUEUED_QUESTIONS)
+    parser.add_argument("--llm-logs", action="store_true", help="log LLM requests and responses to llm_logs/")
+    args = parser.parse_args()
+
+    research_server = ResearchServer(
+        AdmissionController(args.max_concurrent, args.max_queued, QUEUE_TIMEOUT_SEC),
+        ThroughputMeter(THROUGHPUT_WINDOW_SEC),
+    )
+    WebResearchMiniAgents(llm_logger_agent=args.llm_logs, errors_as_messages=True).run(
+        research_server.aserve(args.host, args.port)
+    )
+
+
+if __name__ == "__main__":
+    main()
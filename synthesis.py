@@ -0,0 +1,124 @@
+"""
+Incremental synthesis of the final answer.
+
+The summaries of the web pages are collected into a "fact sheet" in the order in which they arrive (which has nothing
+to do with the order in which the web searches and the scraping were started). The final answer starts as soon as
+enough of the pages have been summarized, instead of waiting for the slowest page (and its retries) - either once a
+coverage threshold is reached or once a deadline passes. The summaries that arrive after that ("stragglers") are
+either appended to the answer as an addendum or dropped.
+"""
+
+import asyncio
+import time
+from contextlib import suppress
+from typing import Literal, Optional
+
+from miniagents import ErrorMessage, MessageSequencePromise
+from pydantic import BaseModel
+
+
+class SynthesisPolicy(BaseModel):
+    # "complete" - start the final answer only after all the pages were read (or failed to be read)
+    mode: Literal["incremental", "complete"] = "complete"
+    # The final answer starts once this fraction of the pages that are being read are done (summarized or failed)...
+    min_coverage: float = 0.8
+    # ...and at least this many of them were summarized
+    min_pages: int = 3
+    # Start the final answer anyway this long after the first page summary arrived (None - no deadline)
+    deadline_sec: Optional[float] = 20.0
+    # What to do with the page summaries that arrive after the final answer started
+    stragglers: Literal["append", "drop"] = "append"
+
+
+class FactSheet:
+    """
+    The page summaries that arrived in the input of the `final_answer_agent` so far. Every web search reports how many
+    pages it is going to read (the messages that carry the `pages_to_read` field, sent by the `web_search_agent` once
+    it picked the pages or failed), and the pages are "announced" by the messages that carry the `reading_page` field
+    (sent by the `page_scraper_agent` before it starts scraping). A page is done once its summary (the `not_for_user`
+    messages) arrives, once it fails (the messages that carry the `failed_page` field), once it turns out to be a
+    duplicate of another page (the `duplicate_of` field) or once it is skipped because the budget of the run ran out
+    (the `skipped_page` field, see `budget.py`). Errors themselves are not counted - they may come from web searches as
+    well as from pages.
+
+    `web_searches` is the number of web searches of the research (None - unknown): the final answer doesn't start
+    before all of them reported their pages (unless the deadline passes), otherwise the coverage could look complete
+    while some of the searches haven't even picked their pages yet.
+    """
+
+    def __init__(self, policy: SynthesisPolicy, web_searches: Optional[int] = None) -> None:
+        self.policy = policy
+        self.web_searches = web_searches
+        self.summaries: list[str] = []
+        self.web_searches_done = 0
+        self.pages_to_read = 0
+        self.pages_announced = 0
+        self.pages_failed = 0
+        self.pages_skipped = 0
+        self.complete = False
+
+        self._first_summary_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def coverage(self) -> float:
+        pages = max(self.pages_to_read, self.pages_announced)
+        if not pages:
+            return 0.0
+        return min(1.0, (len(self.summaries) + self.pages_failed + self.pages_skipped) / pages)
+
+    async def acollect(self, message_promises: MessageSequencePromise) -> None:
+        """
+        Go over all the incoming messages and collect the page summaries.
+        """
+        try:
+            async for message_promise in message_promises:
+                known_beforehand = message_promise.known_beforehand
+                if known_beforehand.get("pages_to_read") is not None:
+                    self.web_searches_done += 1
+                    self.pages_to_read += known_beforehand["pages_to_read"]
+                elif known_beforehand.get("reading_page"):
+                    self.pages_announced += 1
+                elif known_beforehand.get("failed_page"):
+                    self.pages_failed += 1
+                elif known_beforehand.get("duplicate_of") or known_beforehand.get("skipped_page"):
+                    self.pages_skipped += 1
+                elif known_beforehand.get("not_for_user"):
+                    message = await message_promise
+                    if isinstance(message, ErrorMessage):
+                        continue
+                    self.summaries.append(str(message))
+                    if self._first_summary_at is None:
+                        self._first_summary_at = time.monotonic()
+                else:
+                    # Progress reports and errors
+                    continue
+                self._changed.set()
+        finally:
+            self.complete = True
+            self._changed.set()
+
+    def is_ready(self) -> bool:
+        """
+        Whether the final answer can start.
+        """
+        if self.complete:
+            return True
+        if self.policy.mode == "complete" or not self.summaries:
+            return False
+        if self._time_left_sec() == 0.0:
+            return True
+        if self.web_searches is not None and self.web_searches_done < self.web_searches:
+            return False
+        return len(self.summaries) >= self.policy.min_pages and self.coverage >= self.policy.min_coverage
+
+    async def await_ready(self) -> None:
+        while not self.is_ready():
+            self._changed.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._changed.wait(), self._time_left_sec())
+
+    def _time_left_sec(self) -> Optional[float]:
+        if self.policy.mode == "complete" or self.policy.deadline_sec is None or self._first_summary_at is None:
+            return None
+        return max(0.0, self._first_summary_at + self.policy.deadline_sec - time.monotonic())
@@ -0,0 +1,419 @@
+"""
+Lightweight tracing of the research pipeline.
+
+A span measures one stage of the work (planning, a web search, a scrape, an extraction, the final answer etc.). Spans
+are nested automatically: the current span is kept in a context variable, and since MiniAgents starts every agent call
+in an asyncio task created at the moment the agent is triggered, the agents that are triggered from within a span
+become its children. Besides the timing, spans carry the time spent waiting in the queues of the scheduler
+(`queue_wait_sec`, see `scheduler.py`) and arbitrary attributes (token counts, bytes fetched etc.).
+
+Finished spans are exported to a JSONL file and, optionally, to OpenTelemetry (if the `opentelemetry-api` package is
+installed and configured). At the end of a run `Tracer.export_summary` writes a summary of the run: the critical path
+(the chain of nested spans that determined the wall-clock time of the run) and the totals per stage. The spans of a
+run are kept in memory until the root span of its trace ends (however the run ends - successfully, with an error or
+cancelled).
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager, suppress
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+
+# Spans that end this close to the start of the next span on the critical path are still considered to be blocking it
+# (e.g. an agent that reports its result a moment before it closes its span)
+CONCURRENCY_TOLERANCE_SEC = 0.1
+
+T = TypeVar("T")
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: dict[str, Any]) -> None:
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.queue_wait_sec = 0.0
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self.end_time: Optional[float] = None
+
+    @property
+    def duration_sec(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add_to_attribute(self, key: str, value: float) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "type": "span",
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_sec": self.duration_sec,
+            "queue_wait_sec": self.queue_wait_sec,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("_current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_span_attribute(key: str, value: Any) -> None:
+    """
+    Set an attribute of the current span (if any).
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+
+def add_to_span_attribute(key: str, value: float) -> None:
+    """
+    Add to a numeric attribute of the current span (if any) - e.g. a retried request may fetch more than once.
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.add_to_attribute(key, value)
+
+
+def record_queue_wait(wait_sec: float) -> None:
+    """
+    Attribute time spent waiting for a slot of the scheduler to the current span (if any).
+    """
+    span = _current_span.get()
+    if span is not None:
+        span.queue_wait_sec += wait_sec
+
+
+class JsonlSpanExporter:
+    """
+    Appends the spans (and the summaries of the runs) to a JSONL file. The lines are queued and written by a background
+    thread (in batches), so the event loop never waits for the disk.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        # The queue of the writer thread (started on the first write): lines to write, `threading.Event`s to set once
+        # everything before them is written (see `flush`) and None to stop the thread
+        self._queue: Optional[queue.SimpleQueue] = None
+        self._writer_thread: Optional[threading.Thread] = None
+
+    def on_start(self, span: Span) -> None:
+        pass
+
+    def on_end(self, span: Span) -> None:
+        self.write(span.to_dict())
+
+    def write(self, record: dict[str, Any]) -> None:
+        self._put(json.dumps(record, default=str))
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait until everything that was written so far is in the file.
+        """
+        flushed = threading.Event()
+        if self._put(flushed, start=False):
+            flushed.wait(timeout)
+
+    def close(self) -> None:
+        with self._lock:
+            lines, writer_thread = self._queue, self._writer_thread
+            self._queue, self._writer_thread = None, None
+            if lines is not None:
+                lines.put(None)
+        if writer_thread is not None:
+            writer_thread.join()
+
+    def _put(self, item: Any, start: bool = True) -> bool:
+        with self._lock:
+            if self._queue is None:
+                if not start:
+                    return False
+                self._queue = queue.SimpleQueue()
+                self._writer_thread = threading.Thread(
+                    target=self._write_lines, args=(self._queue,), name="JsonlSpanExporter", daemon=True
+                )
+                self._writer_thread.start()
+            self._queue.put(item)
+            return True
+
+    def _write_lines(self, lines_queue: queue.SimpleQueue) -> None:
+        while True:
+            items = [lines_queue.get()]
+            with suppress(queue.Empty):
+                while True:
+                    items.append(lines_queue.get_nowait())
+
+            lines = [item for item in items if isinstance(item, str)]
+            if lines:
+                try:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    with open(self.path, "a", encoding="utf-8") as file:
+                        file.write("".join(f"{line}\n" for line in lines))
+                except OSError:
+                    # Tracing must never break the research itself
+                    pass
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if any(item is None for item in items):
+                return
+
+
+class OpenTelemetrySpanExporter:
+    """
+    Mirrors the spans to OpenTelemetry (requires `pip install opentelemetry-api` and a configured tracer provider,
+    e.g. from `opentelemetry-sdk` with an OTLP exporter - otherwise OpenTelemetry silently drops the spans).
+    """
+
+    def __init__(self, instrumentation_name: str = "web_research") -> None:
+        from opentelemetry import trace  # pylint: disable=import-outside-toplevel
+
+        self._trace = trace
+        self._tracer = trace.get_tracer(instrumentation_name)
+        self._otel_spans: dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, span: Span) -> None:
+        with self._lock:
+            parent = self._otel_spans.get(span.parent_id) if span.parent_id else None
+        otel_span = self._tracer.start_span(
+            span.name,
+            context=self._trace.set_span_in_context(parent) if parent is not None else None,
+            start_time=int(span.start_time * 1e9),
+        )
+        with self._lock:
+            self._otel_spans[span.span_id] = otel_span
+
+    def on_end(self, span: Span) -> None:
+        with self._lock:
+            otel_span = self._otel_spans.get(span.span_id)
+        if otel_span is None:
+            return
+        for key, value in span.attributes.items():
+            if isinstance(value, (str, bool, int, float)):
+                otel_span.set_attribute(key, value)
+        otel_span.set_attribute("queue_wait_sec", span.queue_wait_sec)
+        if span.error:
+            otel_span.set_attribute("error", span.error)
+        otel_span.end(end_time=int(span.end_time * 1e9))
+
+    def forget_trace(self, span_ids: list[str]) -> None:
+        with self._lock:
+            for span_id in span_ids:
+                self._otel_spans.pop(span_id, None)
+
+
+class Tracer:
+    def __init__(self, exporters: Optional[list[Any]] = None, enabled: bool = True) -> None:
+        self.exporters = list(exporters or [])
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._spans_by_trace: dict[str, list[Span]] = {}
+
+    @contextmanager
+    def span(self, name: str, new_trace: bool = False, **attributes: Any) -> Iterator[Span]:
+        """
+        Measure the `with` block as a span. The span becomes a child of the current span, unless `new_trace` is True
+        (or there is no current span), in which case a new trace is started.
+        """
+        parent = None if new_trace else _current_span.get()
+        span = Span(
+            name,
+            trace_id=parent.trace_id if parent else uuid.uuid4().hex,
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes,
+        )
+        if not self.enabled:
+            yield span
+            return
+
+        with self._lock:
+            if parent is None:
+                self._spans_by_trace[span.trace_id] = [span]
+                kept = True
+            else:
+                trace_spans = self._spans_by_trace.get(span.trace_id)
+                kept = trace_spans is not None
+                if kept:
+                    trace_spans.append(span)
+        for exporter in self.exporters:
+            exporter.on_start(span)
+
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.error = f"{type(exc).__name__}: {exc}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_time = time.time()
+            for exporter in self.exporters:
+                exporter.on_end(span)
+            if parent is None:
+                # The root span is over, and so is the run (whether it succeeded, failed or was cancelled) - the spans
+                # of its trace are not needed anymore
+                self.release_trace(span.trace_id)
+            elif not kept:
+                # The span outlived the root span of its trace
+                self._forget_spans([span])
+
+    @asynccontextmanager
+    async def aspan(self, name: str, new_trace: bool = False, **attributes: Any) -> AsyncIterator[Span]:
+        """
+        The same as `span`, but for `async with` statements (so that it can be combined with other asynchronous
+        context managers, e.g. `async with tracer.aspan("extract"), scheduler.aslot("llm"): ...` - in this order the
+        time spent waiting for the slot is attributed to the span).
+        """
+        with self.span(name, new_trace=new_trace, **attributes) as span:
+            yield span
+
+    def traced(
+        self, name: str, new_trace: bool = False, attributes_from: tuple[str, ...] = ()
+    ) -> Callable[[Callable[..., Awaitable[T]]], Callable[..., Awaitable[T]]]:
+        """
+        Decorator that measures every call of an async function (e.g. an agent) as a span. The keyword arguments of
+        the call that are listed in `attributes_from` become the attributes of the span.
+        """
+
+        def _decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+            @wraps(func)
+            async def _traced_func(*args: Any, **kwargs: Any) -> T:
+                attributes = {key: kwargs[key] for key in attributes_from if key in kwargs}
+                with self.span(name, new_trace=new_trace, **attributes):
+                    return await func(*args, **kwargs)
+
+            return _traced_func
+
+        return _decorator
+
+    def summarize(self, trace_id: str) -> dict[str, Any]:
+        with self._lock:
+            spans = list(self._spans_by_trace.get(trace_id, ()))
+        if not spans:
+            return {"type": "summary", "trace_id": trace_id, "spans": 0}
+
+        children: dict[Optional[str], list[Span]] = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+
+        # Agents often finish their own span while the work they triggered is still running, so a span is considered
+        # to last until the last of its descendants ends
+        subtree_end: dict[str, float] = {}
+
+        def _subtree_end(span: Span) -> float:
+            if span.span_id not in subtree_end:
+                subtree_end[span.span_id] = max(
+                    [span.end_time or time.time(), *(_subtree_end(child) for child in children.get(span.span_id, ()))]
+                )
+            return subtree_end[span.span_id]
+
+        root = min(children.get(None) or spans, key=lambda root_span: root_span.start_time)
+        critical_path: list[dict[str, Any]] = []
+
+        def _walk_critical_path(span: Span, depth: int) -> None:
+            critical_path.append(
+                {
+                    "name": span.name,
+                    "depth": depth,
+                    "start_offset_sec": round(span.start_time - root.start_time, 3),
+                    "end_offset_sec": round(_subtree_end(span) - root.start_time, 3),
+                    "duration_sec": round(span.duration_sec, 3),
+                    "queue_wait_sec": round(span.queue_wait_sec, 3),
+                    "attributes": span.attributes,
+                }
+            )
+            # Going backwards from the end: the child that finished last, then the child that finished last before
+            # that one started and so on (the children that ran in parallel with those didn't delay anything)
+            blocking_children = []
+            cursor = float("inf")
+            for child in sorted(children.get(span.span_id, ()), key=_subtree_end, reverse=True):
+                if _subtree_end(child) <= cursor + CONCURRENCY_TOLERANCE_SEC:
+                    blocking_children.append(child)
+                    cursor = child.start_time
+            for child in reversed(blocking_children):
+                _walk_critical_path(child, depth + 1)
+
+        _walk_critical_path(root, 0)
+
+        stages: dict[str, dict[str, Any]] = {}
+        for span in spans:
+            stage = stages.setdefault(span.name, {"count": 0, "total_sec": 0.0, "queue_wait_sec": 0.0, "errors": 0})
+            stage["count"] += 1
+            stage["total_sec"] = round(stage["total_sec"] + span.duration_sec, 3)
+            stage["queue_wait_sec"] = round(stage["queue_wait_sec"] + span.queue_wait_sec, 3)
+            stage["errors"] += bool(span.error)
+            for key, value in span.attributes.items():
+                if key.endswith(("_tokens", "_bytes")) and isinstance(value, (int, float)):
+                    stage[key] = stage.get(key, 0) + value
+
+        return {
+            "type": "summary",
+            "trace_id": trace_id,
+            "time": datetime.now(timezone.utc).isoformat(),
+            "wall_clock_sec": round(_subtree_end(root) - root.start_time, 3),
+            "spans": len(spans),
+            "critical_path": critical_path,
+            "stages": stages,
+        }
+
+    def export_summary(self, trace_id: str, **extra: Any) -> dict[str, Any]:
+        """
+        Write the summary of the trace (plus any `extra` information, e.g. cache statistics) to the exporters that
+        support it and forget the spans of the trace.
+        """
+        if not self.enabled:
+            return {}
+        summary = {**self.summarize(trace_id), **extra}
+        for exporter in self.exporters:
+            if hasattr(exporter, "write"):
+                exporter.write(summary)
+        self.release_trace(trace_id)
+        return summary
+
+    def release_trace(self, trace_id: str) -> None:
+        """
+        Forget the spans of the trace (the spans that are still open are exported when they end, but not kept).
+        """
+        with self._lock:
+            spans = self._spans_by_trace.pop(trace_id, [])
+        self._forget_spans(spans)
+
+    def close(self) -> None:
+        """
+        Flush and close the exporters (e.g. wait until the JSONL file has all the spans).
+        """
+        for exporter in self.exporters:
+            if hasattr(exporter, "close"):
+                exporter.close()
+
+    def _forget_spans(self, spans: list[Span]) -> None:
+        if not spans:
+            return
+        for exporter in self.exporters:
+            if hasattr(exporter, "forget_trace"):
+                exporter.forget_trace([span.span_id for span in spans])
@@ -1,69 +1,43 @@
 import asyncio
+import json
 import os
 import sys
-from typing import Any
-from concurrent.futures import ThreadPoolExecutor
+import time
+from contextlib import suppress
+from typing import Any, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from importlib.util import find_spec
 
 import httpx
 import miniagents
 
 # pylint: disable=wrong-import-order
 from dotenv import load_dotenv
-from markdownify import markdownify as md
 from selenium.webdriver import Remote, ChromeOptions
 from selenium.webdriver.chromium.remote_connection import ChromiumRemoteConnection
 from selenium.webdriver.remote.client_config import ClientConfig
 
-load_dotenv()
+from budget import RunBudget
+from cache import ContentCache, normalize_query, normalize_url
+from content_extraction import html_to_markdown, pdf_to_markdown
+from dedup import simhash
+from driver_pool import BrowserSessionPool
+from fetch_tiers import (
+    PDF_CONTENT_TYPE,
+    TEXT_CONTENT_TYPES,
+    PageTierMemory,
+    reason_to_escalate_content,
+    reason_to_escalate_response,
+)
+from http_clients import HttpClientManager
+from plan_cache import PlanCache
+from replay import ReplaySession
+from retrying import LatencyTracker, ahedged
+from scheduler import Priority, StageBudget, StageScheduler
+from tracing import JsonlSpanExporter, OpenTelemetrySpanExporter, Tracer, add_to_span_attribute, set_span_attribute
 
 EXPECTED_MINIAGENTS_VERSION = (0, 0, 31)
 
-BRIGHTDATA_SERP_API_CREDS = os.environ["BRIGHTDATA_SERP_API_CREDS"]
-BRIGHTDATA_SCRAPING_BROWSER_CREDS = os.environ["BRIGHTDATA_SCRAPING_BROWSER_CREDS"]
-
-BRIGHT_DATA_TIMEOUT = 20
-
-# Allow only a limited number of concurrent web searches
-searching_semaphore = asyncio.Semaphore(5)
-# Allow only a limited number of concurrent web page scrapings
-scraping_thread_pool = ThreadPoolExecutor(max_workers=4)
-
-
-async def fetch_google_search(query: str) -> dict[str, Any]:
-    async with searching_semaphore:
-        async with httpx.AsyncClient(
-            proxy=f"https://{BRIGHTDATA_SERP_API_CREDS}@brd.superproxy.io:33335",
-            verify=False,
-            timeout=BRIGHT_DATA_TIMEOUT,
-        ) as client:
-            response = await client.get(f"https://www.google.com/search?q={query}&brd_json=1")
-
-    return response.json()
-
-
-async def scrape_web_page(url: str) -> str:
-    def _scrape_web_page_sync(url: str) -> str:
-        client_config = ClientConfig(
-            remote_server_addr="https://brd.superproxy.io:9515",
-            username=BRIGHTDATA_SCRAPING_BROWSER_CREDS.split(":")[0],
-            password=BRIGHTDATA_SCRAPING_BROWSER_CREDS.split(":")[1],
-            timeout=BRIGHT_DATA_TIMEOUT,
-        )
-        sbr_connection = ChromiumRemoteConnection(
-            client_config.remote_server_addr,
-            "goog",
-            "chrome",
-            client_config=client_config,
-        )
-        with Remote(sbr_connection, options=ChromeOptions()) as driver:
-            driver.get(url)
-            return driver.page_source
-
-    loop = asyncio.get_running_loop()
-    # Selenium does not support asyncio, so we need to run it in a thread pool
-    page_source = await loop.run_in_executor(scraping_thread_pool, _scrape_web_page_sync, url)
-    return md(page_source)
-
 
 def check_miniagents_version():
     try:
@@ -86,3 +60,391 @@ def check_miniagents_version():
             "Please update MiniAgents with `pip install -U miniagents`\n"
         )
         sys.exit(1)
+
+
+# The version is checked as soon as this module is imported, before anything is imported from MiniAgents (an
+# incompatible version would otherwise fail on one of those imports with a far less clear error)
+check_miniagents_version()
+
+# pylint: disable=wrong-import-position
+from miniagents import MiniAgents
+
+load_dotenv()
+
+BRIGHTDATA_SERP_API_CREDS = os.environ["BRIGHTDATA_SERP_API_CREDS"]
+BRIGHTDATA_SCRAPING_BROWSER_CREDS = os.environ["BRIGHTDATA_SCRAPING_BROWSER_CREDS"]
+# Can be pointed to a local fake proxy (e.g. one that injects failures and delays) for testing
+BRIGHTDATA_SERP_API_PROXY = os.environ.get(
+    "BRIGHTDATA_SERP_API_PROXY", f"https://{BRIGHTDATA_SERP_API_CREDS}@brd.superproxy.io:33335"
+)
+# Can be pointed to a local Selenium server (e.g. http://localhost:4444) for testing
+SCRAPING_BROWSER_URL = os.environ.get("SCRAPING_BROWSER_URL", "https://brd.superproxy.io:9515")
+
+BRIGHT_DATA_TIMEOUT = 20
+# The remote browser gives up on a page (or a script) after this long. It is shorter than the timeout of the WebDriver
+# commands (`BRIGHT_DATA_TIMEOUT`) and, together with the WebDriver handshake, than the timeout of a scraping attempt
+# (see `SCRAPE_RETRY_POLICY` in `web_research.py`), so a scraping thread is never left behind by a timed out attempt.
+BROWSER_PAGE_LOAD_TIMEOUT = 15
+# Pages are fetched with a plain HTTP GET first and are only scraped with the remote browser if that doesn't work out
+# (see `fetch_tiers.py`). Set the WEB_RESEARCH_PLAIN_HTTP environment variable to "false" to always use the browser.
+PLAIN_HTTP_FETCHING = os.environ.get("WEB_RESEARCH_PLAIN_HTTP", "").lower() not in ("0", "false", "no")
+PLAIN_HTTP_TIMEOUT = 10
+# The body of a plain HTTP response is read up to this size (the rest is dropped, the markdown of the page would be
+# truncated long before anyway - see `MAX_PAGE_MARKDOWN_CHARS`)
+MAX_PLAIN_HTTP_BODY_BYTES = 5_000_000
+PLAIN_HTTP_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/pdf;q=0.9,text/plain;q=0.8,*/*;q=0.5",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Concurrency budgets of the stages of the pipeline (see `scheduler.py`). They can be overridden per deployment with
+# the WEB_RESEARCH_STAGE_BUDGETS environment variable, e.g.: {"llm": {"initial": 16, "max": 64}}
+STAGE_BUDGETS = {
+    "search": StageBudget(initial=5, min=1, max=10, target_latency_sec=10),
+    "fetch": StageBudget(initial=8, min=2, max=32, target_latency_sec=10),
+    "scrape": StageBudget(initial=4, min=1, max=8, target_latency_sec=40),
+    "llm": StageBudget(initial=8, min=1, max=32),
+}
+for _stage, _budget_overrides in json.loads(os.environ.get("WEB_RESEARCH_STAGE_BUDGETS") or "{}").items():
+    # Validated (unlike `model_copy(update=...)`), so a bad value fails right away rather than deep in the scheduler
+    STAGE_BUDGETS[_stage] = StageBudget.model_validate(
+        {**(STAGE_BUDGETS[_stage].model_dump() if _stage in STAGE_BUDGETS else {}), **_budget_overrides}
+    )
+
+MAX_CONCURRENT_SEARCHES_PER_HOST = STAGE_BUDGETS["search"].max
+MAX_CONCURRENT_SCRAPINGS = STAGE_BUDGETS["scrape"].max
+# Web pages are converted to markdown of at most this size (the rest of the page is dropped). Long pages are processed
+# in chunks later (see `page_scraper_agent` in `web_research.py`).
+MAX_PAGE_MARKDOWN_CHARS = 200_000
+# Recycle a remote browser session after this many pages (a fresh session gets a fresh fingerprint/IP)
+MAX_PAGES_PER_BROWSER_SESSION = 20
+
+# Set the WEB_RESEARCH_REPLAY environment variable to "record" to save the responses of the SERP API, the scraping
+# browser and OpenAI as fixtures, or to "replay" to serve them from those fixtures instead of the network (see
+# `replay.py` and `benchmarks/bench_pipeline.py`)
+replay_session = ReplaySession(
+    os.environ.get("WEB_RESEARCH_REPLAY") or None,
+    os.environ.get("WEB_RESEARCH_FIXTURES_DIR", os.path.join("benchmarks", "fixtures", "recorded")),
+)
+
+# Every web search, page scraping and LLM call runs within the (adaptive) concurrency budget of its stage
+scheduler = StageScheduler(STAGE_BUDGETS)
+# Latencies of the recent web searches (to decide when to hedge a slow one)
+search_latency = LatencyTracker()
+
+# Connections to the SERP API proxy (and through it) are kept alive and reused across searches. Set the
+# WEB_RESEARCH_HTTP2 environment variable to "true" to use HTTP/2 where possible (requires `pip install h2`).
+http_client_manager = HttpClientManager(
+    max_connections=20,
+    max_keepalive_connections=MAX_CONCURRENT_SEARCHES_PER_HOST,
+    keepalive_expiry=60,
+    # Never allow more concurrent requests to the same host than the search stage could possibly allow
+    max_concurrency_per_host=MAX_CONCURRENT_SEARCHES_PER_HOST,
+    http2=os.environ.get("WEB_RESEARCH_HTTP2", "").lower() in ("1", "true", "yes"),
+    timeout=BRIGHT_DATA_TIMEOUT,
+    transport_wrapper=replay_session.transport_wrapper("serp"),
+)
+# Plain HTTP GETs of web pages go directly to the sites (no proxy), not more than 2 at a time per site
+page_http_client_manager = HttpClientManager(
+    max_connections=STAGE_BUDGETS["fetch"].max,
+    max_keepalive_connections=2,
+    keepalive_expiry=30,
+    timeout=PLAIN_HTTP_TIMEOUT,
+    transport_wrapper=replay_session.transport_wrapper("http_page"),
+)
+# Which domains need the remote browser and which ones don't
+page_tier_memory = PageTierMemory()
+# The actual number of concurrent web page scrapings is controlled by the scheduler
+scraping_thread_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_SCRAPINGS)
+# HTML to markdown conversion is CPU-bound, so it is done in separate processes (not to block the event loop)
+content_extraction_process_pool = ProcessPoolExecutor(max_workers=min(MAX_CONCURRENT_SCRAPINGS, os.cpu_count() or 1))
+
+
+def _create_scraping_browser_driver() -> Remote:
+    username, password = BRIGHTDATA_SCRAPING_BROWSER_CREDS.split(":", 1)
+    client_config = ClientConfig(
+        remote_server_addr=SCRAPING_BROWSER_URL,
+        username=username,
+        password=password,
+        timeout=BRIGHT_DATA_TIMEOUT,
+    )
+    sbr_connection = ChromiumRemoteConnection(
+        client_config.remote_server_addr,
+        "goog",
+        "chrome",
+        client_config=client_config,
+    )
+    driver = Remote(sbr_connection, options=ChromeOptions())
+    driver.set_page_load_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+    driver.set_script_timeout(BROWSER_PAGE_LOAD_TIMEOUT)
+    return driver
+
+
+# Search results and scraped pages are cached on disk across runs. Set the WEB_RESEARCH_CACHE environment variable to
+# "false" to disable the cache.
+content_cache = ContentCache(
+    os.path.join(os.environ.get("WEB_RESEARCH_CACHE_DIR", ".web_research_cache"), "content.sqlite3"),
+    ttls={
+        "serp": 24 * 60 * 60,  # search results get stale quickly
+        "page": 7 * 24 * 60 * 60,
+        "extraction": 30 * 24 * 60 * 60,  # see `extraction_cache.py`
+    },
+    max_bytes=512 * 1024 * 1024,
+    enabled=os.environ.get("WEB_RESEARCH_CACHE", "").lower() not in ("0", "false", "no"),
+)
+# Research plans of past questions, looked up by the similarity of the questions (see `plan_cache.py`). Plans older
+# than a week are not reused.
+plan_cache = PlanCache(
+    os.path.join(os.environ.get("WEB_RESEARCH_CACHE_DIR", ".web_research_cache"), "plans.sqlite3"),
+    ttl=7 * 24 * 60 * 60,
+    enabled=content_cache.enabled,
+)
+
+# Every run of the research pipeline is traced (see `tracing.py`): the spans of its stages and a summary of the run are
+# appended to a JSONL file. Set the WEB_RESEARCH_TRACING environment variable to "false" to disable tracing and
+# WEB_RESEARCH_OTEL to "true" to also send the spans to OpenTelemetry (requires `pip install opentelemetry-api`).
+_span_exporters: list[Any] = [
+    JsonlSpanExporter(os.environ.get("WEB_RESEARCH_TRACE_FILE", os.path.join("traces", "web_research.jsonl")))
+]
+if os.environ.get("WEB_RESEARCH_OTEL", "").lower() in ("1", "true", "yes"):
+    _span_exporters.append(OpenTelemetrySpanExporter())
+tracer = Tracer(
+    _span_exporters,
+    enabled=os.environ.get("WEB_RESEARCH_TRACING", "").lower() not in ("0", "false", "no"),
+)
+
+# Warm remote browser sessions shared by all the scrapings (one session per scraping thread is enough)
+browser_session_pool = BrowserSessionPool(
+    replay_session.driver_factory(_create_scraping_browser_driver),
+    size=MAX_CONCURRENT_SCRAPINGS,
+    max_pages_per_session=MAX_PAGES_PER_BROWSER_SESSION,
+)
+
+
+async def fetch_google_search(
+    query: str, priority: Priority = Priority.NORMAL, budget: Optional[RunBudget] = None
+) -> dict[str, Any]:
+    cache_key = normalize_query(query)
+    cached = await content_cache.aget("serp", cache_key)
+    set_span_attribute("cached", cached is not None)
+    if cached is not None:
+        return json.loads(cached)
+
+    # If the search takes longer than 95% of the previous ones did, a duplicate request is sent and the first
+    # response wins (see `retrying.py`)
+    hedge_after_sec = search_latency.percentile(95)
+    started_at = time.monotonic()
+    if hedge_after_sec is None:
+        search_results = await _afetch_google_search_uncached(query, priority, budget)
+    else:
+        search_results = await ahedged(
+            lambda: _afetch_google_search_uncached(query, priority, budget), hedge_after_sec
+        )
+    search_latency.record(time.monotonic() - started_at)
+
+    await content_cache.aset("serp", cache_key, json.dumps(search_results))
+    return search_results
+
+
+async def _afetch_google_search_uncached(
+    query: str, priority: Priority, budget: Optional[RunBudget]
+) -> dict[str, Any]:
+    url = "https://www.google.com/search"
+    client = http_client_manager.get_client(proxy=BRIGHTDATA_SERP_API_PROXY, verify=False)
+    async with scheduler.aslot("search", priority), http_client_manager.ahost_slot(url):
+        if budget is not None:
+            # Every request is paid for (including the hedged duplicates and the failed attempts)
+            budget.record_paid_request()
+        response = await client.get(url, params={"q": query, "brd_json": 1})
+        if response.is_success:
+            scheduler.observe_response("search", response.status_code, response.headers)
+        else:
+            # Let the caller decide whether to retry (see `retrying.py`), the scheduler will take the failure into
+            # account as well
+            response.raise_for_status()
+    add_to_span_attribute("fetched_bytes", len(response.content))
+    return response.json()
+
+
+async def scrape_web_page(url: str, priority: Priority = Priority.NORMAL, budget: Optional[RunBudget] = None) -> str:
+    cache_key = normalize_url(url)
+    cached = await content_cache.aget("page", cache_key)
+    set_span_attribute("cached", cached is not None)
+    if cached is not None:
+        return cached
+
+    page_content = None
+    if PLAIN_HTTP_FETCHING and page_tier_memory.should_try_http(url):
+        page_content = await _afetch_web_page_over_http(url, priority)
+    if page_content is None:
+        set_span_attribute("tier", "browser")
+        if budget is not None:
+            # Plain HTTP fetches are free, the remote browser is not
+            budget.record_paid_request()
+        page_content = await _ascrape_web_page_with_browser(url, priority)
+
+    await content_cache.aset("page", cache_key, page_content)
+    return page_content
+
+
+async def _afetch_web_page_over_http(url: str, priority: Priority) -> Optional[str]:
+    """
+    Fetch a web page with a plain HTTP GET and convert it to markdown. None if the page needs the remote browser.
+    """
+    loop = asyncio.get_running_loop()
+    client = page_http_client_manager.get_client()
+    page_content = None
+    try:
+        async with scheduler.aslot("fetch", priority), page_http_client_manager.ahost_slot(url):
+            async with client.stream("GET", url, headers=PLAIN_HTTP_HEADERS, follow_redirects=True) as response:
+                body, truncated = await _aread_capped_body(response, MAX_PLAIN_HTTP_BODY_BYTES)
+    except httpx.HTTPError as exc:
+        reason = type(exc).__name__
+    else:
+        add_to_span_attribute("fetched_bytes", len(body))
+        content_type = response.headers.get("content-type", "").lower()
+        reason = reason_to_escalate_response(response.status_code, content_type, len(body))
+        if reason is None and content_type.startswith(PDF_CONTENT_TYPE):
+            if truncated:
+                # Unlike HTML, a PDF document can't be parsed from its beginning alone
+                reason = "pdf too large"
+            elif find_spec("pypdf") is None:
+                reason = "pdf (pypdf is not installed)"
+            else:
+                try:
+                    page_content = await loop.run_in_executor(
+                        content_extraction_process_pool, pdf_to_markdown, body, MAX_PAGE_MARKDOWN_CHARS
+                    )
+                except Exception:  # pylint: disable=broad-exception-caught
+                    page_content = None
+                reason = None if page_content else "pdf without text"
+        elif reason is None:
+            markup = _decode_body(body, response.encoding)
+            page_content = (
+                markup[:MAX_PAGE_MARKDOWN_CHARS]
+                if content_type.startswith(TEXT_CONTENT_TYPES)
+                else await loop.run_in_executor(
+                    content_extraction_process_pool, html_to_markdown, markup, MAX_PAGE_MARKDOWN_CHARS
+                )
+            )
+            reason = reason_to_escalate_content(markup, page_content)
+
+    if reason is not None:
+        page_tier_memory.record_http_failure(url)
+        set_span_attribute("escalated", reason)
+        return None
+    page_tier_memory.record_http_success(url)
+    set_span_attribute("tier", "http")
+    return page_content
+
+
+async def _aread_capped_body(response: httpx.Response, max_bytes: int) -> tuple[bytes, bool]:
+    """
+    Read the body of a streamed response, but not more than `max_bytes` of it. Returns the body and whether it was
+    truncated.
+    """
+    chunks = []
+    size = 0
+    async for chunk in response.aiter_bytes():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_bytes:
+            return b"".join(chunks)[:max_bytes], True
+    return b"".join(chunks), False
+
+
+def _decode_body(body: bytes, encoding: Optional[str]) -> str:
+    try:
+        return body.decode(encoding or "utf-8", errors="replace")
+    except LookupError:
+        # The page declares a charset that Python doesn't know
+        return body.decode("utf-8", errors="replace")
+
+
+async def _ascrape_web_page_with_browser(url: str, priority: Priority) -> str:
+    def _scrape_web_page_sync(url: str) -> str:
+        # A session that fails here is not returned to the pool - it gets replaced with a fresh one
+        with browser_session_pool.lease() as driver:
+            driver.get(url)
+            return driver.page_source
+
+    loop = asyncio.get_running_loop()
+    async with scheduler.aslot("scrape", priority):
+        # Selenium does not support asyncio, so we need to run it in a thread pool
+        scraping = loop.run_in_executor(scraping_thread_pool, _scrape_web_page_sync, url)
+        try:
+            page_source = await asyncio.shield(scraping)
+        except asyncio.CancelledError:
+            # The thread can't be cancelled (e.g. when an attempt times out) and keeps its browser session leased
+            # until the page is loaded or `BROWSER_PAGE_LOAD_TIMEOUT` passes - the slot is held until then too, so the
+            # scraping stage never has more browser sessions busy than its budget allows (and a retry doesn't start
+            # while the previous attempt still holds a session)
+            with suppress(Exception):
+                await scraping
+            raise
+    add_to_span_attribute("fetched_bytes", len(page_source.encode("utf-8")))
+    return await loop.run_in_executor(
+        content_extraction_process_pool, html_to_markdown, page_source, MAX_PAGE_MARKDOWN_CHARS
+    )
+
+
+async def fingerprint_page_content(page_content: str) -> int:
+    # SimHash of a long page takes a while to compute, so it is done in a separate process (see `dedup.py`)
+    return await asyncio.get_running_loop().run_in_executor(content_extraction_process_pool, simhash, page_content)
+
+
+def export_trace_summary(trace_id: str, **extra: Any) -> dict[str, Any]:
+    """
+    Write the summary of a traced run (critical path, totals per stage) together with the current statistics of the
+    shared resources and any `extra` statistics of the run (see `tracing.py`).
+    """
+    return tracer.export_summary(
+        trace_id,
+        scheduler=scheduler.stats(),
+        cache=content_cache.stats(),
+        plan_cache=plan_cache.stats(),
+        browser_sessions=browser_session_pool.stats(),
+        fetch_tiers=page_tier_memory.stats(),
+        **extra,
+    )
+
+
+def warm_up_scraping_browser() -> None:
+    """
+    Start opening a remote browser session in the background (doesn't block), so it is ready by the time the first
+    page needs to be scraped. Remote browser sessions are paid for, so only one is opened, and only if every page goes
+    to the browser - when pages are fetched over plain HTTP first, most runs never need the browser, and the sessions
+    are opened on demand by the pages that do.
+    """
+    if not PLAIN_HTTP_FETCHING:
+        scraping_thread_pool.submit(browser_session_pool.warm_up, 1)
+
+
+async def aclose_shared_resources() -> None:
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(
+        http_client_manager.aclose(),
+        page_http_client_manager.aclose(),
+        loop.run_in_executor(scraping_thread_pool, browser_session_pool.close),
+        # Waits for the background writes of the spans
+        asyncio.to_thread(tracer.close),
+    )
+    content_cache.close()
+    plan_cache.close()
+    content_extraction_process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+class WebResearchMiniAgents(MiniAgents):
+    """
+    `MiniAgents` context that also releases the resources shared by all the agents (remote browser sessions etc.)
+    once all the agents are done.
+    """
+
+    async def afinalize(self) -> None:
+        try:
+            await super().afinalize()
+        finally:
+            await aclose_shared_resources()
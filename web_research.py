@@ -12,29 +12,112 @@ Please refer to the README.md of this repository to learn how to run the applica
 """
 
 import asyncio
+import os
+from contextlib import suppress
 from datetime import datetime
-from typing import Union
+from typing import Any, Optional, Union
 
+import httpx
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 from pydantic import BaseModel
 
-from utils import check_miniagents_version, fetch_google_search, scrape_web_page
-
-check_miniagents_version()
-
-# pylint: disable=wrong-import-position
-from miniagents import AgentCall, InteractionContext, Message, MessageSequencePromise, MiniAgents, miniagent
-from miniagents.ext.llms import OpenAIAgent, aprepare_dicts_for_openai
+from budget import BudgetExhaustedError, BudgetLimits, RunBudget
+from cache import normalize_query
+from chunking import count_tokens, split_into_token_chunks
+from dedup import DedupRegistry
+from extraction_cache import ExtractionCache
+from retrying import LatencyTracker, RetryPolicy, aretry
+from serp import format_search_results, parse_organic_results, rank_search_results
+from tracing import Span, add_to_span_attribute, set_span_attribute
+from utils import (
+    Priority,
+    WebResearchMiniAgents,
+    content_cache,
+    export_trace_summary,
+    fetch_google_search,
+    fingerprint_page_content,
+    plan_cache,
+    replay_session,
+    scheduler,
+    scrape_web_page,
+    tracer,
+    warm_up_scraping_browser,
+)
+
+# Importing `utils` above has checked the version of MiniAgents (see `check_miniagents_version`), so it is safe to
+# import things from MiniAgents now (`synthesis` imports from it too)
+# pylint: disable=wrong-import-position,wrong-import-order
+from miniagents import AgentCall, InteractionContext, Message, MessageSequencePromise, TextMessage, miniagent
+from miniagents.ext.llms import OpenAIAgent, OpenAIMessage, aprepare_dicts_for_openai
+
+from synthesis import FactSheet, SynthesisPolicy
 
 load_dotenv()
 
 MODEL = "gpt-4o-mini"  # "gpt-4o"
 SMARTER_MODEL = "o4-mini"  # "o3"
+# Facts are extracted with this model instead of `MODEL` when the budget of the run is running low (see `budget.py`)
+CHEAPER_MODEL = "gpt-4.1-nano"
 MAX_WEB_PAGES_PER_SEARCH = 2
-SLEEP_BEFORE_RETRY_SEC = 5
+# Only this many search results (the most relevant ones, see `serp.py`) are shown to the LLM that picks the pages
+MAX_SEARCH_RESULTS_FOR_SELECTION = 8
+# Retries with exponential backoff and jitter (see `retrying.py`). Slow Structured Output calls are also "hedged" - a
+# duplicate request is sent if the original one takes longer than 95% of the previous ones did (web searches are
+# hedged in a similar way in `utils.py`).
+SEARCH_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay_sec=0.5, attempt_timeout_sec=30, deadline_sec=60)
+SCRAPE_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay_sec=1, attempt_timeout_sec=60, deadline_sec=150)
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=3, base_delay_sec=1, attempt_timeout_sec=120, deadline_sec=240)
+# Web pages that are longer than this (in tokens of the model that does the extraction) are split into chunks, facts
+# are extracted from the chunks in parallel and then merged into a single summary
+CHUNK_TOKEN_BUDGETS = {
+    MODEL: 12_000,
+    SMARTER_MODEL: 24_000,
+    CHEAPER_MODEL: 12_000,
+}
+MAX_CONCURRENT_CHUNK_EXTRACTIONS = 3
+# Stop extracting facts from the remaining chunks of a page once this many chunks turned out to be relevant
+ENOUGH_RELEVANT_CHUNKS = 4
+NO_RELEVANT_FACTS = "NO RELEVANT FACTS"
+# "exact" - reuse a cached page extraction only if it was made for the same rationale, "same_page" - also reuse
+# extractions of the same page made for similar questions (see `extraction_cache.py`)
+EXTRACTION_REUSE_POLICY = os.environ.get("WEB_RESEARCH_EXTRACTION_REUSE", "exact")
+# "complete" - the final answer waits for all the pages. "incremental" - it starts once most of the pages are summarized
+# instead of waiting for the slowest one, the summaries that arrive later are appended to the answer (an extra LLM
+# call - see `synthesis.py`).
+SYNTHESIS_POLICY = SynthesisPolicy(mode=os.environ.get("WEB_RESEARCH_SYNTHESIS", "complete"))
+# When a similar question was researched recently, its web searches can be started while the new plan is still being
+# generated (see `plan_cache.py`). The ones that don't make it into the new plan are wasted (and paid for), hence off
+# by default.
+SPECULATIVE_SEARCHES = os.environ.get("WEB_RESEARCH_SPECULATIVE_SEARCHES", "").lower() in ("1", "true", "yes")
+# The default budget of a research run (no limits unless these environment variables are set). `server.py` accepts
+# budgets per question too.
+DEFAULT_BUDGET_LIMITS = BudgetLimits(
+    deadline_sec=os.environ.get("WEB_RESEARCH_DEADLINE_SEC") or None,
+    max_tokens=os.environ.get("WEB_RESEARCH_MAX_TOKENS") or None,
+    max_paid_requests=os.environ.get("WEB_RESEARCH_MAX_PAID_REQUESTS") or None,
+)
+NOTHING_TO_ADD = "NOTHING TO ADD"
+
+
+async def _observe_openai_response(response: httpx.Response) -> None:
+    # Let the scheduler adapt the concurrency of LLM calls to the rate limits of OpenAI (see `scheduler.py`)
+    scheduler.observe_response("llm", response.status_code, response.headers, response)
+
+
+openai_client = AsyncOpenAI(
+    http_client=DefaultAsyncHttpxClient(
+        event_hooks={"response": [_observe_openai_response]},
+        # Records or replays the LLM calls if requested (see `replay.py`), the default transport otherwise
+        transport=replay_session.httpx_transport("llm", client_class=DefaultAsyncHttpxClient),
+    )
+)
+# A version of the built-in `OpenAIAgent` that uses the same client as the rest of the app (clients can't be passed
+# to `trigger` because they are not "freezable", hence `non_freezable_kwargs`)
+openai_agent = OpenAIAgent.fork(non_freezable_kwargs={"async_client": openai_client})
+extraction_cache = ExtractionCache(content_cache, reuse_policy=EXTRACTION_REUSE_POLICY)
 
-openai_client = AsyncOpenAI()
+structured_output_latency = LatencyTracker()
 
 
 async def main():
@@ -68,7 +151,8 @@ async def main():
     # This is because all the agents communicate everything back here, including their progress and their failures.
     # None of the agents declared in this file print anything to the console on their own! In future examples I will
     # demonstrate how easy it is to swap the UI as a consequence of this design (or even connect this whole agentic
-    # system to another, bigger AI system instead of exposing it to the user directly).
+    # system to another, bigger AI system instead of exposing it to the user directly). `server.py` in this repository
+    # is one such example - it streams the very same messages to HTTP clients instead of the console.
     #
     # NOTE #2: Even though we are consuming the promises in the loops above explicitly, this is not strictly required
     # for the agents to start their work in the background. By default, they will start in the background regardless of
@@ -85,49 +169,135 @@ async def main():
     # In the majority of scenarios there is hardly any benefit in setting `start_soon` to False for anything.
 
 
+# Every research is a separate trace (see `tracing.py`). The agents that are triggered by a traced agent inherit its
+# span, so their own spans are nested under it automatically.
 @miniagent
-async def research_agent(ctx: InteractionContext) -> None:
+@tracer.traced("research", new_trace=True, attributes_from=("deadline_sec", "max_tokens", "max_paid_requests"))
+async def research_agent(
+    ctx: InteractionContext,
+    deadline_sec: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    max_paid_requests: Optional[int] = None,
+) -> None:
     ctx.reply("RESEARCHING...")
 
-    # First, analyze the user's question and break it down into search queries
-    message_dicts = await aprepare_dicts_for_openai(
-        ctx.message_promises,
-        system=(
-            "Your job is to breakdown the user's question into a list of web searches that need to be done to answer "
-            "the question. Please try to optimize your search queries so there aren't too many of them. Current date "
-            "is " + datetime.now().strftime("%Y-%m-%d")
-        ),
-    )
-    # There is no built-in miniagent for OpenAI's Structured Output feature (yet), so we will use OpenAI's client
-    # library directly
-    response = await openai_client.beta.chat.completions.parse(
-        model=SMARTER_MODEL,
-        messages=message_dicts,
-        response_format=WebSearchesToBeDone,  # See the definition of this class at the bottom of this file
+    # The budget of this run (the limits that were not given are taken from `DEFAULT_BUDGET_LIMITS`). It is passed to
+    # all the other agents, so they can report what they spend and save when it runs low (see `budget.py`).
+    budget = RunBudget(
+        DEFAULT_BUDGET_LIMITS.model_copy(
+            update={
+                name: value
+                for name, value in (
+                    ("deadline_sec", deadline_sec),
+                    ("max_tokens", max_tokens),
+                    ("max_paid_requests", max_paid_requests),
+                )
+                if value is not None
+            }
+        )
     )
-    parsed: WebSearchesToBeDone = response.choices[0].message.parsed
+
+    # A remote browser session takes a while to open, let's start opening one while the question is being analyzed
+    # (if the browser is going to be needed at all - see `warm_up_scraping_browser` in `utils.py`)
+    warm_up_scraping_browser()
+
+    # First, analyze the user's question and break it down into search queries. Unless the same question was researched
+    # recently - then its plan is reused (a merely similar question's plan is only shown to the LLM as a starting point
+    # - see `plan_cache.py`).
+    question = "\n\n".join(str(message) for message in await ctx.message_promises)
+    speculative_searches: dict[str, asyncio.Task] = {}
+    with tracer.span("plan"):
+        plan_match = await plan_cache.alookup(question, SMARTER_MODEL)
+        cached_plan = None
+        if plan_match is not None:
+            set_span_attribute("plan_similarity", round(plan_match.similarity, 3))
+            cached_plan = WebSearchesToBeDone.model_validate_json(plan_match.plan)
+
+        if cached_plan is not None and plan_match.reusable:
+            set_span_attribute("plan_cache", "reused")
+            parsed = cached_plan
+        else:
+            system = (
+                "Your job is to breakdown the user's question into a list of web searches that need to be done to "
+                "answer the question. Please try to optimize your search queries so there aren't too many of them. "
+                "Current date is " + datetime.now().strftime("%Y-%m-%d")
+            )
+            if cached_plan is not None:
+                set_span_attribute("plan_cache", "seeded")
+                system += (
+                    "\n\nA similar question was researched recently:\n\n"
+                    + plan_match.question
+                    + "\n\nThese web searches were done for it:\n\n"
+                    + "\n".join(f"- {web_search.web_search_query}" for web_search in cached_plan.web_searches)
+                    + "\n\nReuse the ones that fit the user's question word for word, change or drop the ones that "
+                    "don't and add the ones that are missing."
+                )
+                if SPECULATIVE_SEARCHES:
+                    # Not awaited here - the searches run while the new plan is being generated
+                    speculative_searches = {
+                        normalize_query(web_search.web_search_query): asyncio.create_task(
+                            _aspeculative_search(web_search.web_search_query, budget)
+                        )
+                        for web_search in cached_plan.web_searches
+                    }
+            message_dicts = await aprepare_dicts_for_openai(ctx.message_promises, system=system)
+            # There is no built-in miniagent for OpenAI's Structured Output feature (yet), so we will use OpenAI's
+            # client library directly (see `_aparse_structured_output` below). Planning has a high priority, because
+            # nothing else can start before it is done.
+            try:
+                parsed: WebSearchesToBeDone = await _aparse_structured_output(
+                    ctx,
+                    message_dicts,
+                    WebSearchesToBeDone,  # See the definition of this class at the bottom of this file
+                    priority=Priority.HIGH,
+                    budget=budget,
+                )
+            except BaseException:
+                for speculative_search in speculative_searches.values():
+                    speculative_search.cancel()
+                raise
+            await plan_cache.aset(question, SMARTER_MODEL, parsed.model_dump_json())
+
+    if speculative_searches:
+        # The speculative searches that didn't make it into the new plan are not needed anymore
+        planned_queries = {normalize_query(web_search.web_search_query) for web_search in parsed.web_searches}
+        for query in list(speculative_searches):
+            if query not in planned_queries:
+                speculative_searches.pop(query).cancel()
+        set_span_attribute("speculative_searches_used", len(speculative_searches))
 
     ctx.reply(f"RUNNING {len(parsed.web_searches)} WEB SEARCHES")
 
-    already_picked_urls = set[str]()
+    dedup_registry = DedupRegistry()
     # Let's fork the `web_search_agent` to introduce mutable state - we want it to remember across multiple calls
-    # which urls were already picked for scraping, so it doesn't scrape them again (same pages may be present in
-    # multiple search results)
+    # which pages were already picked for scraping, so it doesn't scrape them again (same pages may be present in
+    # multiple search results, sometimes under slightly different urls - see `dedup.py`)
     _web_search_agent = web_search_agent.fork(
         non_freezable_kwargs={
-            "already_picked_urls": already_picked_urls,
+            "dedup_registry": dedup_registry,
+            "speculative_searches": speculative_searches,
+            "budget": budget,
         },
     )
 
     # We will initiate a call to the final answer agent because we will be collecting input for it as we go along
-    # (unlike `trigger`, `initiate_call` does not require all the input messages and/or promises upfront)
-    final_answer_call: AgentCall = final_answer_agent.initiate_call(
+    # (unlike `trigger`, `initiate_call` does not require all the input messages and/or promises upfront). It is
+    # forked too, because it reports how much work the deduplication saved and which sources were skipped because of
+    # the budget.
+    final_answer_call: AgentCall = final_answer_agent.fork(
+        non_freezable_kwargs={
+            "dedup_registry": dedup_registry,
+            "budget": budget,
+        },
+    ).initiate_call(
         # We will deliver the dialog with the user (which in this version of the app consists of only the user
         # question) to the `final_answer_agent` as a keyword argument, because the input sequence will be used to pass
         # the information found on the internet to answer the question. (Every miniagent receives a promise of the
         # input sequence of message promises, keyword arguments, and spews out a promise of the reply sequence of
         # message promises.)
         user_question=await ctx.message_promises,
+        # The final answer doesn't start before every web search picked its pages (see `synthesis.py`)
+        web_searches=len(parsed.web_searches),
     )
 
     # For each identified search query, trigger a web search
@@ -145,11 +315,10 @@ async def research_agent(ctx: InteractionContext) -> None:
         # to be part of the response sequence).
         ctx.reply_out_of_order(search_and_scraping_results)
 
-        # Send the (promises of) web search and scraping results to the final answer agent too.
-        # NOTE: We could use `send_out_of_order` instead of `send_message` here as well, but we don't really care one
-        # way or another - the `final_answer_agent` is designed to start its work only after all its input is available
-        # (all the incoming promises are resolved) anyway.
-        final_answer_call.send_message(search_and_scraping_results)
+        # Send the (promises of) web search and scraping results to the final answer agent too. Out of order, because
+        # the `final_answer_agent` collects the page summaries as soon as they are available (it doesn't necessarily
+        # wait for all of them before it starts answering - see `synthesis.py`).
+        final_answer_call.send_out_of_order(search_and_scraping_results)
 
     # Again, no `await` below. We are still exchanging promises. The agents that were called will start their work in
     # the background as soon as task switching happens.
@@ -158,34 +327,110 @@ async def research_agent(ctx: InteractionContext) -> None:
     # technically precise), also closes the call that was started with `initiate_call`. In other words, it "informs"
     # the agent that is being called that there will be no more input. We could change this behavior by adding the
     # following parameter if it was necessary: `.reply_sequence(finish_call=False)`
-    ctx.reply(final_answer_call.reply_sequence())
+    final_answer = final_answer_call.reply_sequence()
+    ctx.reply(final_answer)
+
+    # The span of this agent is the root span of the trace of the run - the spans of the run are kept in memory until
+    # it ends (see `tracing.py`), so it should last until the final answer is given. The answer (or its error) reaches
+    # the user through the reply above, there is no need to raise its error here as well.
+    with suppress(Exception):
+        await final_answer
+
+
+async def _aspeculative_search(search_query: str, budget: RunBudget) -> dict[str, Any]:
+    # The task is started within the "plan" span - without a span of its own, its attributes (and its time) would be
+    # attributed to the planning
+    async with tracer.aspan("speculative_search", search_query=search_query):
+        return await fetch_google_search(search_query, Priority.LOW, budget)
 
 
 @miniagent
+@tracer.traced("web_search", attributes_from=("search_query",))
 async def web_search_agent(
     ctx: InteractionContext,
     search_query: str,
     rationale: str,
-    already_picked_urls: set[str],
+    dedup_registry: DedupRegistry,
+    speculative_searches: dict[str, asyncio.Task],
+    budget: RunBudget,
 ) -> None:
+    pages_to_read = 0
+    try:
+        pages_to_read = await _asearch_and_pick_pages(
+            ctx, search_query, rationale, dedup_registry, speculative_searches, budget
+        )
+    finally:
+        # The `pages_to_read` field lets the `final_answer_agent` know that this web search is done picking pages (even
+        # if it failed) and how many pages it is going to read (see `synthesis.py`)
+        ctx.reply(
+            TextMessage(
+                f"{pages_to_read} PAGES TO READ FOR: {search_query}", pages_to_read=pages_to_read, not_for_user=True
+            )
+        )
+
+
+async def _asearch_and_pick_pages(
+    ctx: InteractionContext,
+    search_query: str,
+    rationale: str,
+    dedup_registry: DedupRegistry,
+    speculative_searches: dict[str, asyncio.Task],
+    budget: RunBudget,
+) -> int:
+    """
+    Do the web search, pick the pages to read and trigger their scraping. Returns the number of pages picked.
+    """
+    speculative_search = speculative_searches.pop(normalize_query(search_query), None)
+    if budget.exhausted and speculative_search is None:
+        budget.skip(f'web search "{search_query}"', "out of budget")
+        ctx.reply(f"SKIPPING SEARCH (OUT OF BUDGET): {search_query}")
+        return 0
+
     ctx.reply(f'SEARCHING FOR "{search_query}"\n{rationale}')
 
-    try:
-        # Execute the search query
-        search_results = await fetch_google_search(search_query)
-    except Exception:  # pylint: disable=broad-exception-caught
-        # Something went wrong upon the first attempt - let's give Bright Data SERP API a second chance...
-        await asyncio.sleep(SLEEP_BEFORE_RETRY_SEC)
-        ctx.reply(f"RETRYING SEARCH: {search_query}")
-        search_results = await fetch_google_search(search_query)
+    # Execute the search query (if something goes wrong, Bright Data SERP API will get a few more chances), unless it
+    # was already started speculatively (see `research_agent`)
+    with tracer.span("search"):
+        search_results = None
+        if speculative_search is not None:
+            set_span_attribute("speculative", True)
+            try:
+                search_results = await speculative_search
+            except Exception:  # pylint: disable=broad-exception-caught
+                # The regular search below gets its own chances
+                pass
+        if search_results is None:
+            search_results = await aretry(
+                lambda: fetch_google_search(search_query, budget=budget),
+                SEARCH_RETRY_POLICY,
+                on_retry=lambda attempt, error: ctx.reply(f"RETRYING SEARCH (ATTEMPT {attempt}): {search_query}"),
+            )
+
+    # Only the organic results are of interest (without the ads, knowledge panels etc.), and only the most relevant of
+    # them - the fewer tokens the LLM has to read, the sooner it picks the pages
+    organic_results = parse_organic_results(search_results)
+    top_results = rank_search_results(
+        organic_results, f"{search_query} {rationale}", max_results=MAX_SEARCH_RESULTS_FOR_SELECTION
+    )
+    set_span_attribute("results", len(organic_results))
+    if not top_results:
+        ctx.reply(f"NO SEARCH RESULTS: {search_query}")
+        return 0
 
     ctx.reply(f"SEARCH SUCCESSFUL: {search_query}")
 
+    if budget.exhausted:
+        # Picking the pages is an LLM call, and there would be no budget left to read them anyway
+        budget.skip(f'web search "{search_query}"', "out of budget")
+        ctx.reply(f"SKIPPING SEARCH RESULTS (OUT OF BUDGET): {search_query}")
+        return 0
+
     # Analyze search results to identify relevant web pages
     message_dicts = await aprepare_dicts_for_openai(
         [
             ctx.message_promises,
-            f"RATIONALE: {rationale}\n\nSEARCH QUERY: {search_query}\n\nSEARCH RESULTS:\n\n{search_results}",
+            f"RATIONALE: {rationale}\n\nSEARCH QUERY: {search_query}\n\nSEARCH RESULTS:\n\n"
+            + format_search_results(top_results),
         ],
         system=(
             "This is a user question that another AI agent (not you) will have to answer. Your job, however, is to "
@@ -195,21 +440,38 @@ async def web_search_agent(
         ),
     )
     # No built-in miniagent for OpenAI's Structured Output feature (yet), so we will use OpenAI's client directly
-    response = await openai_client.beta.chat.completions.parse(
-        model=SMARTER_MODEL,
-        messages=message_dicts,
-        response_format=WebPagesToBeRead,  # See the definition of this class at the bottom of this file
-    )
-    parsed: WebPagesToBeRead = response.choices[0].message.parsed
+    with tracer.span("select_urls"):
+        parsed: WebPagesToBeRead = await _aparse_structured_output(
+            ctx,
+            message_dicts,
+            WebPagesToBeRead,  # See the definition of this class at the bottom of this file
+            budget=budget,
+        )
 
-    # Filter out pages that were already picked for scraping and also limit the number of pages to be scraped
+    # Filter out pages that were already picked for scraping (under the same or an equivalent url) and also limit the
+    # number of pages to be scraped (as the budget runs low, fewer pages are read)
+    max_web_pages = budget.pages_per_search(MAX_WEB_PAGES_PER_SEARCH)
     web_pages_to_scrape: list[WebPage] = []
+    pages_over_budget = 0
     for web_page in parsed.web_pages:
-        if web_page.url not in already_picked_urls:
-            web_pages_to_scrape.append(web_page)
-            already_picked_urls.add(web_page.url)
-        if len(web_pages_to_scrape) >= MAX_WEB_PAGES_PER_SEARCH:
+        if len(web_pages_to_scrape) + pages_over_budget >= MAX_WEB_PAGES_PER_SEARCH:
             break
+        if len(web_pages_to_scrape) >= max_web_pages:
+            # Not claimed - another web search may still read this page
+            if not dedup_registry.is_claimed(web_page.url):
+                budget.skip(web_page.url, "budget running low")
+                pages_over_budget += 1
+        elif dedup_registry.claim_url(web_page.url):
+            web_pages_to_scrape.append(web_page)
+
+    # The scrapers share the registry too (to skip the pages whose content turns out to be a duplicate), and the
+    # budget of the run
+    _page_scraper_agent = page_scraper_agent.fork(
+        non_freezable_kwargs={
+            "dedup_registry": dedup_registry,
+            "budget": budget,
+        },
+    )
 
     # Trigger scraping for each identified web page (no `await` in front of `trigger`, so again, read this as "schedule
     # for parallel execution")
@@ -217,111 +479,412 @@ async def web_search_agent(
         # Return scraping results in order of their availability rather than sequentially (`reply_out_of_order`, see
         # more detailed explanation earlier in this file)
         ctx.reply_out_of_order(
-            page_scraper_agent.trigger(
+            _page_scraper_agent.trigger(
                 ctx.message_promises,
                 url=web_page.url,
                 rationale=web_page.rationale,
             )
         )
+    return len(web_pages_to_scrape)
 
 
 @miniagent
+@tracer.traced("read_page", attributes_from=("url",))
 async def page_scraper_agent(
     ctx: InteractionContext,
     url: str,
     rationale: str,
+    dedup_registry: DedupRegistry,
+    budget: RunBudget,
 ) -> None:
-    ctx.reply(f"READING PAGE: {url}\n{rationale}")
+    # The `reading_page` field lets the `final_answer_agent` know how many pages are being read
+    ctx.reply(TextMessage(f"READING PAGE: {url}\n{rationale}", reading_page=url))
+    try:
+        await _aread_page(ctx, url, rationale, dedup_registry, budget)
+    except Exception:
+        # The `failed_page` field lets the `final_answer_agent` know that this page is done with (the error itself
+        # reaches the user anyway)
+        ctx.reply(TextMessage(f"FAILED TO READ PAGE: {url}", failed_page=url, not_for_user=True))
+        raise
+
 
+async def _aread_page(
+    ctx: InteractionContext, url: str, rationale: str, dedup_registry: DedupRegistry, budget: RunBudget
+) -> None:
+    """
+    Scrape the page and reply with the summary of the facts that are relevant to the question (or with the reason why
+    there is none).
+    """
+    # Scrape the web page (if something goes wrong, Bright Data Scraping Browser will get a few more chances).
+    # NOTE: Scraping is not hedged - Selenium runs in threads which can't be cancelled, so the "losing" duplicate would
+    # keep a remote browser session busy (and paid for) anyway.
     try:
-        # Scrape the web page
-        page_content = await scrape_web_page(url)
-    except Exception:  # pylint: disable=broad-exception-caught
-        # Something went wrong upon the first attempt - let's give Bright Data Scraping Browser a second chance...
-        await asyncio.sleep(SLEEP_BEFORE_RETRY_SEC)
-        ctx.reply(f"RETRYING: {url}")
-        page_content = await scrape_web_page(url)
-
-    # Extract relevant information from the scraped web page.
-    # NOTE: This time we ARE awaiting for the completed OpenAI response instead of accepting a sequence promise. This
-    # is because we want to make sure that the page summary was generated without any problems before we report
-    # success.
-    page_summary = await OpenAIAgent.trigger(
-        # `OpenAIAgent` is a built-in miniagent for text generation using OpenAI
-        [
-            ctx.message_promises,
-            f"URL: {url}\nRATIONALE: {rationale}\n\nWEB PAGE CONTENT:\n\n{page_content}",
-        ],
-        system=(
-            "This is a user question that another AI agent (not you) will have to answer. Your job, however, is "
-            "to extract from WEB PAGE CONTENT facts that are relevant to the users original "
-            "question. The other AI agent will use the information you extract along with information extracted "
-            "by other agents to answer the user's original question later. "
-            "Current date is " + datetime.now().strftime("%Y-%m-%d")
-        ),
-        model=MODEL,
-        # Streaming doesn't really matter for internal use, could be False, could be True
-        stream=False,
-        # Let's break the flow of the current agent if LLM completion goes wrong (you will see at the very end of this
-        # file that we set `errors_as_messages` to True globally for all agents)
-        errors_as_messages=False,
-        response_metadata={
-            # This message, apart from being forwarded by the `research_agent` to the `final_answer_agent`, will also
-            # be delivered all the way to the user, so let's prevent it from being displayed (unless we wanted the user
-            # to see the internal "thinking" process of this agentic system with all its details).
-            # NOTE: We came up with the "not_for_user" attribute name specifically in this app. We could have used any
-            # other name, as long as we properly read it back (see the `main` function at the top of this file).
-            "not_for_user": True,
-        },
+        with tracer.span("scrape"):
+            # The scraping is cancelled if the budget of the run runs out in the meantime (the final answer won't wait
+            # for this page then)
+            page_content = await budget.arun(
+                aretry(
+                    lambda: scrape_web_page(url, budget=budget),
+                    SCRAPE_RETRY_POLICY,
+                    on_retry=lambda attempt, error: ctx.reply(f"RETRYING (ATTEMPT {attempt}): {url}"),
+                )
+            )
+    except BudgetExhaustedError:
+        _skip_page(ctx, budget, url)
+        return
+
+    # The same article is often published on several sites (or is available under urls that look nothing alike) - if
+    # another page with (almost) the same content was already read in this research, there is nothing new to learn
+    duplicate_of = dedup_registry.find_near_duplicate(url, page_content, await fingerprint_page_content(page_content))
+    if duplicate_of is not None:
+        saved_tokens = count_tokens(page_content, MODEL)
+        dedup_registry.record_saved_tokens(saved_tokens)
+        set_span_attribute("saved_tokens", saved_tokens)
+        # The `duplicate_of` field lets the `final_answer_agent` know that this page is done with
+        ctx.reply(TextMessage(f"SKIPPING DUPLICATE PAGE: {url}\n(SAME AS {duplicate_of})", duplicate_of=duplicate_of))
+        return
+
+    # When the budget runs low, the facts are extracted with a cheaper model
+    model = budget.model_for_extraction(MODEL, CHEAPER_MODEL)
+    set_span_attribute("model", model)
+
+    # The same page might have been processed before (for this or a similar question, with the same model) - if so,
+    # there is no need to ask the LLM to extract the facts again
+    question = str(await ctx.message_promises.as_single_text_promise())
+    cached_summary = await extraction_cache.aget(
+        page_content=page_content, url=url, rationale=rationale, question=question, model=model
     )
+    if cached_summary is not None:
+        set_span_attribute("extraction_cached", True)
+        ctx.reply(f"SCRAPING SUCCESSFUL (CACHED): {url}")
+        # The cached summary is delivered exactly the way a freshly generated one would be (including the
+        # "not_for_user" flag - see the explanation below)
+        ctx.reply(OpenAIMessage(cached_summary, role="assistant", model=model, not_for_user=True))
+        return
+
+    if budget.exhausted:
+        _skip_page(ctx, budget, url)
+        return
+
+    # Large pages are split into chunks that fit the context window of the model comfortably
+    chunks = split_into_token_chunks(page_content, CHUNK_TOKEN_BUDGETS[model], model)
+
+    if len(chunks) == 1:
+        # Extract relevant information from the scraped web page.
+        # NOTE: This time we ARE awaiting for the completed OpenAI response instead of accepting a sequence promise.
+        # This is because we want to make sure that the page summary was generated without any problems before we
+        # report success.
+        async with tracer.aspan("extract") as span, scheduler.aslot("llm"):
+            page_summary = await openai_agent.trigger(
+                # `openai_agent` is the built-in miniagent for text generation using OpenAI (see the top of this file)
+                [
+                    ctx.message_promises,
+                    f"URL: {url}\nRATIONALE: {rationale}\n\nWEB PAGE CONTENT:\n\n{page_content}",
+                ],
+                system=_page_extraction_system_prompt(),
+                model=model,
+                # Streaming doesn't really matter for internal use, could be False, could be True
+                stream=False,
+                # Let's break the flow of the current agent if LLM completion goes wrong (you will see at the very end
+                # of this file that we set `errors_as_messages` to True globally for all agents)
+                errors_as_messages=False,
+                response_metadata={
+                    # This message, apart from being forwarded by the `research_agent` to the `final_answer_agent`,
+                    # will also be delivered all the way to the user, so let's prevent it from being displayed (unless
+                    # we wanted the user to see the internal "thinking" process of this agentic system with all its
+                    # details).
+                    # NOTE: We came up with the "not_for_user" attribute name specifically in this app. We could have
+                    # used any other name, as long as we properly read it back (see the `main` function at the top of
+                    # this file).
+                    "not_for_user": True,
+                },
+            )
+            _record_token_usage(span, page_summary, budget)
+    else:
+        ctx.reply(f"READING PAGE IN {len(chunks)} PARTS: {url}")
+        # "Map" - extract facts from the chunks in parallel
+        chunk_facts = await _aextract_facts_from_chunks(ctx, url, rationale, chunks, model, budget)
+        if len(chunk_facts) == 1:
+            # Only one part of the page was relevant - there is nothing to merge
+            page_summary = (OpenAIMessage(chunk_facts[0], role="assistant", model=model, not_for_user=True),)
+        elif chunk_facts:
+            # "Reduce" - merge the facts from all the chunks into a single summary (the same kind of message as the
+            # one produced for a short page above)
+            async with tracer.aspan("merge_facts", parts=len(chunk_facts)) as span, scheduler.aslot("llm"):
+                page_summary = await openai_agent.trigger(
+                    [
+                        ctx.message_promises,
+                        f"URL: {url}\nRATIONALE: {rationale}\n\nFACTS EXTRACTED FROM PARTS OF THE WEB PAGE:\n\n"
+                        + "\n\n---\n\n".join(chunk_facts),
+                    ],
+                    system=(
+                        "This is a user question that another AI agent (not you) will have to answer. Other AI "
+                        "agents have extracted facts relevant to this question from different parts of the same web "
+                        "page. Your job is to merge these facts into a single coherent list of facts, removing "
+                        "duplicates and preserving all the details (numbers, names, dates, prices etc.). "
+                        "Current date is " + datetime.now().strftime("%Y-%m-%d")
+                    ),
+                    model=model,
+                    stream=False,
+                    errors_as_messages=False,
+                    response_metadata={"not_for_user": True},
+                )
+                _record_token_usage(span, page_summary, budget)
+        else:
+            page_summary = (
+                OpenAIMessage(
+                    f"No facts relevant to the question were found on {url}",
+                    role="assistant",
+                    model=model,
+                    not_for_user=True,
+                ),
+            )
+
     ctx.reply(f"SCRAPING SUCCESSFUL: {url}")  # Let's report success
     ctx.reply(page_summary)  # and send the summary
 
+    await extraction_cache.aset(
+        page_content=page_content,
+        url=url,
+        rationale=rationale,
+        question=question,
+        model=model,
+        summary="\n\n".join(str(message) for message in page_summary),
+    )
+
+
+async def _aparse_structured_output(
+    ctx: InteractionContext,
+    message_dicts: list[dict[str, str]],
+    response_format: type[BaseModel],
+    priority: Priority = Priority.NORMAL,
+    budget: Optional[RunBudget] = None,
+) -> BaseModel:
+    """
+    Call OpenAI's Structured Output with `SMARTER_MODEL` in a slot of the "llm" stage of the scheduler, with retries
+    (reported to the user via `ctx`) and hedging. The tokens are charged to the `budget` of the run (if given).
+    """
+
+    async def _aparse_once() -> BaseModel:
+        async with scheduler.aslot("llm", priority):
+            # The retries are done by `aretry`, OpenAI's client should not retry on its own on top of that
+            response = await openai_client.with_options(max_retries=0).beta.chat.completions.parse(
+                model=SMARTER_MODEL,
+                messages=message_dicts,
+                response_format=response_format,
+            )
+        # Attributed to the span of the caller (e.g. "plan" or "select_urls")
+        if response.usage is not None:
+            add_to_span_attribute("prompt_tokens", response.usage.prompt_tokens)
+            add_to_span_attribute("completion_tokens", response.usage.completion_tokens)
+            if budget is not None:
+                budget.record_tokens(response.usage.total_tokens)
+        return response.choices[0].message.parsed
+
+    return await aretry(
+        _aparse_once,
+        LLM_RETRY_POLICY,
+        on_retry=lambda attempt, error: ctx.reply(
+            f"RETRYING {response_format.__name__} (ATTEMPT {attempt}) AFTER {type(error).__name__}"
+        ),
+        latency_tracker=structured_output_latency,
+        hedge=True,
+    )
+
+
+def _page_extraction_system_prompt() -> str:
+    return (
+        "This is a user question that another AI agent (not you) will have to answer. Your job, however, is "
+        "to extract from WEB PAGE CONTENT facts that are relevant to the users original "
+        "question. The other AI agent will use the information you extract along with information extracted "
+        "by other agents to answer the user's original question later. "
+        "Current date is " + datetime.now().strftime("%Y-%m-%d")
+    )
+
+
+async def _aextract_facts_from_chunks(
+    ctx: InteractionContext, url: str, rationale: str, chunks: list[str], model: str, budget: RunBudget
+) -> list[str]:
+    """
+    Extract facts from the chunks of a web page with `model` (the one the chunks were sized for) in parallel (but not
+    more than `MAX_CONCURRENT_CHUNK_EXTRACTIONS` at a time). The chunks are processed in their original order and once
+    `ENOUGH_RELEVANT_CHUNKS` chunks turn out to be relevant (or the budget of the run is exhausted), the remaining ones
+    are skipped. Returns the facts from the relevant chunks in the order of the chunks.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHUNK_EXTRACTIONS)
+    chunk_facts: list[Optional[str]] = [None] * len(chunks)
+    relevant_chunks = 0
+
+    async def _aextract(chunk_idx: int, chunk: str) -> None:
+        nonlocal relevant_chunks
+
+        async with semaphore:
+            if relevant_chunks >= ENOUGH_RELEVANT_CHUNKS or budget.exhausted:
+                return
+            async with tracer.aspan("extract", part=chunk_idx + 1) as span, scheduler.aslot("llm"):
+                facts = await openai_agent.trigger(
+                    [
+                        ctx.message_promises,
+                        f"URL: {url}\nRATIONALE: {rationale}\n\n"
+                        f"WEB PAGE CONTENT (PART {chunk_idx + 1} OF {len(chunks)}):\n\n{chunk}",
+                    ],
+                    system=(
+                        _page_extraction_system_prompt()
+                        + f" If this part of the web page doesn't contain any relevant facts, reply with "
+                        f"{NO_RELEVANT_FACTS} and nothing else."
+                    ),
+                    model=model,
+                    stream=False,
+                    errors_as_messages=False,
+                )
+                _record_token_usage(span, facts, budget)
+            facts_str = "\n\n".join(str(message) for message in facts).strip()
+            if facts_str and NO_RELEVANT_FACTS not in facts_str:
+                chunk_facts[chunk_idx] = facts_str
+                relevant_chunks += 1
+
+    await asyncio.gather(*(_aextract(chunk_idx, chunk) for chunk_idx, chunk in enumerate(chunks)))
+    return [facts for facts in chunk_facts if facts]
+
+
+def _record_token_usage(span: Span, messages: tuple[Message, ...], budget: RunBudget) -> None:
+    # Non-streamed responses of `openai_agent` carry the token usage reported by OpenAI in their metadata
+    for message in messages:
+        usage = getattr(message, "usage", None)
+        if usage is not None:
+            span.add_to_attribute("prompt_tokens", usage.prompt_tokens)
+            span.add_to_attribute("completion_tokens", usage.completion_tokens)
+            budget.record_tokens(usage.prompt_tokens + usage.completion_tokens)
+
+
+def _skip_page(ctx: InteractionContext, budget: RunBudget, url: str) -> None:
+    budget.skip(url, "out of budget")
+    set_span_attribute("skipped", "out of budget")
+    # The `skipped_page` field lets the `final_answer_agent` know that this page is done with
+    ctx.reply(TextMessage(f"SKIPPING PAGE (OUT OF BUDGET): {url}", skipped_page=url))
+
 
 @miniagent
-async def final_answer_agent(ctx: InteractionContext, user_question: Union[Message, tuple[Message, ...]]) -> None:
-    # Here we await for the incoming `MessageSequencePromise` to materialize into a tuple of concrete `Message` objects
-    # (which would be the result of this `await` if we assigned it to a variable) - as you remember, all the results of
-    # the web searching and scraping are sent as input to the `final_answer_agent` (see the `research_agent` above).
-    await ctx.message_promises
-    # The only reason we do this `await` here is because we do not want the "=== ANSWER: ===" message below (which is
-    # available immediately, because it is a concrete string) to be sent to the user earlier than all the web searching
+async def final_answer_agent(
+    ctx: InteractionContext,
+    user_question: Union[Message, tuple[Message, ...]],
+    web_searches: int,
+    dedup_registry: DedupRegistry,
+    budget: RunBudget,
+) -> None:
+    # All the results of the web searching and scraping are sent as input to the `final_answer_agent` (see the
+    # `research_agent` above). Instead of awaiting for the whole incoming `MessageSequencePromise` to materialize, we
+    # collect the page summaries in the background, in the order of their availability, into a "fact sheet"...
+    fact_sheet = FactSheet(SYNTHESIS_POLICY, web_searches=web_searches)
+    collecting = asyncio.create_task(fact_sheet.acollect(ctx.message_promises))
+    # ...and wait only until enough of them are in (or until the slowest pages took too long - see `synthesis.py`, or
+    # until the budget of the run ran out - see `budget.py`).
+    with suppress(BudgetExhaustedError):
+        await budget.arun(fact_sheet.await_ready())
+    # The other reason to wait here is that we do not want the "=== ANSWER: ===" message below (which is available
+    # immediately, because it is a concrete string) to be sent to the user earlier than the bulk of the web searching
     # and scraping is done.
     #
     # As you might remember, the reports of the searching and scraping progress are being returned to the user as "out
     # of order" messages. Such messages are allowed to be delivered both, earlier as well as later than the "ordered"
-    # messages in the response sequence of an agent, depending on the timing of their availability.
+    # messages in the response sequence of an agent, depending on the timing of their availability (the reports of the
+    # pages that are still being read will be delivered after the answer).
     ctx.reply("==========\nANSWER:\n==========")
 
-    # Just to be clear. It's not the answer that is generated by OpenAI miniagent (below) that requires you to
-    # explicitly `await` for incoming messages, it is only the "=== ANSWER: ===" part (above) that does. We don't want
-    # the user to see the "=== ANSWER: ===" text first and then start receiving "SEARCHING", "READING PAGE",
-    # "SCRAPING SUCCESSFUL" etc.
-    #
-    # Since the generation of the final answer using OpenAI expects all the incoming messages to become part of the
-    # prompt (the `ctx.message_promises` part of the `trigger` parameters below), it would only have started after
-    # everything else was done regardless of whether you awaited for input explicitly or not.
-    ctx.reply(
-        # `OpenAIAgent` is a built-in miniagent for text generation using OpenAI
-        OpenAIAgent.trigger(
+    async with tracer.aspan("final_answer") as span:
+        facts_used = len(fact_sheet.summaries)
+        span.set_attribute("pages_used", facts_used)
+        span.set_attribute("coverage", fact_sheet.coverage)
+        # The final answer is what the user is waiting for, so it goes ahead of everything else in the queue of LLM
+        # calls
+        async with scheduler.aslot("llm", Priority.CRITICAL):
+            # `openai_agent` is the built-in miniagent for text generation using OpenAI (see the top of this file)
+            final_answer = openai_agent.trigger(
+                [
+                    "USER QUESTION:",
+                    user_question,
+                    "INFORMATION FOUND ON THE INTERNET:",
+                    *fact_sheet.summaries[:facts_used],
+                ],
+                system=(
+                    "Please answer the USER QUESTION based on the INFORMATION FOUND ON THE INTERNET. "
+                    "Current date is " + datetime.now().strftime("%Y-%m-%d")
+                ),
+                model=MODEL,
+            )
+            ctx.reply(final_answer)
+            # Hold the slot until the answer is fully generated (the user still receives it token by token, because
+            # it was passed to `ctx.reply` above)
+            final_answer_messages = await final_answer
+        # The answer is streamed, and streamed responses don't report token usage, hence the estimates (the system
+        # message is left out of the prompt - it is only a couple of sentences)
+        question_text = (
+            "\n\n".join(str(message) for message in user_question)
+            if isinstance(user_question, tuple)
+            else str(user_question)
+        )
+        prompt_tokens = count_tokens("\n\n".join([question_text, *fact_sheet.summaries[:facts_used]]), MODEL)
+        completion_tokens = count_tokens("".join(str(message) for message in final_answer_messages), MODEL)
+        span.set_attribute("prompt_tokens", prompt_tokens)
+        span.set_attribute("completion_tokens", completion_tokens)
+        budget.record_tokens(prompt_tokens + completion_tokens)
+
+        # The pages that were still being read when the answer started ("stragglers")
+        await collecting
+        stragglers = fact_sheet.summaries[facts_used:]
+        if stragglers and SYNTHESIS_POLICY.stragglers == "append" and not budget.exhausted:
+            await _aappend_to_final_answer(ctx, user_question, final_answer_messages, stragglers, budget)
+        elif stragglers:
+            span.set_attribute("pages_dropped", len(stragglers))
+
+    # Let the user know what the answer is missing because of the budget
+    if budget.skipped_sources:
+        ctx.reply("==========\nSKIPPED SOURCES (OUT OF BUDGET):\n==========")
+        ctx.reply(budget.format_skipped_sources())
+    budget.close()
+
+    # All the work of this research is done by now - let's write down where the time went (see `tracing.py`)
+    export_trace_summary(span.trace_id, dedup=dedup_registry.stats(), budget=budget.stats())
+
+
+async def _aappend_to_final_answer(
+    ctx: InteractionContext,
+    user_question: Union[Message, tuple[Message, ...]],
+    final_answer_messages: tuple[Message, ...],
+    stragglers: list[str],
+    budget: RunBudget,
+) -> None:
+    """
+    Complement the final answer with the page summaries that arrived after it had started (if they add anything).
+    """
+    async with tracer.aspan("addendum", pages=len(stragglers)) as span, scheduler.aslot("llm", Priority.CRITICAL):
+        addendum = await openai_agent.trigger(
             [
                 "USER QUESTION:",
                 user_question,
-                "INFORMATION FOUND ON THE INTERNET:",
-                # The `as_single_text_promise()` method concatenates all the messages in the promised sequence into a
-                # single text message promise with the original messages separated by double newlines. As you can see,
-                # it also returns a promise (and there is no `await` in front of it). The actual concatenation happens
-                # in the background because the messages that are being concatenated might also not be available right
-                # away.
-                ctx.message_promises.as_single_text_promise(),
+                "ANSWER GIVEN SO FAR:",
+                final_answer_messages,
+                "MORE INFORMATION FOUND ON THE INTERNET:",
+                *stragglers,
             ],
             system=(
-                "Please answer the USER QUESTION based on the INFORMATION FOUND ON THE INTERNET. "
+                "The USER QUESTION was already answered based on part of the information found on the internet (see "
+                "ANSWER GIVEN SO FAR). Please write a short addendum to this answer based on MORE INFORMATION FOUND "
+                "ON THE INTERNET - only what this information adds to the answer or corrects in it. If it adds "
+                f"nothing of substance, reply with {NOTHING_TO_ADD} and nothing else. "
                 "Current date is " + datetime.now().strftime("%Y-%m-%d")
             ),
             model=MODEL,
+            # The addendum is only shown if there is something to add, hence no streaming
+            stream=False,
+            errors_as_messages=False,
         )
-    )
+        _record_token_usage(span, addendum, budget)
+
+    addendum_str = "\n\n".join(str(message) for message in addendum).strip()
+    if addendum_str and NOTHING_TO_ADD not in addendum_str:
+        ctx.reply("==========\nADDENDUM:\n==========")
+        ctx.reply(addendum)
 
 
 class WebSearch(BaseModel):
@@ -343,7 +906,9 @@ class WebPagesToBeRead(BaseModel):
 
 
 if __name__ == "__main__":
-    MiniAgents(
+    # `WebResearchMiniAgents` is a regular `MiniAgents` context which, in addition, shuts down the pooled remote
+    # browser sessions (and other shared resources) from `utils.py` when all the agents are done
+    WebResearchMiniAgents(
         # # Make OpenAIAgent (as well as any other LLM miniagent) log LLM requests and responses as markdown files in
         # # the `llm_logs` folder under the current working directory (helps understand what happens under the hood).
         # # Check the `llm_logs` folder after you run this app to see what those files looks like.